@@ -29,9 +29,6 @@ generate_stats_for_file() {
     # By default don't include router traffic in these metrics
     global_filter="!(ip && (ip.addr == 192.168.1.1 || ip.addr == 192.168.3.1 || ip.addr == 192.168.231.1))"
 
-    lan_filter="(eth.dst.ig == 1 || ((ip.src == 10.0.0.0/8 || ip.src == 172.16.0.0/12 || ip.src == 192.168.0.0/16 || ipv6.src == 2620:0:5300::/44 || ipv6.src == fdc4:22e1:d500::/32) && (ip.dst == 10.0.0.0/8 || ip.dst == 172.16.0.0/12 || ip.dst == 192.168.0.0/16 || ipv6.dst == ff00::/8 || ipv6.dst == fe80::/10 ||  ipv6.dst == 2620:0:5300::/44 || ipv6.dst == fdc4:22e1:d500::/32)))"
-    wan_filter="(eth.dst.ig == 0 && !((ip.src == 10.0.0.0/8 || ip.src == 172.16.0.0/12 || ip.src == 192.168.0.0/16 || ipv6.src == 2620:0:5300::/44 || ipv6.src == fdc4:22e1:d500::/32) && (ip.dst == 10.0.0.0/8 || ip.dst == 172.16.0.0/12 || ip.dst == 192.168.0.0/16 || ipv6.dst == ff00::/8 || ipv6.dst == fe80::/10 ||  ipv6.dst == 2620:0:5300::/44 || ipv6.dst == fdc4:22e1:d500::/32)))"
-
     # Use tshark to parse the statistics
     tshark -q -r $pcap_file -z io,stat,$interval_size,"${global_filter}","eth.src == $mac && ${global_filter}","eth.dst == $mac && ${global_filter}" | grep "<>" > "stats.tmp"
 
@@ -106,6 +103,11 @@ if [ "$#" -ne 4 ]; then
     usage
 fi
 
+# LAN/WAN filters are built from the same site prefixes the Python scripts use
+script_dir=$(dirname "${BASH_SOURCE[0]}")
+lan_filter=$(python3 "$script_dir/../python/lan_classifier.py" lan)
+wan_filter=$(python3 "$script_dir/../python/lan_classifier.py" wan)
+
 # Verify interval_size is a number
 if [ -n "$3" ] && [ "$3" -eq "$3" ]; then
   interval_size=$3
@@ -1,6 +1,8 @@
 #!/bin/bash
 
-global_filter="(eth.dst.ig == 1 || ((ip.src == 10.0.0.0/8 || ip.src == 172.16.0.0/12 || ip.src == 192.168.0.0/16 || ipv6.src == 2620:0:5300::/44 || ipv6.src == fdc4:22e1:d500::/32) && (ip.dst == 10.0.0.0/8 || ip.dst == 172.16.0.0/12 || ip.dst == 192.168.0.0/16 || ipv6.dst == ff00::/8 || ipv6.dst == fe80::/10 ||  ipv6.dst == 2620:0:5300::/44 || ipv6.dst == fdc4:22e1:d500::/32)))"
+# The filter is built from the same site prefixes the Python scripts use
+script_dir=$(dirname "${BASH_SOURCE[0]}")
+global_filter=$(python3 "$script_dir/../../python/lan_classifier.py" lan)
 
 pcap_filename=`echo "${1%.pcap}"`
 outfile="${pcap_filename}-LAN.pcap"
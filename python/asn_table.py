@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+import lan_classifier
+from lan_classifier import IPV6_KEY_BITS
+
+# Offline IP -> ASN lookups from a routeviews style prefix to origin AS dump (<prefix> <length> <asn> per line, e.g. CAIDA's pfx2as)
+# Nested prefixes are flattened into disjoint [start, end] intervals holding the most specific prefix's AS,
+# so a lookup is a single binary search over sorted NumPy arrays
+
+# Addresses are keyed like lan_classifier, IPv6 on its upper 64 bits, which every routed prefix fits in
+KEY_BITS = {4: 32, 6: IPV6_KEY_BITS}
+
+# Loads the prefix dump and returns {version: (starts, ends, asns)} with uint32 (IPv4) or uint64 (IPv6) intervals
+def load_prefix_table(file_location):
+
+    prefixes = {4: (list(), list(), list()), 6: (list(), list(), list())}
+    with open(file_location) as infile:
+        for line in infile:
+            parts = line.split()
+            if len(parts) < 3 or not parts[1].isdigit():
+                continue
+
+            # Multi-origin prefixes are written 1_2 and AS sets 1,2, keep the first AS of either
+            asn = parts[2].split('_')[0].split(',')[0]
+            version, key = lan_classifier.address_key(parts[0])
+            if version == None or not asn.isdigit():
+                continue
+
+            keys, lengths, asns = prefixes[version]
+            keys.append(key)
+            lengths.append(int(parts[1]))
+            asns.append(int(asn))
+
+    table = dict()
+    for version in [4, 6]:
+        table[version] = build_intervals(*prefixes[version], KEY_BITS[version])
+
+    return table
+
+
+# Turns (network key, prefix length, asn) prefixes into disjoint intervals, where prefixes overlap the longer one wins
+def build_intervals(keys, lengths, asns, key_bits):
+
+    dtype = np.uint32 if key_bits == 32 else np.uint64
+    last_key = np.uint64((1 << key_bits) - 1)
+
+    keys = np.asarray(keys, dtype=np.uint64)
+    lengths = np.minimum(np.asarray(lengths, dtype=np.int64), key_bits)
+    asns = np.asarray(asns, dtype=np.int64)
+    if len(keys) == 0:
+        return np.zeros(0, dtype=dtype), np.zeros(0, dtype=dtype), np.zeros(0, dtype=np.int64)
+
+    # The host bits of each prefix length, looked up since NumPy can't shift a uint64 by 64
+    host_masks = np.array([(1 << (key_bits - x)) - 1 for x in range(key_bits + 1)], dtype=np.uint64)
+    masks = host_masks[lengths]
+    starts = keys & ~masks
+    ends = starts | masks
+
+    # Every prefix starts and ends on a boundary, so no prefix starts or ends inside a piece between two of them
+    boundaries = np.unique(np.concatenate([starts, ends[ends != last_key] + np.uint64(1)]))
+    piece_starts = boundaries
+    piece_ends = np.append(boundaries[1:] - np.uint64(1), last_key)
+
+    # Prefixes of one length never overlap each other, so each length is one search over all the pieces
+    # Lengths go from short to long so the most specific prefix is the one left covering a piece
+    covered = np.zeros(len(piece_starts), dtype=bool)
+    values = np.zeros(len(piece_starts), dtype=np.int64)
+    for length in np.unique(lengths):
+        selected = np.flatnonzero(lengths == length)
+        order = selected[np.argsort(starts[selected], kind="stable")]
+        level_starts, first = np.unique(starts[order], return_index=True)
+        level_ends = ends[order][first]
+        level_asns = asns[order][first]
+
+        candidates = np.searchsorted(level_starts, piece_starts, side="right") - 1
+        found = (candidates >= 0) & (piece_starts <= level_ends[np.maximum(candidates, 0)])
+        values = np.where(found, level_asns[np.maximum(candidates, 0)], values)
+        covered |= found
+
+    piece_starts = piece_starts[covered]
+    piece_ends = piece_ends[covered]
+    values = values[covered]
+
+    # Neighbouring pieces of the same AS are merged into one interval
+    joined = (values[1:] == values[:-1]) & (piece_starts[1:] == piece_ends[:-1] + np.uint64(1))
+    first_pieces = np.flatnonzero(np.concatenate([[True], ~joined]))
+    last_pieces = np.append(first_pieces[1:] - 1, len(values) - 1)
+
+    return piece_starts[first_pieces].astype(dtype), piece_ends[last_pieces].astype(dtype), values[first_pieces]
+
+
+# Bulk lookup of one IP version's keys, returns the AS of each or 0 where no prefix covers it
+def lookup_keys(table, version, keys):
+
+    starts, ends, asns = table[version]
+    keys = np.asarray(keys, dtype=starts.dtype)
+    if len(starts) == 0:
+        return np.zeros(len(keys), dtype=np.int64)
+
+    # Working through the keys in order keeps the binary searches and the reads after them on the same cache lines,
+    # which pays for the sort many times over
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    candidates = np.maximum(np.searchsorted(starts, sorted_keys, side="right") - 1, 0)
+    found = (sorted_keys >= starts[candidates]) & (sorted_keys <= ends[candidates])
+
+    ret_asns = np.empty(len(keys), dtype=np.int64)
+    ret_asns[order] = np.where(found, asns[candidates], 0)
+    return ret_asns
+
+
+# Bulk lookup of address strings of either IP version, returns the AS of each or 0
+def lookup_addresses(table, addresses):
+
+    # Addresses repeat, so only parse each distinct one
+    codes, uniques = pd.factorize(np.asarray(addresses, dtype=object))
+
+    versions = np.zeros(len(uniques), dtype=np.int8)
+    keys = {4: np.zeros(len(uniques), dtype=np.uint32), 6: np.zeros(len(uniques), dtype=np.uint64)}
+    for i, address in enumerate(uniques):
+        version, key = lan_classifier.address_key(address)
+        if version != None:
+            versions[i] = version
+            keys[version][i] = key
+
+    unique_asns = np.zeros(len(uniques), dtype=np.int64)
+    for version in [4, 6]:
+        unique_asns = np.where(versions == version, lookup_keys(table, version, keys[version]), unique_asns)
+
+    return np.where(codes >= 0, unique_asns[np.maximum(codes, 0)], 0)
+
+
+# Loads AS names in the "<asn> <name>, <CC>" format of RIPE's asn.txt, returns {asn: (owner, country)}
+# Owners keep the country on the end like the Cymru answers do
+def load_as_names(file_location):
+
+    as_names = dict()
+    with open(file_location, encoding="utf-8", errors="replace") as infile:
+        for line in infile:
+            asn, _, owner = line.strip().partition(' ')
+            if not asn.isdigit() or owner == "":
+                continue
+
+            country = None
+            name, _, suffix = owner.rpartition(', ')
+            if name != "" and len(suffix) == 2 and suffix.isalpha():
+                country = suffix
+
+            as_names[int(asn)] = (owner, country)
+
+    return as_names
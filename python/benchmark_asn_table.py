@@ -0,0 +1,84 @@
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import time
+import numpy as np
+import asn_table
+from parse_protocols import is_positive_int
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description="Times building the offline ASN table from a synthetic routeviews style prefix dump and looking addresses up in it")
+    parser.add_argument('--prefixes', type=is_positive_int, default=1000000, help="The number of prefixes in the dump, about 1 in 8 of them IPv6")
+    parser.add_argument('--lookups', type=is_positive_int, default=1000000, help="The number of addresses looked up at once")
+    parser.add_argument('--repeats', type=is_positive_int, default=3, help="The best of this many runs is reported")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        dump_location = os.path.join(temp_dir, "pfx2as.txt")
+        write_prefix_dump(dump_location, args.prefixes, rng)
+
+        load_best = time_best(args.repeats, lambda: asn_table.load_prefix_table(dump_location))
+        table = asn_table.load_prefix_table(dump_location)
+
+    interval_count = sum(len(table[x][0]) for x in table)
+
+    # Random keys for the bulk lookup, and a smaller set of address strings for the parsing path
+    v4_keys = rng.integers(0, 2 ** 32, args.lookups, dtype=np.uint64).astype(np.uint32)
+    v6_keys = (np.uint64(0x2000) << np.uint64(48)) | rng.integers(0, 2 ** 48, args.lookups, dtype=np.uint64)
+    addresses = [socket.inet_ntop(socket.AF_INET, int(x).to_bytes(4, "big")) for x in v4_keys[:min(args.lookups, 100000)]]
+
+    v4_best = time_best(args.repeats, lambda: asn_table.lookup_keys(table, 4, v4_keys))
+    v6_best = time_best(args.repeats, lambda: asn_table.lookup_keys(table, 6, v6_keys))
+    address_best = time_best(args.repeats, lambda: asn_table.lookup_addresses(table, addresses))
+
+    print(f"{args.prefixes} prefixes flattened into {interval_count} intervals")
+    print(f"{'step':<28}{'count':>10}{'best ms':>12}{'ns/item':>10}")
+    for step, count, best in [("load + build", args.prefixes, load_best), ("lookup IPv4 keys", len(v4_keys), v4_best), ("lookup IPv6 keys", len(v6_keys), v6_best), ("lookup address strings", len(addresses), address_best)]:
+        print(f"{step:<28}{count:>10}{best * 1000:>12.2f}{best * 1000000000 / count:>10.1f}")
+
+
+def time_best(repeats, function):
+
+    best = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+# Writes <prefix> <length> <asn> lines shaped roughly like a real table
+# IPv4 is mostly /24s with some shorter covering prefixes, IPv6 is /32 to /48 inside 2000::/16
+def write_prefix_dump(file_location, prefix_count, rng):
+
+    v6_count = prefix_count // 8
+    v4_count = prefix_count - v6_count
+
+    v4_lengths = rng.choice([8, 12, 16, 20, 22, 23, 24], v4_count, p=[0.001, 0.009, 0.04, 0.05, 0.1, 0.1, 0.7])
+    v4_keys = rng.integers(0, 2 ** 32, v4_count, dtype=np.uint64)
+    v6_lengths = rng.choice([32, 36, 40, 44, 48], v6_count, p=[0.2, 0.1, 0.1, 0.1, 0.5])
+    v6_keys = rng.integers(0, 2 ** 48, v6_count, dtype=np.uint64)
+    asns = rng.integers(1, 400000, prefix_count)
+
+    with open(file_location, "w") as outfile:
+        for i in range(v4_count):
+            host_bits = 32 - int(v4_lengths[i])
+            network = (int(v4_keys[i]) >> host_bits) << host_bits
+            outfile.write(f"{socket.inet_ntop(socket.AF_INET, network.to_bytes(4, 'big'))}\t{v4_lengths[i]}\t{asns[i]}\n")
+
+        for i in range(v6_count):
+            host_bits = 128 - int(v6_lengths[i])
+            network = (((0x2000 << 48) | int(v6_keys[i])) << 64 >> host_bits) << host_bits
+            outfile.write(f"{socket.inet_ntop(socket.AF_INET6, network.to_bytes(16, 'big'))}\t{v6_lengths[i]}\t{asns[v4_count + i]}\n")
+
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
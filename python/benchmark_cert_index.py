@@ -0,0 +1,116 @@
+import argparse
+import random
+import sys
+import time
+import cert_index
+from parse_protocols import is_positive_int
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description="Times matching hostnames to certificate owners with the suffix index against trying every certificate name")
+    parser.add_argument('--certs', type=is_positive_int, default=10000, help="The number of synthetic certificates")
+    parser.add_argument('--hostnames', type=is_positive_int, default=10000, help="The number of hostnames matched against them")
+    parser.add_argument('--linear-hostnames', type=is_positive_int, default=500, help="How many of the hostnames the per-name scan is timed on, the rest is extrapolated")
+    parser.add_argument('--repeats', type=is_positive_int, default=3, help="The best of this many runs is reported")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    cert_data, domains = build_certs(args.certs, rng)
+    hostnames = build_hostnames(args.hostnames, domains, rng)
+    linear_hostnames = hostnames[:min(args.linear_hostnames, len(hostnames))]
+
+    build_best = time_best(args.repeats, lambda: cert_index.build_cert_index(cert_data))
+    index = cert_index.build_cert_index(cert_data)
+    lookup_best = time_best(args.repeats, lambda: [cert_index.find_cert(index, x) for x in hostnames])
+    linear_best = time_best(args.repeats, lambda: [find_cert_linear(cert_data, x) for x in linear_hostnames])
+
+    # Both have to pick the same certificate for every hostname
+    mismatches = sum(1 for x in linear_hostnames if cert_index.find_cert(index, x) is not find_cert_linear(cert_data, x))
+    matched = sum(1 for x in hostnames if cert_index.find_cert(index, x) != None)
+
+    linear_total = linear_best * len(hostnames) / len(linear_hostnames)
+    print(f"{args.certs} certs, {len(hostnames)} hostnames, {matched} with an owner, {mismatches} mismatches against the scan on {len(linear_hostnames)}")
+    print(f"{'step':<28}{'count':>10}{'best ms':>12}{'us/item':>10}")
+    for step, count, best in [("build index", args.certs, build_best), ("index lookups", len(hostnames), lookup_best), ("scan every name (est.)", len(hostnames), linear_total)]:
+        print(f"{step:<28}{count:>10}{best * 1000:>12.2f}{best * 1000000 / count:>10.2f}")
+
+
+def time_best(repeats, function):
+
+    best = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+# The matching resolve_owner_with_cert_information did before the index, first certificate with a name the hostname ends with
+def find_cert_linear(cert_data, hostname):
+
+    for serial in cert_data:
+        cert = cert_data[serial]
+        if "orgName" not in cert:
+            continue
+
+        names_to_check = list()
+        if "commonName" in cert:
+            names_to_check.append(cert["commonName"])
+        if "altNames" in cert:
+            names_to_check.extend(cert["altNames"])
+
+        for name in names_to_check:
+            if name.startswith("*"):
+                name = name[1:]
+            if hostname.endswith(name):
+                return cert
+
+    return None
+
+
+def random_label(rng):
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for i in range(rng.randint(3, 10)))
+
+
+# Certificates for made up domains, mostly a wildcard plus the bare domain, some with extra hosts or other domains
+# A few have no organization, like domain validated certificates
+def build_certs(cert_count, rng):
+
+    tlds = ["com", "net", "org", "io", "co.uk", "de"]
+    cert_data = dict()
+    domains = list()
+    for i in range(cert_count):
+        domain = f"{random_label(rng)}.{rng.choice(tlds)}"
+        domains.append(domain)
+
+        alt_names = [f"*.{domain}", domain]
+        for j in range(rng.randint(0, 3)):
+            alt_names.append(f"{random_label(rng)}.{rng.choice([domain, domains[rng.randrange(len(domains))]])}")
+
+        cert = {"commonName": rng.choice(alt_names[:2]), "altNames": alt_names, "countryName": "US"}
+        if rng.random() < 0.9:
+            cert["orgName"] = f"Org {i}"
+        cert_data[f"{i:08x}"] = cert
+
+    return cert_data, domains
+
+
+# Hostnames under the certificates' domains, a few levels deep, mixed with ones no certificate covers
+def build_hostnames(hostname_count, domains, rng):
+
+    hostnames = list()
+    for i in range(hostname_count):
+        if rng.random() < 0.7:
+            labels = [random_label(rng) for j in range(rng.randint(0, 2))]
+            hostnames.append(".".join(labels + [rng.choice(domains)]))
+        else:
+            hostnames.append(f"{random_label(rng)}.{random_label(rng)}.example")
+
+    return hostnames
+
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,64 @@
+import argparse
+import sys
+import time
+from parse_protocols import unwind_phs_tree
+from parse_protocols import is_positive_int
+
+# Header and footer tshark wraps around the io,phs tree
+phs_header = ["", "===================================================================", "Protocol Hierarchy Statistics", "Filter: ", ""]
+phs_footer = ["==================================================================="]
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description="Times unwind_phs_tree on synthetic protocol hierarchies of increasing size")
+    parser.add_argument('--lines', type=is_positive_int, default=10000, help="The size of the largest hierarchy, smaller ones are timed at 1/10, 1/4 and 1/2 of it")
+    parser.add_argument('--repeats', type=is_positive_int, default=5, help="The best of this many runs is reported")
+    args = parser.parse_args()
+
+    sizes = sorted(set([max(1, args.lines // 10), max(1, args.lines // 4), max(1, args.lines // 2), args.lines]))
+
+    # A linear parser should show the same cost per line at every size
+    print(f"{'shape':<8}{'lines':>10}{'best ms':>12}{'us/line':>10}")
+    for shape in ["wide", "deep", "mixed"]:
+        for size in sizes:
+            phs_lines = build_phs_lines(shape, size)
+
+            best = None
+            for i in range(args.repeats):
+                start = time.perf_counter()
+                protocol_list = unwind_phs_tree(iter(phs_lines))
+                elapsed = time.perf_counter() - start
+                if best == None or elapsed < best:
+                    best = elapsed
+
+            # Every tree line plus the empty root chain
+            assert len(protocol_list) == size + 1
+
+            print(f"{shape:<8}{size:>10}{best * 1000:>12.2f}{best * 1000000 / size:>10.2f}")
+
+
+# Builds io,phs output with the given number of tree lines, as tshark would stream it
+# wide: eth/ip/udp with every other protocol directly below it
+# deep: chains 32 protocols long, each one climbing all the way back up before the next
+# mixed: short chains of up to 6 protocols
+def build_phs_lines(shape, size):
+
+    tree = list()
+    for i in range(size):
+        if i == 0:
+            depth = 0
+        elif shape == "wide":
+            depth = min(i, 3)
+        elif shape == "deep":
+            depth = 1 + (i % 32)
+        else:
+            depth = 1 + (i % 6)
+
+        name = "eth" if i == 0 else f"proto{i}"
+        tree.append(f"{'  ' * depth}{name:<40}frames:{size - i} bytes:{(size - i) * 100}")
+
+    return [f"{line}\n" for line in phs_header + tree + phs_footer]
+
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
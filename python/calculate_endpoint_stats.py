@@ -2,6 +2,8 @@ import argparse
 import os
 import sys
 import csv
+import pandas as pd
+import protocol_output
 
 
 protos_to_skip = ["ip", "udp", "tls", "tcp", "ipv6"]
@@ -492,48 +494,27 @@ def read_protocol_data(protocol_files):
     # Get list of files
     file_list = protocol_files.split(';')
 
-    for protocol_file in file_list:
+    # Load every file, they can be any format parse_protocols writes
+    table = pd.concat([protocol_output.read_protocol_table(x) for x in file_list], ignore_index=True)
+    table = table[~table["Protocol"].isin(protos_to_skip)]
 
-        # Load CSV
-        with open(protocol_file, newline='') as infile:
-            
-            file_reader = csv.reader(infile)
-            next(file_reader, None)  # skip the headers
-            
-            for row in file_reader:
-                protocol = row[2]
-                protocol_ip = row[3]
-                packet_count = row[4]
-                byte_count = row[5]
-                tx_packet_count = row[6]
-                tx_byte_count = row[7]
-                rx_packet_count = row[8]
-                rx_byte_count = row[9]
-
-                if protocol in protos_to_skip:
-                    continue
+    # Sum each IP/protocol pair across the files, keeping the order they're first seen in
+    totals = table.groupby(["IP", "Protocol"], sort=False)[protocol_output.count_columns].sum()
 
-                if protocol_ip not in ret_dict:
-                    proto_dict = dict()
-                    ret_dict[protocol_ip] = proto_dict
+    for (protocol_ip, protocol), counts in zip(totals.index, totals.itertuples(index=False)):
 
-                if protocol not in ret_dict[protocol_ip]: 
-                    inner_proto_dict = dict()
-                    inner_proto_dict["Packets"] = int(packet_count)
-                    inner_proto_dict["Bytes"] = int(byte_count)
-                    inner_proto_dict["TxPackets"] = int(tx_packet_count)
-                    inner_proto_dict["TxBytes"] = int(tx_byte_count)
-                    inner_proto_dict["RxPackets"] = int(rx_packet_count)
-                    inner_proto_dict["RxBytes"] = int(rx_byte_count)
-                    ret_dict[protocol_ip][protocol] = inner_proto_dict
+        if protocol_ip not in ret_dict:
+            proto_dict = dict()
+            ret_dict[protocol_ip] = proto_dict
 
-                else:
-                    ret_dict[protocol_ip][protocol]["Packets"] += int(packet_count)
-                    ret_dict[protocol_ip][protocol]["Bytes"] += int(byte_count)
-                    ret_dict[protocol_ip][protocol]["TxPackets"] += int(tx_packet_count)
-                    ret_dict[protocol_ip][protocol]["TxBytes"] += int(tx_byte_count)
-                    ret_dict[protocol_ip][protocol]["RxPackets"] += int(rx_packet_count)
-                    ret_dict[protocol_ip][protocol]["RxBytes"] += int(rx_byte_count)
+        inner_proto_dict = dict()
+        inner_proto_dict["Packets"] = int(counts.TotalPackets)
+        inner_proto_dict["Bytes"] = int(counts.TotalBytes)
+        inner_proto_dict["TxPackets"] = int(counts.TxPackets)
+        inner_proto_dict["TxBytes"] = int(counts.TxBytes)
+        inner_proto_dict["RxPackets"] = int(counts.RxPackets)
+        inner_proto_dict["RxBytes"] = int(counts.RxBytes)
+        ret_dict[protocol_ip][protocol] = inner_proto_dict
 
     return ret_dict
 
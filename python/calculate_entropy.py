@@ -1,27 +1,66 @@
-import subprocess
 import argparse
 import os
+import subprocess
+import tempfile
+import hashlib
 import sys
 import csv
-from math import log
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
 from rich.progress import Progress
 from rich.progress import Group
 from rich.live import Live
 from rich.progress import TextColumn
 from rich.progress import BarColumn
 from rich.progress import TaskProgressColumn
+import lan_classifier
+from parse_protocols import stream_packet_field_chunks
+from device_ips import find_device_ips
 
-lan_filter = "(eth.dst.ig == 1 || ((ip.src == 10.0.0.0/8 || ip.src == 172.16.0.0/12 || ip.src == 192.168.0.0/16 || ipv6.src == 2620:0:5300::/44 || ipv6.src == fdc4:22e1:d500::/32) && (ip.dst == 10.0.0.0/8 || ip.dst == 172.16.0.0/12 || ip.dst == 192.168.0.0/16 || ipv6.dst == ff00::/8 || ipv6.dst == fe80::/10 ||  ipv6.dst == 2620:0:5300::/44 || ipv6.dst == fdc4:22e1:d500::/32)))"
-wan_filter = "(eth.dst.ig == 0 && !((ip.src == 10.0.0.0/8 || ip.src == 172.16.0.0/12 || ip.src == 192.168.0.0/16 || ipv6.src == 2620:0:5300::/44 || ipv6.src == fdc4:22e1:d500::/32) && (ip.dst == 10.0.0.0/8 || ip.dst == 172.16.0.0/12 || ip.dst == 192.168.0.0/16 || ipv6.dst == ff00::/8 || ipv6.dst == fe80::/10 ||  ipv6.dst == 2620:0:5300::/44 || ipv6.dst == fdc4:22e1:d500::/32)))"
+# Flows with one of these IPs on either end (the routers) are left out, TCP and UDP alike and in exact and sketch mode the same
 exclude_ips = ("192.168.1.1", "192.168.3.1", "192.168.231.1", "192.168.2.1")
 
+# Fields exported for every packet when counting flows, in column order
+flow_fields = ["frame.time_relative", "frame.len", "eth.dst.ig", "ip.src", "ip.dst", "ipv6.src", "ipv6.dst", "tcp.srcport", "tcp.dstport", "udp.srcport", "udp.dstport"]
+
+# Packets are read this many at a time, and the per chunk flow tables are folded together every few chunks
+flow_chunk_rows = 250000
+flow_fold_tables = 8
+flow_group_keys = ["window", "scope", "proto", "ip_a", "port_a", "ip_b", "port_b"]
+
+# Flow summaries are kept here, one per capture, bump the version whenever their layout changes
+summary_dir = os.path.join("results", "flows")
+SUMMARY_FORMAT_VERSION = 1
+
+# Each counter's flow bitmap has 2 ** sketch_bitmap_shift bits packed into bytes
+# Linear counting on a bitmap this size can't count past about 1.4k flows per counter (sketch_saturation_flows)
+sketch_bitmap_shift = 8
+sketch_bitmap_bits = 2 ** sketch_bitmap_shift
+sketch_bitmap_bytes = sketch_bitmap_bits // 8
+sketch_saturation_flows = int(round(-sketch_bitmap_bits * np.log1p(-(sketch_bitmap_bits - 1) / sketch_bitmap_bits)))
+
 def main(argv):
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('input_csv', type=is_file, help="A CSV containing paths to pcap files to analyze")
+    parser.add_argument('input_csv', type=is_file, help="A CSV containing paths to pcap files to analyze, or to flow summaries with --merge")
+    parser.add_argument('--jobs', type=is_positive_int, default=1, help="The number of files to process at once")
+    parser.add_argument('--window', type=is_positive_int, default=None, metavar="SECONDS", help="Calculate entropy for each window of this many seconds instead of the whole capture, windows line up with the generateStatsForIntervals.bash intervals")
+    parser.add_argument('--merge', default=None, metavar="NAME", help=f"Combine the flow summaries in input_csv (saved to {summary_dir} as <capture>-<path hash>-flows.npz for every capture analyzed) into one capture called NAME and calculate its entropy without reading any pcaps")
+    parser.add_argument('--sketch', type=is_positive_int, default=None, metavar="WIDTH", help="Estimate entropy with count-min sketches WIDTH counters wide instead of exact flow tables, memory stays fixed however long the captures are and an estimated error (not a guaranteed bound) is reported with every entropy")
+    parser.add_argument('--sketch-depth', type=is_positive_int, default=4, help="The number of rows in each sketch, more rows narrow the estimated error")
     args = parser.parse_args()
     paths = parse_cfg_csv(args.input_csv)
 
+    if args.sketch != None and (args.window != None or args.merge != None):
+        parser.error("--sketch estimates whole captures and can't be used with --window or --merge")
+
+    if args.merge != None:
+        if args.window != None:
+            parser.error("--merge works on whole capture summaries and can't be used with --window")
+        merge_flow_summaries(paths, args.merge)
+        return
+
     # Setup interactive environment for nice statusing
     overall_progress = Progress(
         TextColumn("[blue][progress.description]{task.description}"),
@@ -54,42 +93,76 @@ def main(argv):
         # Prep output
         lines_to_write = []
         header = "Filename,LAN Packet Entropy,LAN Byte Entropy,WAN Packet Entropy,WAN Byte Entropy,Overall Packet Entropy,Overall Byte Entropy\n"
+        if args.window != None:
+            header = header.replace("Filename,", "Filename,WindowStart,")
+        elif args.sketch != None:
+            header = "Filename,LAN Packet Entropy,LAN Packet Entropy Estimated Error,LAN Byte Entropy,LAN Byte Entropy Estimated Error,WAN Packet Entropy,WAN Packet Entropy Estimated Error,WAN Byte Entropy,WAN Byte Entropy Estimated Error,Overall Packet Entropy,Overall Packet Entropy Estimated Error,Overall Byte Entropy,Overall Byte Entropy Estimated Error\n"
         lines_to_write.append(header)
 
-        for path in paths: # iterate through each path
-            file_location = str(path) # turn into string 
-            file_name = os.path.basename(file_location).replace(".pcap","")
-
-            lan_flows = list()
-            wan_flows = list()
-            all_flows = list()
-
-            # Update progress bar
-            overall_progress.update(overall_task, description=f"Processing {file_name}")
-            file_task = file_progress.add_task("Counting TCP flows", total=inter_file_tasks)
+        # Flow lists for every file (and window), entropy is calculated over all of them in one go
+        row_labels = list()
+        flow_lists = list()
 
-            tcp_lan_flows, tcp_wan_flows, tcp_all_flows = count_tcp_flows(file_location)
+        # Each file is independent and nearly all the time is spent waiting on tshark,
+        # so files are handed to a pool of workers that each show their own progress bar
+        if args.sketch == None and not os.path.isdir(summary_dir):
+            os.makedirs(summary_dir)
 
-            file_progress.update(file_task, advance=1, description=f"Counting UDP flows")
-            udp_lan_flows, udp_wan_flows, udp_all_flows = count_udp_flows(file_location)
-
-            # Merge flows
-            lan_flows += tcp_lan_flows + udp_lan_flows
-            wan_flows += tcp_wan_flows + udp_wan_flows
-            all_flows += tcp_all_flows + udp_all_flows
-
-            # Now calculate the entropy
-            file_progress.update(file_task, advance=1, description=f"Calculating Entropy")
-            lan_entropy, wan_entropy, all_entropy = calculate_entropy(lan_flows, wan_flows, all_flows)
+        def run_file(file_location):
+            file_name = os.path.basename(file_location).replace(".pcap","")
+            file_task = file_progress.add_task(f"{file_name} - Reading packets", total=inter_file_tasks)
+            summary_location = flow_summary_location(file_location)
+            try:
+                if args.sketch != None:
+                    return sketch_capture_entropy(file_location, args.sketch, args.sketch_depth, file_name, file_progress, file_task)
+                return count_capture_flows(file_location, args.window, file_name, file_progress, file_task, summary_location)
+            finally:
+                file_progress.remove_task(file_task)
+                overall_progress.update(overall_task, advance=1)
+
+        overall_progress.update(overall_task, description=f"Processing ({args.jobs} at a time)")
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [executor.submit(run_file, str(path)) for path in paths]
+
+            # Results are collected in input order, not completion order, so the output matches a serial run
+            # A file that fails is reported and left out without losing anyone else's results
+            for path, future in zip(paths, futures):
+                file_location = str(path) # turn into string
+                try:
+                    file_rows = future.result()
+                except subprocess.CalledProcessError as e:
+                    print(f"ERROR: Could not count flows for {file_location} - tshark couldn't read it: {e.stderr}")
+                    continue
+                except Exception as e:
+                    print(f"ERROR: Could not count flows for {file_location} - {e}")
+                    continue
+
+                # Sketches already come back as estimates
+                file_name = os.path.basename(file_location).replace(".pcap","")
+                if args.sketch != None:
+                    values = [file_name]
+                    for scope_estimates in file_rows:
+                        for entropy, error in scope_estimates:
+                            values += [str(entropy), str(error)]
+                    lines_to_write.append(",".join(values) + "\n")
+                    continue
+
+                # Entropy is calculated for every file at once after they're all counted
+                for window_start, lan_flows, wan_flows, all_flows in file_rows:
+                    row_labels.append(file_name if window_start == None else f"{file_name},{window_start}")
+                    flow_lists += [lan_flows, wan_flows, all_flows]
+
+        # Now calculate the entropy, each file has a LAN, WAN and overall group
+        overall_progress.update(overall_task, description=f"Calculating Entropy")
+        entropies = calculate_entropy_for_flow_lists(flow_lists)
+
+        for i, row_label in enumerate(row_labels):
+            lan_entropy, wan_entropy, all_entropy = entropies[3 * i:3 * i + 3]
 
             # Add to output array
-            line_to_write = f"{file_name},{lan_entropy[0]},{lan_entropy[1]},{wan_entropy[0]},{wan_entropy[1]},{all_entropy[0]},{all_entropy[1]}\n"
+            line_to_write = f"{row_label},{lan_entropy[0]},{lan_entropy[1]},{wan_entropy[0]},{wan_entropy[1]},{all_entropy[0]},{all_entropy[1]}\n"
             lines_to_write.append(line_to_write)
 
-            file_progress.remove_task(file_task)
-            overall_progress.update(overall_task, advance=1)
-
-
         overall_progress.update(overall_task, description=f"Writing results")
         
         # Create output dir if it doesn't exist
@@ -97,16 +170,56 @@ def main(argv):
             os.makedirs("results")
 
         outfile_name = f"entropy.csv"
+        if args.window != None:
+            outfile_name = f"entropy-{args.window}s.csv"
+        elif args.sketch != None:
+            outfile_name = f"entropy-sketch.csv"
         outfile_location = os.path.join("results", outfile_name)
         with open(outfile_location, "w", newline='') as outfile: # open the csv  
             outfile.writelines(lines_to_write)
 
+# Combines the flows of several captures, e.g. every day of a deployment, into one and writes its entropy to results/entropy-<name>.csv
+# Only the summaries are read, so adding a capture to a combined result only costs reading that one capture
+def merge_flow_summaries(summary_locations, name):
+
+    flow_tables = list()
+    for summary_location in summary_locations:
+        try:
+            flow_tables.append(load_flow_summary(summary_location))
+        except (OSError, ValueError, KeyError) as e:
+            print(f"ERROR: Could not load flow summary {summary_location} - {e}")
+            return
+
+        # Every capture has some flows, an empty summary means its capture wasn't read properly
+        if len(flow_tables[-1]) == 0:
+            print(f"ERROR: Flow summary {summary_location} has no flows")
+            return
+
+    flow_table = combine_flow_counts(flow_tables)
+    _, lan_flows, wan_flows, all_flows = build_flow_lists(flow_table, None, 0)[0]
+    lan_entropy, wan_entropy, all_entropy = calculate_entropy(lan_flows, wan_flows, all_flows)
+
+    if not os.path.isdir("results"):
+        os.makedirs("results")
+
+    outfile_location = os.path.join("results", f"entropy-{name}.csv")
+    with open(outfile_location, "w", newline='') as outfile:
+        outfile.write("Filename,LAN Packet Entropy,LAN Byte Entropy,WAN Packet Entropy,WAN Byte Entropy,Overall Packet Entropy,Overall Byte Entropy\n")
+        outfile.write(f"{name},{lan_entropy[0]},{lan_entropy[1]},{wan_entropy[0]},{wan_entropy[1]},{all_entropy[0]},{all_entropy[1]}\n")
+
 def is_file(path):
     if os.path.isfile(path):
         return path
     else:
         raise argparse.ArgumentTypeError(f"{path} not found or isn't a file")
     
+def is_positive_int(value):
+    if value.isdigit() and int(value) > 0:
+        return int(value)
+    else:
+        raise argparse.ArgumentTypeError(f"{value} must be a positive integer")
+    
+
 def parse_cfg_csv(file_location):
 
     ret_list = list()
@@ -123,506 +236,394 @@ def parse_cfg_csv(file_location):
     return ret_list
     
 
-def count_tcp_flows(file_location):
+# Reads the capture once in chunks of packets, adding each chunk to a running flow table with exact byte counts
+# Memory only grows with the number of distinct flows, not the size of the capture
+# If given a summary location, the capture's flows are also saved there so it can be merged later without rereading it,
+# a capture tshark can't read all of raises CalledProcessError before anything is saved
+# Returns (window start, LAN flows, WAN flows, all flows) for each window from the start of the capture to its last packet,
+# or a single row with a window start of None when there are no windows
+def count_capture_flows(file_location, window_size=None, file_name=None, file_progress=None, file_task=None, summary_location=None):
+
+    flow_table, last_window = read_flow_table(file_location, window_size)
+
+    if file_progress != None:
+        file_progress.update(file_task, advance=1, description=f"{file_name} - Counting flows")
 
-    overall_ret_list = list()
-    lan_ret_list = list()
-    wan_ret_list = list()
+    if summary_location != None:
+        save_flow_summary(flow_table, summary_location)
 
-    # Process LAN and WAN seperately
-    tshark_command = ["tshark", "-qnr", file_location, "-z", f"conv,tcp,{lan_filter}", "-z", f"conv,tcp,{wan_filter}"]
-    command = subprocess.run(tshark_command, capture_output=True, text=True)
+    ret_list = build_flow_lists(flow_table, window_size, last_window)
 
-    if(command.returncode == 0):      
-        parsed_output = command.stdout
-        parsed_output = parsed_output.split('\n') 
+    if file_progress != None:
+        file_progress.update(file_task, advance=1)
 
-        # Trim header and footer
-        parsed_output = parsed_output[5:]
-        parsed_output = parsed_output[:-2]
+    return ret_list
 
-        # Need to iterate with indicies since we're splitting the list in two
-        for i in range(len(parsed_output)):
 
-            line = parsed_output[i]
+# Returns the capture's flow table and the index of its last window
+def read_flow_table(file_location, window_size):
 
-            # Look for footer of TCP section
-            if "====" in line:
-                
-                # The previous line is the last part of the TCP section
-                wan_lines = parsed_output[:i]
-                
-                # The next lines are header
-                lan_lines = parsed_output[i+6:]
+    partial_tables = list()
+    last_window = -1
 
-                break
+    for chunk in stream_packet_field_chunks(file_location, flow_fields, flow_chunk_rows):
+        chunk_table, chunk_last_window = count_flows_in_chunk(chunk, window_size)
+        partial_tables.append(chunk_table)
+        last_window = max(last_window, chunk_last_window)
 
-        # For TCP flows, we can count each line in the output as a distinct flow since these are connections
+        # Fold the partial tables together every so often so they don't pile up
+        if len(partial_tables) >= flow_fold_tables:
+            partial_tables = [combine_flow_counts(partial_tables)]
 
-        # Process WAN
-        for line in wan_lines:
-            tokens = line.split()
+    return combine_flow_counts(partial_tables), last_window
 
-            src_ip = tokens[0].rsplit(':', 1)[0]
-            dst_ip = tokens[2].rsplit(':', 1)[0]
 
-            # Skip if excluded
-            if src_ip in exclude_ips or dst_ip in exclude_ips:
-                continue
+# Turns a flow table into the flow lists entropy is calculated over, see count_capture_flows
+def build_flow_lists(flow_table, window_size, last_window):
 
-            packet_count = int(tokens[9])
-            byte_count = int(tokens[10].replace(',',''))
-            data_unit = tokens[11]
+    # This device's IPs are the ones found in every UDP address pair of the capture
+    udp_flows = flow_table[flow_table["proto"] == "udp"]
+    device_ips = find_device_ips(set(zip(udp_flows["ip_a"], udp_flows["ip_b"])))
+    udp_flows = udp_flows[~udp_flows["ip_a"].isin(exclude_ips) & ~udp_flows["ip_b"].isin(exclude_ips)]
 
-            if data_unit == "kB":
-                byte_count = byte_count * 1000
-            elif data_unit == "mB":
-                byte_count = byte_count * 1000 * 1000
+    # Windows without any flows are still reported so the rows line up with io,stat intervals
+    if window_size == None:
+        window_starts = [None]
+        last_window = 0
+    else:
+        window_starts = [x * window_size for x in range(last_window + 1)]
+
+    flow_lists = dict()
+    for window in range(last_window + 1):
+        for scope in ["LAN", "WAN"]:
+            flow_lists[(window, scope)] = list()
+
+    # For TCP flows, we can count each conversation as a distinct flow since these are connections
+    tcp_flows = flow_table[(flow_table["proto"] == "tcp") & ~flow_table["ip_a"].isin(exclude_ips) & ~flow_table["ip_b"].isin(exclude_ips)]
+    for window, scope, packet_count, byte_count in zip(tcp_flows["window"], tcp_flows["scope"], tcp_flows["packets"], tcp_flows["bytes"]):
+        flow_lists[(window, scope)].append((int(packet_count), int(byte_count)))
+
+    # For UDP flows, we treat each connection to the same IP as the same flow
+    # Note that this may not be entirely accurate as communication to the same
+    # endpoint may not be part of the same conversation but we assume for
+    # this case that the communication will likely be for the same purpose
+    udp_totals = dict()
+    for window, scope, ip_a, ip_b, packet_count, byte_count in zip(udp_flows["window"], udp_flows["scope"], udp_flows["ip_a"], udp_flows["ip_b"], udp_flows["packets"], udp_flows["bytes"]):
+
+        # Key to the remote end when we know which end is this device, otherwise key to both
+        if ip_a in device_ips:
+            key = ip_b
+        elif ip_b in device_ips:
+            key = ip_a
+        else:
+            key = (ip_a, ip_b)
 
-            wan_ret_list.append((packet_count, byte_count))
-            overall_ret_list.append((packet_count, byte_count))
+        udp_key = (window, scope, key)
+        if udp_key not in udp_totals:
+            udp_totals[udp_key] = (int(packet_count), int(byte_count))
+        else:
+            udp_totals[udp_key] = (udp_totals[udp_key][0] + int(packet_count), udp_totals[udp_key][1] + int(byte_count))
 
-        # Process LAN
-        for line in lan_lines:
-            tokens = line.split()
+    for (window, scope, key), flow in udp_totals.items():
+        flow_lists[(window, scope)].append(flow)
 
-            src_ip = tokens[0].rsplit(':', 1)[0]
-            dst_ip = tokens[2].rsplit(':', 1)[0]
+    ret_list = list()
+    for window, window_start in enumerate(window_starts):
+        lan_flows = flow_lists[(window, "LAN")]
+        wan_flows = flow_lists[(window, "WAN")]
+        ret_list.append((window_start, lan_flows, wan_flows, lan_flows + wan_flows))
 
-            # Skip if excluded
-            if src_ip in exclude_ips or dst_ip in exclude_ips:
-                continue
+    return ret_list
 
-            packet_count = int(tokens[9])
-            byte_count = int(tokens[10].replace(',',''))
-            data_unit = tokens[11]
 
-            if data_unit == "kB":
-                byte_count = byte_count * 1000
-            elif data_unit == "mB":
-                byte_count = byte_count * 1000 * 1000
+# Sums the packets and bytes of each flow in a chunk of exported packet fields
+# Both directions of a conversation are one flow, TCP flows are told apart by port while UDP flows are only keyed by address
+def count_flows_in_chunk(chunk, window_size):
 
-            lan_ret_list.append((packet_count, byte_count))
-            overall_ret_list.append((packet_count, byte_count))
+    src_ip = chunk["ip.src"].where(chunk["ip.src"] != "", chunk["ipv6.src"])
+    dst_ip = chunk["ip.dst"].where(chunk["ip.dst"] != "", chunk["ipv6.dst"])
 
-    return lan_ret_list, wan_ret_list, overall_ret_list
+    is_tcp = chunk["tcp.srcport"] != ""
+    is_udp = ~is_tcp & (chunk["udp.srcport"] != "")
+    src_port = chunk["tcp.srcport"].where(is_tcp, "")
+    dst_port = chunk["tcp.dstport"].where(is_tcp, "")
 
+    scopes = lan_classifier.classify_scopes(chunk["eth.dst.ig"], chunk["ip.src"], chunk["ip.dst"], chunk["ipv6.src"], chunk["ipv6.dst"])
 
-def count_udp_flows(file_location):
-
-    overall_ret_list = list()
-    lan_ret_list = list()
-    wan_ret_list = list()
-
-    # Process LAN and WAN seperately
-    tshark_command = ["tshark", "-qnr", file_location, "-z", f"conv,udp,{lan_filter}", "-z", f"conv,udp,{wan_filter}"]
-    command = subprocess.run(tshark_command, capture_output=True, text=True)
-
-    if(command.returncode == 0):      
-        parsed_output = command.stdout
-        parsed_output = parsed_output.split('\n') 
-
-        # Trim header and footer
-        parsed_output = parsed_output[5:]
-        parsed_output = parsed_output[:-2]
-
-        # Need to iterate with indicies since we're splitting the list in two
-        for i in range(len(parsed_output)):
-
-            line = parsed_output[i]
-
-            # Look for footer of UDP section
-            if "====" in line:
-                
-                # The previous line is the last part of the UDP section
-                wan_lines = parsed_output[:i]
-                
-                # The next lines are header
-                lan_lines = parsed_output[i+6:]
-
-                break
-
-        # For UDP flows, we treat each connection to the same IP as the same flow
-        # Note that this may not be entirely accurate as communication to the same
-        # endpoint may not be part of the same conversation but we assume for 
-        # this case that the communication will likely be for the same purpose
-
-        # We need to determine what this node's IP is. This is the only IP that exist in every flow
-        # All we have to do is check which IP is shared between multiple flows
-        possible_ips = list()
-        possible_ipv6s = list()
-        for line in wan_lines:
-            tokens = line.split()
-            src_ip = tokens[0].rsplit(':', 1)[0]
-            dst_ip = tokens[2].rsplit(':', 1)[0]
-
-            # IPv6
-            if(':' in src_ip):
-
-                # Only true if this is the first loop of ipv6
-                if len(possible_ipv6s) == 0:
-                    possible_ipv6s.append(src_ip)
-                    possible_ipv6s.append(dst_ip)
-                
-                else:
-                    for ip in possible_ipv6s:
-
-                        # If the IP was not found, it's not this device's IP
-                        if ip != src_ip and ip != dst_ip:
-                            possible_ipv6s.remove(ip)
-            # IPv4
-            else:
-
-                # Only true if this is the first loop
-                if len(possible_ips) == 0:
-                    possible_ips.append(src_ip)
-                    possible_ips.append(dst_ip)
-                
-                else:
-                    for ip in possible_ips:
-
-                        # If the IP was not found, it's not this device's IP
-                        if ip != src_ip and ip != dst_ip:
-                            possible_ips.remove(ip)
-
-            if len(possible_ipv6s) == 1 and len(possible_ips) == 1:
-                break
-
-
-        # This loop is only processed if there were < 2 results in the wan list
-        for line in lan_lines:
-            tokens = line.split()
-            src_ip = tokens[0].rsplit(':', 1)[0]
-            dst_ip = tokens[2].rsplit(':', 1)[0]
-
-            # IPv6
-            if(':' in src_ip):
-
-                # Only true if this is the first loop of ipv6
-                if len(possible_ipv6s) == 0:
-                    possible_ipv6s.append(src_ip)
-                    possible_ipv6s.append(dst_ip)
-                
-                else:
-                    for ip in possible_ipv6s:
-
-                        # If the IP was not found, it's not this device's IP
-                        if ip != src_ip and ip != dst_ip:
-                            possible_ipv6s.remove(ip)
-            # IPv4
-            else:
-
-                # Only true if this is the first loop
-                if len(possible_ips) == 0:
-                    possible_ips.append(src_ip)
-                    possible_ips.append(dst_ip)
-                
-                else:
-                    for ip in possible_ips:
-
-                        # If the IP was not found, it's not this device's IP
-                        if ip != src_ip and ip != dst_ip:
-                            possible_ips.remove(ip)
-
-            if len(possible_ipv6s) == 1 and len(possible_ips) == 1:
-                break
-
-        # If this is true, there was only one IP contacted via UDP, treat it as one flow
-        if len(possible_ipv6s) == 2:
-            one_v6_flow = True
-
-        elif len(possible_ipv6s) > 0:
-            this_v6_ip = possible_ipv6s[0]
-            one_v6_flow = False
-
-        # This is possible if a device uses multiple IPs for communication
-        # If this is the case, we have to key off of both IPs to identify flows
-        else:
-            this_v6_ip = None
-            one_v6_flow = False
+    # Put the ends of each flow in a fixed order so both directions land on the same key
+    swap = (src_ip > dst_ip) | ((src_ip == dst_ip) & (src_port > dst_port))
 
-        if len(possible_ips) == 2:
-            one_v4_flow = True
+    if window_size == None:
+        windows = np.zeros(len(chunk), dtype=np.int64)
+    else:
+        windows = (pd.to_numeric(chunk["frame.time_relative"], errors="coerce").fillna(0).to_numpy() // window_size).astype(np.int64)
 
-        elif len(possible_ips) > 0:
-            this_v4_ip = possible_ips[0]
-            one_v4_flow = False
+    flows = pd.DataFrame({
+        "window": windows,
+        "scope": scopes,
+        "proto": np.where(is_tcp, "tcp", "udp"),
+        "ip_a": src_ip.where(~swap, dst_ip),
+        "port_a": src_port.where(~swap, dst_port),
+        "ip_b": dst_ip.where(~swap, src_ip),
+        "port_b": dst_port.where(~swap, src_port),
+        "bytes": chunk["frame.len"].to_numpy()
+    })
 
-        # This is possible if a device uses multiple IPs for communication
-        # If this is the case, we have to key off of both IPs to identify flows
-        else:
-            this_v4_ip = None
-            one_v4_flow = False
-
-        # We're going to key each flow to remote_ip
-        udp_flows = dict()
-
-        # Process WAN
-        for line in wan_lines:
-            tokens = line.split()
-
-            src_ip = tokens[0].rsplit(':', 1)[0]
-            dst_ip = tokens[2].rsplit(':', 1)[0]
-
-            packet_count = int(tokens[9])
-            byte_count = int(tokens[10].replace(',',''))
-            data_unit = tokens[11]
-
-            if data_unit == "kB":
-                byte_count = byte_count * 1000
-            elif data_unit == "mB":
-                byte_count = byte_count * 1000 * 1000
-
-            # IPv6
-            if ':' in src_ip:
-
-                # If we have a multi-IP situation, we need to key off of both
-                if one_v6_flow == False and this_v6_ip == None:
-                    
-                    # We have two option for keys, we need to check both since UDP
-                    # may reverse paths in tshark
-                    key1 = src_ip + "-" + dst_ip
-                    key2 = dst_ip + "-" + src_ip
-
-                    # Check if we've used a key and use the same one
-                    if key1 in udp_flows:
-                        key = key1
-                    elif key2 in udp_flows:
-                        key = key2
-                    
-                    # Default to key1
-                    else:
-                        key = key1
-
-                # If only have one flow or the src is this device, key to the remote destination
-                elif one_v6_flow or src_ip == this_v6_ip:
-                    key = dst_ip
-
-                # Otherwise key to source
-                else:
-                    key = src_ip
-
-            # IPv4
-            else:
-
-                # If we have a multi-IP situation, we need to key off of both
-                if one_v4_flow == False and this_v4_ip == None:
-                    
-                    # We have two option for keys, we need to check both since UDP
-                    # may reverse paths in tshark
-                    key1 = src_ip + "-" + dst_ip
-                    key2 = dst_ip + "-" + src_ip
-
-                    # Check if we've used a key and use the same one
-                    if key1 in udp_flows:
-                        key = key1
-                    elif key2 in udp_flows:
-                        key = key2
-                    
-                    # Default to key1
-                    else:
-                        key = key1
-
-                # We only have one flow or the src is this device, key to the remote destination
-                if one_v4_flow or src_ip == this_v4_ip:
-                    key = dst_ip
-                else:
-                    key = src_ip    
-
-            # Skip if IP excluded
-            if key in exclude_ips:
-                continue
-
-            if not key in udp_flows:
-                udp_flows[key] = (packet_count, byte_count)
-            else:
-                udp_flows[key] = (udp_flows[key][0] + packet_count, udp_flows[key][1] + byte_count)
-
-        # Add final flows
-        wan_ret_list += udp_flows.values()
-        overall_ret_list += udp_flows.values()
-
-        # Clear dict
-        udp_flows = dict()
-
-        # Process WAN
-        for line in lan_lines:
-            tokens = line.split()
-
-            src_ip = tokens[0].rsplit(':', 1)[0]
-            dst_ip = tokens[2].rsplit(':', 1)[0]
-
-            packet_count = int(tokens[9])
-            byte_count = int(tokens[10].replace(',',''))
-            data_unit = tokens[11]
-
-            if data_unit == "kB":
-                byte_count = byte_count * 1000
-            elif data_unit == "mB":
-                byte_count = byte_count * 1000 * 1000
-
-            # IPv6
-            if ':' in src_ip:
-
-                # If we have a multi-IP situation, we need to key off of both
-                if one_v6_flow == False and this_v6_ip == None:
-                    
-                    # We have two option for keys, we need to check both since UDP
-                    # may reverse paths in tshark
-                    key1 = src_ip + "-" + dst_ip
-                    key2 = dst_ip + "-" + src_ip
-
-                    # Check if we've used a key and use the same one
-                    if key1 in udp_flows:
-                        key = key1
-                    elif key2 in udp_flows:
-                        key = key2
-                    
-                    # Default to key1
-                    else:
-                        key = key1
-
-                # If only have one flow or the src is this device, key to the remote destination
-                elif one_v6_flow or src_ip == this_v6_ip:
-                    key = dst_ip
-
-                # Otherwise key to source
-                else:
-                    key = src_ip
-
-            # IPv4
-            else:
-
-                # If we have a multi-IP situation, we need to key off of both
-                if one_v4_flow == False and this_v4_ip == None:
-                    
-                    # We have two option for keys, we need to check both since UDP
-                    # may reverse paths in tshark
-                    key1 = src_ip + "-" + dst_ip
-                    key2 = dst_ip + "-" + src_ip
-
-                    # Check if we've used a key and use the same one
-                    if key1 in udp_flows:
-                        key = key1
-                    elif key2 in udp_flows:
-                        key = key2
-                    
-                    # Default to key1
-                    else:
-                        key = key1
-
-                # We only have one flow or the src is this device, key to the remote destination
-                if one_v4_flow or src_ip == this_v4_ip:
-                    key = dst_ip
-                else:
-                    key = src_ip    
-
-            # Skip if IP excluded
-            if key in exclude_ips:
-                continue
-
-            # Skip if IP excluded
-            if key in exclude_ips:
-                continue
-
-            if not key in udp_flows:
-                udp_flows[key] = (packet_count, byte_count)
-            else:
-                udp_flows[key] = (udp_flows[key][0] + packet_count, udp_flows[key][1] + byte_count)
-
-        # Add final flows
-        lan_ret_list += udp_flows.values()
-        overall_ret_list += udp_flows.values()
-
-        return lan_ret_list, wan_ret_list, overall_ret_list
+    keep = (is_tcp | is_udp).to_numpy() & (src_ip != "").to_numpy() & (dst_ip != "").to_numpy() & (scopes != "")
+    flows = flows[keep]
+
+    counts = flows.groupby(flow_group_keys, sort=False).agg(packets=("bytes", "size"), bytes=("bytes", "sum")).reset_index()
+    last_window = int(windows.max()) if len(windows) > 0 else -1
+    return counts, last_window
+
+
+# Summaries are named after the capture plus a hash of its full path, so captures with the same file name in different
+# directories (e.g. US1/day1.pcap and FR/day1.pcap) each keep their own
+def flow_summary_location(file_location):
+
+    file_name = os.path.basename(file_location).replace(".pcap","")
+    path_hash = hashlib.sha256(os.path.abspath(file_location).encode()).hexdigest()[:12]
+    return os.path.join(summary_dir, f"{file_name}-{path_hash}-flows.npz")
+
+
+# Saves the capture's flows for the whole capture, whatever window size they were counted with, as a NumPy .npz file
+# Summaries of different captures can be merged by summing the packets and bytes of matching flows
+def save_flow_summary(flow_table, summary_location):
+
+    summary = flow_table.copy()
+    summary["window"] = 0
+    summary = combine_flow_counts([summary])
+
+    arrays = dict()
+    arrays["format_version"] = np.array(SUMMARY_FORMAT_VERSION)
+    for column in flow_group_keys[1:]:
+        arrays[column] = summary[column].to_numpy(dtype=str)
+    arrays["packets"] = summary["packets"].to_numpy(dtype=np.int64)
+    arrays["bytes"] = summary["bytes"].to_numpy(dtype=np.int64)
+
+    # Write then rename so a merge never reads a half written summary, every write gets its own temp file since workers share the process
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(summary_location), suffix=".tmp", delete=False) as outfile:
+        temp_location = outfile.name
+        np.savez_compressed(outfile, **arrays)
+    os.replace(temp_location, summary_location)
+
+
+# Loads a summary written by save_flow_summary back into a flow table
+def load_flow_summary(summary_location):
+
+    with np.load(summary_location, allow_pickle=False) as summary:
+        if int(summary["format_version"]) != SUMMARY_FORMAT_VERSION:
+            raise ValueError(f"{summary_location} is a version {int(summary['format_version'])} summary, expected version {SUMMARY_FORMAT_VERSION}")
+
+        flow_table = pd.DataFrame({column: summary[column].astype(object) for column in flow_group_keys[1:]})
+        flow_table.insert(0, "window", np.zeros(len(flow_table), dtype=np.int64))
+        flow_table["packets"] = summary["packets"]
+        flow_table["bytes"] = summary["bytes"]
+
+    return flow_table
+
+
+def combine_flow_counts(tables):
+
+    if len(tables) == 0:
+        return pd.DataFrame({x: pd.Series(dtype=object) for x in flow_group_keys} | {"packets": pd.Series(dtype=np.int64), "bytes": pd.Series(dtype=np.int64)})
+
+    counts = pd.concat(tables, ignore_index=True)
+    counts = counts.groupby(flow_group_keys, sort=False).agg(packets=("packets", "sum"), bytes=("bytes", "sum"))
+    return counts.reset_index()
+
+
+# Estimates entropy in a single pass with count-min sketches instead of exact flow tables, so memory stays fixed however long the capture is
+# Each packet adds to one counter in every row of the sketch, in the row's bucket for its flow
+# Returns ((packet entropy, estimated error), (byte entropy, estimated error)) for LAN, WAN and all flows, both are None without flows
+def sketch_capture_entropy(file_location, width, depth, file_name=None, file_progress=None, file_task=None):
+
+    sketch = new_flow_sketch(width, depth)
+
+    for chunk in stream_packet_field_chunks(file_location, flow_fields, flow_chunk_rows):
+        chunk_table, _ = count_flows_in_chunk(chunk, None)
+        update_flow_sketch(sketch, chunk_table)
+
+    if file_progress != None:
+        file_progress.update(file_task, advance=1, description=f"{file_name} - Estimating entropy")
+
+    _, saturated = estimate_counter_flows(sketch)
+    if saturated.any():
+        print(f"WARNING: {file_location} has more than {sketch_saturation_flows} flows in {int(saturated.sum())} sketch counters, "
+              f"its flows are undercounted and its estimates can't be relied on, use a wider --sketch")
+
+    ret_list = estimate_sketch_entropies(sketch)
+
+    if file_progress != None:
+        file_progress.update(file_task, advance=1)
+
+    return ret_list
+
+
+# Counters are kept per scope, LAN first then WAN
+# Every counter also has a bitmap of flows seen in it, used to estimate how many flows share the counter
+def new_flow_sketch(width, depth):
+
+    sketch = dict()
+    sketch["width"] = width
+    sketch["depth"] = depth
+    sketch["packets"] = np.zeros((2, depth, width), dtype=np.float64)
+    sketch["bytes"] = np.zeros((2, depth, width), dtype=np.float64)
+    sketch["flows_seen"] = np.zeros((2, depth, width * sketch_bitmap_bytes), dtype=np.uint8)
+    return sketch
+
+
+# Adds a table of flow counts (see count_flows_in_chunk) to the sketch
+# Flows are told apart and excluded the same way as the exact counting, except that UDP flows stay keyed by their address pair
+# since which address is this device isn't known until the whole capture is read
+def update_flow_sketch(sketch, flow_counts):
+
+    flow_counts = flow_counts[~flow_counts["ip_a"].isin(exclude_ips) & ~flow_counts["ip_b"].isin(exclude_ips)]
+    if len(flow_counts) == 0:
+        return
+
+    # Every flow is hashed once, then mixed with a different seed for each row's bucket and for its bitmap bit
+    flow_hashes = pd.util.hash_pandas_object(flow_counts[flow_group_keys[2:]], index=False).to_numpy()
+    bitmap_bits = (mix_hash(flow_hashes, sketch["depth"]) >> np.uint64(64 - sketch_bitmap_shift)).astype(np.int64)
+    bitmap_masks = np.left_shift(1, bitmap_bits % 8).astype(np.uint8)
+
+    packets = flow_counts["packets"].to_numpy(dtype=np.float64)
+    byte_counts = flow_counts["bytes"].to_numpy(dtype=np.float64)
+    width = np.uint64(sketch["width"])
+
+    for scope_index, scope in enumerate(["LAN", "WAN"]):
+        in_scope = (flow_counts["scope"] == scope).to_numpy()
+        if not in_scope.any():
+            continue
+
+        for row in range(sketch["depth"]):
+            buckets = (mix_hash(flow_hashes[in_scope], row) % width).astype(np.int64)
+            sketch["packets"][scope_index, row] += np.bincount(buckets, weights=packets[in_scope], minlength=sketch["width"])
+            sketch["bytes"][scope_index, row] += np.bincount(buckets, weights=byte_counts[in_scope], minlength=sketch["width"])
+            np.bitwise_or.at(sketch["flows_seen"][scope_index, row], buckets * sketch_bitmap_bytes + bitmap_bits[in_scope] // 8, bitmap_masks[in_scope])
+
+
+# SplitMix64 finalizer over hash + seed, so flows with different hashes get unrelated buckets in every row
+def mix_hash(hashes, seed):
+
+    mixed = hashes + np.uint64((seed + 1) * 0x9E3779B97F4A7C15 % 2 ** 64)
+    mixed = (mixed ^ (mixed >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    mixed = (mixed ^ (mixed >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return mixed ^ (mixed >> np.uint64(31))
+
+
+# Estimates how many flows share each counter by linear counting on its bitmap, a bitmap with a single bit set is one flow
+# A full bitmap can't tell how many more flows there are, those counters come back capped at sketch_saturation_flows and marked saturated
+def estimate_counter_flows(sketch):
+
+    bits_set = np.unpackbits(sketch["flows_seen"].reshape(2, sketch["depth"], sketch["width"], sketch_bitmap_bytes), axis=3).sum(axis=3)
+    flows_per_counter = -sketch_bitmap_bits * np.log1p(-np.minimum(bits_set, sketch_bitmap_bits - 1) / sketch_bitmap_bits)
+    flows_per_counter = np.maximum(bits_set, np.round(flows_per_counter))
+    return flows_per_counter, bits_set >= sketch_bitmap_bits - 1
+
+
+# Flows sharing a counter look like one flow, so the entropy of each row's counters is lower than the real entropy,
+# and it can be higher by at most the entropy hidden inside the counters, which is below lg(flows in the counter) for each one
+# None of this is a guaranteed bound: the flows in a counter, and so the hidden entropy and the flow count the entropy is
+# normalized by, are estimates, the upper side is the median of the rows' rather than the lowest to keep it steady,
+# and saturated counters (see estimate_counter_flows) undercount the flows, skewing both
+# The midpoint between the highest lower side and the upper side is reported with half the gap as its estimated error,
+# both normalized by the estimated flow count like the exact entropy
+def estimate_sketch_entropies(sketch):
+
+    flows_per_counter, _ = estimate_counter_flows(sketch)
+
+    ret_list = list()
+    for scope_indexes in ([0], [1], [0, 1]):
+
+        # LAN and WAN flows are always distinct, so all flows is both scopes' counters side by side
+        flow_counts = np.concatenate([flows_per_counter[x] for x in scope_indexes], axis=1)
+        flow_count = float(np.max(flow_counts.sum(axis=1)))
+        if flow_count == 0:
+            ret_list.append(((None, None), (None, None)))
+            continue
+
+        normalizer = np.log2(flow_count) if flow_count > 1 else 1.0
+
+        estimates = list()
+        for count_name in ["packets", "bytes"]:
+            counts = np.concatenate([sketch[count_name][x] for x in scope_indexes], axis=1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ratios = counts / counts.sum(axis=1, keepdims=True)
+                row_entropies = -np.sum(np.where(ratios > 0, ratios * np.log2(ratios), 0.0), axis=1)
+                hidden_entropies = np.sum(np.where(ratios > 0, ratios * np.log2(np.maximum(flow_counts, 1)), 0.0), axis=1)
+
+            lower = float(np.max(row_entropies))
+            upper = max(lower, float(np.median(row_entropies + hidden_entropies)))
+            estimates.append(((lower + upper) / 2 / normalizer, (upper - lower) / 2 / normalizer))
+
+        ret_list.append(tuple(estimates))
+
+    return ret_list
 
 
 def calculate_entropy(lan_flows, wan_flows, all_flows):
-    
-    log_base = 2
 
-    # LAN
-    if(len(lan_flows) > 0):
+    lan_entropy, wan_entropy, all_entropy = calculate_entropy_for_flow_lists([lan_flows, wan_flows, all_flows])
+    return lan_entropy, wan_entropy, all_entropy
 
-        # Get entropy
-        lan_pkt_entropy, lan_byte_entropy = calculate_entropy_from_flow_list(lan_flows, log_base)
 
-        # Normalize
-        lan_flow_count = len(lan_flows)
-        if lan_flow_count > 1:
-            lan_pkt_entropy = (lan_pkt_entropy / log(lan_flow_count, log_base))
-            lan_byte_entropy = (lan_byte_entropy / log(lan_flow_count, log_base))
-    
-    else:
-        lan_pkt_entropy = None
-        lan_byte_entropy = None
+# Takes any number of (packets, bytes) flow lists and returns a (packet entropy, byte entropy) tuple for each
+# Lists without flows get (None, None)
+def calculate_entropy_for_flow_lists(flow_lists):
 
-    # WAN
-    if(len(wan_flows) > 0):
+    # Pack every list into one pair of count arrays, list i covers offsets[i] up to offsets[i + 1]
+    offsets = np.zeros(len(flow_lists) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(x) for x in flow_lists])
 
-        # Get entropy
-        wan_pkt_entropy, wan_byte_entropy = calculate_entropy_from_flow_list(wan_flows, log_base)
+    flows = np.zeros((offsets[-1], 2), dtype=np.float64)
+    for i, flow_list in enumerate(flow_lists):
+        if len(flow_list) > 0:
+            flows[offsets[i]:offsets[i + 1]] = flow_list
 
-        # Normalize
-        wan_flow_count = len(wan_flows)
-        if wan_flow_count > 1:
-            wan_pkt_entropy = (wan_pkt_entropy / log(wan_flow_count, log_base))
-            wan_byte_entropy = (wan_byte_entropy / log(wan_flow_count, log_base))
-    
-    else:
-        wan_pkt_entropy = None
-        wan_byte_entropy = None
+    pkt_entropies, byte_entropies = calculate_segment_entropies(flows[:, 0], flows[:, 1], offsets)
 
-    # All
-    if(len(all_flows) > 0):
+    ret_list = list()
+    for i in range(len(flow_lists)):
+        if offsets[i + 1] > offsets[i]:
+            ret_list.append((float(pkt_entropies[i]), float(byte_entropies[i])))
+        else:
+            ret_list.append((None, None))
 
-        # Get entropy
-        all_pkt_entropy, all_byte_entropy = calculate_entropy_from_flow_list(all_flows, log_base)
+    return ret_list
 
-        # Normalize
-        all_flow_count = len(all_flows)
-        if all_flow_count > 1:
-            all_pkt_entropy = (all_pkt_entropy / log(all_flow_count, log_base))
-            all_byte_entropy = (all_byte_entropy / log(all_flow_count, log_base))
-    
-    else:
-        all_pkt_entropy = None
-        all_byte_entropy = None
 
-    return (lan_pkt_entropy, lan_byte_entropy), (wan_pkt_entropy, wan_byte_entropy), (all_pkt_entropy, all_byte_entropy)
+# Normalized packet and byte entropy for many groups of flows in one pass
+# Group i is made of the flows from offsets[i] up to offsets[i + 1]
+# Uses formula: Entropy = -sum((count_in_flow/total_count)*lg(count_in_flow/total_count)) across flows
+# normalized by lg(flow_count) when there's more than one flow, groups without flows come back as 0
+def calculate_segment_entropies(packet_counts, byte_counts, offsets, log_base=2):
 
+    offsets = np.asarray(offsets, dtype=np.int64)
+    flow_counts = np.diff(offsets)
+    group_count = len(flow_counts)
+    group_ids = np.repeat(np.arange(group_count), flow_counts)
 
-def calculate_entropy_from_flow_list(flows, log_base):
-    
-    pkt_entropy = 0
-    byte_entropy = 0
-
-    # Get total count first  
-    pkt_count = 0
-    byte_count = 0
-    for flow in flows:
-        pkt_count += flow[0]
-        byte_count += flow[1]
-
-    # Now process entropy
-    # Uses formula: Entropy = -sum((count_in_flow/total_count)*lg(count_in_flow/total_count)) across flows
-    for flow in flows:
-        pkt_in_flow = flow[0]
-        byte_in_flow = flow[1]
-        
-        pkt_ratio = pkt_in_flow / float(pkt_count)
-        byte_ratio = byte_in_flow / float(byte_count)
-        
-        pkt_inner_term = pkt_ratio * log(pkt_ratio, log_base)
-        byte_inner_term = byte_ratio * log(byte_ratio, log_base)
+    # The most entropy possible for each group's flow count, single flow groups are left as is
+    normalizers = np.ones(group_count, dtype=np.float64)
+    has_many_flows = flow_counts > 1
+    normalizers[has_many_flows] = np.log(flow_counts[has_many_flows]) / np.log(log_base)
+
+    entropies = list()
+    for counts in (packet_counts, byte_counts):
+        counts = np.asarray(counts, dtype=np.float64)
+
+        totals = np.bincount(group_ids, weights=counts, minlength=group_count)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratios = counts / totals[group_ids]
 
-        pkt_entropy += pkt_inner_term
-        byte_entropy += byte_inner_term
+            # An empty flow adds nothing rather than lg(0)
+            terms = np.where(ratios > 0, ratios * np.log(ratios) / np.log(log_base), 0.0)
 
-    pkt_entropy *= -1
-    byte_entropy *= -1
+        entropy = -np.bincount(group_ids, weights=terms, minlength=group_count)
+        entropies.append(entropy / normalizers)
 
-    return pkt_entropy, byte_entropy
+    return entropies[0], entropies[1]
 
 
 if __name__ == "__main__":
@@ -2,7 +2,7 @@ import pathlib
 import argparse
 import os
 import sys
-import csv
+import protocol_output
 
 def main(argv):
 
@@ -39,91 +39,86 @@ def main(argv):
         if os.path.isdir(file_location):
             continue
 
-        with open(file_location, newline='') as f:
-            reader = csv.reader(f)
-
-            network_type = "ALL"
-            if "-LAN" in file_name:
-                network_type = "LAN"
-            elif "-WAN" in file_name:
-                network_type = "WAN"
-
-            for row in reader:
-                if row[0] != 'MAC': # Skip header
-                    mac = row[0]
-
-                    # Initialize dicts
-                    if mac not in distribution_per_mac_dict:
-                        distribution_per_mac_dict[mac] = dict()
-                        distribution_per_mac_dict[mac]["ALL"] = dict()
-                        distribution_per_mac_dict[mac]["ALL"]["Discovery"] = 0
-                        distribution_per_mac_dict[mac]["ALL"]["Management"] = 0
-                        distribution_per_mac_dict[mac]["ALL"]["Encrypted"] = 0
-                        distribution_per_mac_dict[mac]["ALL"]["NonEncrypted"] = 0
-                        distribution_per_mac_dict[mac]["ALL"]["Unknown"] = 0 # Should be 0, used as a check
-                        distribution_per_mac_dict[mac]["LAN"] = dict()
-                        distribution_per_mac_dict[mac]["LAN"]["Discovery"] = 0
-                        distribution_per_mac_dict[mac]["LAN"]["Management"] = 0
-                        distribution_per_mac_dict[mac]["LAN"]["Encrypted"] = 0
-                        distribution_per_mac_dict[mac]["LAN"]["NonEncrypted"] = 0
-                        distribution_per_mac_dict[mac]["LAN"]["Unknown"] = 0 # Should be 0, used as a check
-                        distribution_per_mac_dict[mac]["WAN"] = dict()
-                        distribution_per_mac_dict[mac]["WAN"]["Discovery"] = 0
-                        distribution_per_mac_dict[mac]["WAN"]["Management"] = 0
-                        distribution_per_mac_dict[mac]["WAN"]["Encrypted"] = 0
-                        distribution_per_mac_dict[mac]["WAN"]["NonEncrypted"] = 0
-                        distribution_per_mac_dict[mac]["WAN"]["Unknown"] = 0 # Should be 0, used as a check
-                                        
-                    if mac not in unique_per_mac_dict:
-                        unique_per_mac_dict[mac] = dict()
-                        unique_per_mac_dict[mac]["ALL"] = dict()
-                        unique_per_mac_dict[mac]["WAN"] = dict()
-                        unique_per_mac_dict[mac]["LAN"] = dict()
-                        unique_per_mac_dict[mac]["ALL"]["Network"] = list()
-                        unique_per_mac_dict[mac]["ALL"]["Transport"] = list()
-                        unique_per_mac_dict[mac]["ALL"]["Session"] = list()
-                        unique_per_mac_dict[mac]["ALL"]["Application"] = list()
-                        unique_per_mac_dict[mac]["WAN"]["Network"] = list()
-                        unique_per_mac_dict[mac]["WAN"]["Transport"] = list()
-                        unique_per_mac_dict[mac]["WAN"]["Session"] = list()
-                        unique_per_mac_dict[mac]["WAN"]["Application"] = list()
-                        unique_per_mac_dict[mac]["LAN"]["Network"] = list()
-                        unique_per_mac_dict[mac]["LAN"]["Transport"] = list()
-                        unique_per_mac_dict[mac]["LAN"]["Session"] = list()
-                        unique_per_mac_dict[mac]["LAN"]["Application"] = list()
-
-                    # Check what type of protocol this is
-                    proto = row[2]
-                    proto_layer = "Application"
-                    if proto in layer_3_protos:
-                        proto_layer = "Network"
-                    elif proto in layer_4_protos:
-                        proto_layer = "Transport"
-                    elif proto in layer_5_protos:
-                        proto_layer = "Session"
-
-                    proto_type = "Unknown"
-                    if proto in discovery_protos:
-                        proto_type = "Discovery"
-                    elif proto in manage_protos:
-                        proto_type = "Management"
-                    elif proto in enc_protos:
-                        proto_type = "Encrypted"
-                    elif proto in unenc_protos:
-                        proto_type = "NonEncrypted"
-
-                    # Increase counts
-                    if proto_layer == "Application":
-                        packet_count = int(row[4])
-                        distribution_per_mac_dict[mac][network_type][proto_type] += packet_count
-
-                    # Save all application protos
-                    if proto_layer == "Application" and not proto in all_app_protos:
-                        all_app_protos.append(proto)
-
-                    # If unique, add to dict
-                    if proto not in unique_per_mac_dict[mac][network_type][proto_layer]:
-                        unique_per_mac_dict[mac][network_type][proto_layer].append(proto)
+        table = protocol_output.read_protocol_table(file_location)
+
+        network_type = "ALL"
+        if "-LAN" in file_name:
+            network_type = "LAN"
+        elif "-WAN" in file_name:
+            network_type = "WAN"
+
+        for mac, proto, packet_count in zip(table["MAC"], table["Protocol"], table["TotalPackets"]):
+
+            # Initialize dicts
+            if mac not in distribution_per_mac_dict:
+                distribution_per_mac_dict[mac] = dict()
+                distribution_per_mac_dict[mac]["ALL"] = dict()
+                distribution_per_mac_dict[mac]["ALL"]["Discovery"] = 0
+                distribution_per_mac_dict[mac]["ALL"]["Management"] = 0
+                distribution_per_mac_dict[mac]["ALL"]["Encrypted"] = 0
+                distribution_per_mac_dict[mac]["ALL"]["NonEncrypted"] = 0
+                distribution_per_mac_dict[mac]["ALL"]["Unknown"] = 0 # Should be 0, used as a check
+                distribution_per_mac_dict[mac]["LAN"] = dict()
+                distribution_per_mac_dict[mac]["LAN"]["Discovery"] = 0
+                distribution_per_mac_dict[mac]["LAN"]["Management"] = 0
+                distribution_per_mac_dict[mac]["LAN"]["Encrypted"] = 0
+                distribution_per_mac_dict[mac]["LAN"]["NonEncrypted"] = 0
+                distribution_per_mac_dict[mac]["LAN"]["Unknown"] = 0 # Should be 0, used as a check
+                distribution_per_mac_dict[mac]["WAN"] = dict()
+                distribution_per_mac_dict[mac]["WAN"]["Discovery"] = 0
+                distribution_per_mac_dict[mac]["WAN"]["Management"] = 0
+                distribution_per_mac_dict[mac]["WAN"]["Encrypted"] = 0
+                distribution_per_mac_dict[mac]["WAN"]["NonEncrypted"] = 0
+                distribution_per_mac_dict[mac]["WAN"]["Unknown"] = 0 # Should be 0, used as a check
+
+            if mac not in unique_per_mac_dict:
+                unique_per_mac_dict[mac] = dict()
+                unique_per_mac_dict[mac]["ALL"] = dict()
+                unique_per_mac_dict[mac]["WAN"] = dict()
+                unique_per_mac_dict[mac]["LAN"] = dict()
+                unique_per_mac_dict[mac]["ALL"]["Network"] = list()
+                unique_per_mac_dict[mac]["ALL"]["Transport"] = list()
+                unique_per_mac_dict[mac]["ALL"]["Session"] = list()
+                unique_per_mac_dict[mac]["ALL"]["Application"] = list()
+                unique_per_mac_dict[mac]["WAN"]["Network"] = list()
+                unique_per_mac_dict[mac]["WAN"]["Transport"] = list()
+                unique_per_mac_dict[mac]["WAN"]["Session"] = list()
+                unique_per_mac_dict[mac]["WAN"]["Application"] = list()
+                unique_per_mac_dict[mac]["LAN"]["Network"] = list()
+                unique_per_mac_dict[mac]["LAN"]["Transport"] = list()
+                unique_per_mac_dict[mac]["LAN"]["Session"] = list()
+                unique_per_mac_dict[mac]["LAN"]["Application"] = list()
+
+            # Check what type of protocol this is
+            proto_layer = "Application"
+            if proto in layer_3_protos:
+                proto_layer = "Network"
+            elif proto in layer_4_protos:
+                proto_layer = "Transport"
+            elif proto in layer_5_protos:
+                proto_layer = "Session"
+
+            proto_type = "Unknown"
+            if proto in discovery_protos:
+                proto_type = "Discovery"
+            elif proto in manage_protos:
+                proto_type = "Management"
+            elif proto in enc_protos:
+                proto_type = "Encrypted"
+            elif proto in unenc_protos:
+                proto_type = "NonEncrypted"
+
+            # Increase counts
+            if proto_layer == "Application":
+                distribution_per_mac_dict[mac][network_type][proto_type] += int(packet_count)
+
+            # Save all application protos
+            if proto_layer == "Application" and not proto in all_app_protos:
+                all_app_protos.append(proto)
+
+            # If unique, add to dict
+            if proto not in unique_per_mac_dict[mac][network_type][proto_layer]:
+                unique_per_mac_dict[mac][network_type][proto_layer].append(proto)
 
     all_app_protos.sort()
 
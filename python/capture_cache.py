@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import subprocess
+
+# How much of the start and end of a capture goes into its fingerprint
+# Hashing the whole file would cost as much as the tshark pass we're trying to skip
+FINGERPRINT_SAMPLE_BYTES = 1024 * 1024
+
+# Part of every key, bump it whenever the shape of a stored result changes so old entries are never misread
+FORMAT_VERSION = 2
+
+# Fingerprints and the tshark version don't change during a run, so only compute them once
+fingerprints = dict()
+tshark_version = None
+
+# Creates the settings used by load/store, returns None (caching disabled) if there's no directory
+def open_cache(cache_dir, max_megabytes):
+
+    if cache_dir == None:
+        return None
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    cache = dict()
+    cache["dir"] = cache_dir
+    cache["max_bytes"] = int(max_megabytes * 1024 * 1024)
+    return cache
+
+# Returns the stored result for this capture and query, or None if there isn't one
+def load(cache, pcap_file, query):
+
+    if cache == None:
+        return None
+
+    entry_location = os.path.join(cache["dir"], f"{make_key(pcap_file, query)}.json")
+    try:
+        with open(entry_location) as infile:
+            result = json.load(infile)
+    except (OSError, ValueError):
+        return None
+
+    # Touch the entry so eviction treats it as recently used
+    os.utime(entry_location)
+    return result
+
+# Stores a JSON serializable result for this capture and query, evicting the least recently used entries if needed
+def store(cache, pcap_file, query, result):
+
+    if cache == None:
+        return
+
+    entry_location = os.path.join(cache["dir"], f"{make_key(pcap_file, query)}.json")
+
+    # Write then rename so a reader never sees a half written entry
+    temp_location = f"{entry_location}.{os.getpid()}.tmp"
+    with open(temp_location, "w") as outfile:
+        json.dump(result, outfile)
+    os.replace(temp_location, entry_location)
+
+    evict(cache)
+
+# Removes the least recently used entries until the cache fits under its size cap
+def evict(cache):
+
+    entries = list()
+    total_bytes = 0
+    for file_name in os.listdir(cache["dir"]):
+        if not file_name.endswith(".json"):
+            continue
+
+        stats = os.stat(os.path.join(cache["dir"], file_name))
+        entries.append((stats.st_mtime, stats.st_size, file_name))
+        total_bytes += stats.st_size
+
+    entries.sort()
+    for mtime, size, file_name in entries:
+        if total_bytes <= cache["max_bytes"]:
+            break
+
+        try:
+            os.remove(os.path.join(cache["dir"], file_name))
+        except OSError:
+            pass
+        total_bytes -= size
+
+# Key for a query against a capture
+# Covers the result format, the capture contents, the tshark version that produced the result, and the query itself
+def make_key(pcap_file, query):
+
+    key_parts = [FORMAT_VERSION, fingerprint_capture(pcap_file), get_tshark_version(), query]
+    return hashlib.sha256(json.dumps(key_parts).encode()).hexdigest()
+
+# Identifies a capture by size, modification time, and a hash of its first and last bytes
+def fingerprint_capture(pcap_file):
+
+    stats = os.stat(pcap_file)
+    file_id = (os.path.abspath(pcap_file), stats.st_size, stats.st_mtime_ns)
+
+    if file_id not in fingerprints:
+        content_hash = hashlib.sha256()
+        with open(pcap_file, "rb") as infile:
+            content_hash.update(infile.read(FINGERPRINT_SAMPLE_BYTES))
+            if stats.st_size > FINGERPRINT_SAMPLE_BYTES:
+                infile.seek(max(FINGERPRINT_SAMPLE_BYTES, stats.st_size - FINGERPRINT_SAMPLE_BYTES))
+                content_hash.update(infile.read(FINGERPRINT_SAMPLE_BYTES))
+
+        fingerprints[file_id] = [stats.st_size, stats.st_mtime_ns, content_hash.hexdigest()]
+
+    return fingerprints[file_id]
+
+# Dissector changes between tshark versions can change results, so the version is part of every key
+def get_tshark_version():
+
+    global tshark_version
+
+    if tshark_version == None:
+        command = subprocess.run(["tshark", "--version"], capture_output=True, text=True)
+        tshark_version = command.stdout.split('\n')[0].strip()
+
+    return tshark_version
@@ -0,0 +1,72 @@
+# Finds the certificate that owns a hostname without trying every name of every certificate
+# A certificate name matches a hostname the hostname ends with, so names are kept in a trie keyed on their labels from the right:
+# every label but the leftmost must match the hostname's label exactly, and the leftmost only has to end the hostname's label
+# (example.com also matches notexample.com). Wildcards lose their star, so *.example.com leaves an empty leftmost label,
+# which ends any label and so matches the whole subtree of hostnames under example.com
+# Where several certificates match, the first one in cert_data wins
+
+# Builds the index over the certificates that have an owner
+# Each trie node is {"children": {label: node}, "names": {leftmost label: position in certs}}
+def build_cert_index(cert_data):
+
+    index = dict()
+    index["certs"] = list()
+    index["root"] = new_node()
+
+    for serial in cert_data:
+        cert = cert_data[serial]
+        if "orgName" not in cert:
+            continue
+
+        cert_number = len(index["certs"])
+        index["certs"].append(cert)
+
+        names_to_check = list()
+        if "commonName" in cert:
+            names_to_check.append(cert["commonName"])
+        if "altNames" in cert:
+            names_to_check.extend(cert["altNames"])
+
+        for name in names_to_check:
+
+            # Remove the star if this is a wildcarded name
+            if name.startswith("*"):
+                name = name[1:]
+
+            labels = name.split('.')
+            node = index["root"]
+            for label in reversed(labels[1:]):
+                node = node["children"].setdefault(label, new_node())
+
+            # An earlier certificate with the same name keeps it
+            node["names"].setdefault(labels[0], cert_number)
+
+    return index
+
+
+def new_node():
+    return {"children": dict(), "names": dict()}
+
+
+# Returns the first certificate with a name the hostname ends with, or None
+def find_cert(index, hostname):
+
+    best = None
+    node = index["root"]
+    for label in reversed(hostname.split('.')):
+
+        # Names ending here match if their leftmost label ends this label, the empty one (a wildcard) always does
+        names = node["names"]
+        if len(names) > 0:
+            for start in range(len(label) + 1):
+                cert_number = names.get(label[start:])
+                if cert_number != None and (best == None or cert_number < best):
+                    best = cert_number
+
+        node = node["children"].get(label)
+        if node == None:
+            break
+
+    if best == None:
+        return None
+    return index["certs"][best]
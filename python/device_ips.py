@@ -0,0 +1,52 @@
+# Works out which addresses belong to the device a capture was taken for
+# The device is part of every conversation it has, so its address is the one address of each IP family
+# that turns up in all of them. Each address is counted once and compared against the total, so this is linear in the input
+
+# Takes (ip, ip) pairs, one for each conversation, and returns the device's IPs
+# Both directions of a conversation are the same pair, and an IP family with a single pair has nothing to go on
+def find_device_ips(ip_pairs):
+
+    totals = {4: 0, 6: 0}
+    appearances = dict()
+    for pair in set(frozenset(x) for x in ip_pairs):
+        totals[address_family(next(iter(pair)))] += 1
+        for ip in pair:
+            appearances[ip] = appearances.get(ip, 0) + 1
+
+    return pick_device_ips(appearances, totals)
+
+
+# Takes endpoint table rows starting <ip>,<total_packets> and returns the device's IPs
+# Every packet has two endpoints, so the device's packets make up half of its family's packets in the table
+def find_device_ips_in_endpoints(endpoint_rows):
+
+    totals = {4: 0, 6: 0}
+    appearances = dict()
+    for row in endpoint_rows:
+        packets = int(row[1])
+        totals[address_family(row[0])] += packets
+        appearances[row[0]] = appearances.get(row[0], 0) + 2 * packets
+
+    return pick_device_ips(appearances, totals)
+
+
+# An address is the device's if it's in all of its family's conversations and it's the only one that is
+# Two addresses talking only to each other are both in everything, so then neither is picked
+def pick_device_ips(appearances, totals):
+
+    candidates = {4: list(), 6: list()}
+    for ip, count in appearances.items():
+        family = address_family(ip)
+        if totals[family] > 0 and count == totals[family]:
+            candidates[family].append(ip)
+
+    ret_set = set()
+    for family_candidates in candidates.values():
+        if len(family_candidates) == 1:
+            ret_set.add(family_candidates[0])
+
+    return ret_set
+
+
+def address_family(ip):
+    return 6 if ':' in ip else 4
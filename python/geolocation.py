@@ -0,0 +1,264 @@
+import csv
+import numpy as np
+import asn_table
+import lan_classifier
+
+# Offline IP geolocation from a local database, instead of tshark's MaxMind lookups (-Ng) which need extra reads of every capture
+# Either a MaxMind DB (.mmdb, e.g. GeoLite2-Country) or a range CSV of <start ip>,<end ip>,<country> rows (e.g. DB-IP's country lite,
+# IP2Location LITE DB1 with integer addresses)
+# Countries are numbered and kept in the same {version: (starts, ends, values)} interval table as asn_table, 0 is no country,
+# so looking up every WAN IP of a capture is one vectorized binary search per IP version
+
+KEY_BITS = asn_table.KEY_BITS
+
+# Loads the database, returns {"table": interval table, "countries": [None, country, ...]}
+def load_geolocation_db(file_location):
+
+    if file_location.endswith(".mmdb"):
+        return load_mmdb(file_location)
+    return load_range_csv(file_location)
+
+
+# Returns the country of each address, None where the database doesn't have one
+def lookup_countries(geo_db, addresses):
+
+    codes = asn_table.lookup_addresses(geo_db["table"], addresses)
+    return [geo_db["countries"][x] for x in codes]
+
+
+def new_country_codes():
+    return {"countries": [None], "codes": dict()}
+
+
+def country_code(country_codes, country):
+
+    if country not in country_codes["codes"]:
+        country_codes["codes"][country] = len(country_codes["countries"])
+        country_codes["countries"].append(country)
+    return country_codes["codes"][country]
+
+
+def load_range_csv(file_location):
+
+    ranges = {4: (list(), list(), list()), 6: (list(), list(), list())}
+    country_codes = new_country_codes()
+
+    with open(file_location, newline='', encoding="utf-8", errors="replace") as infile:
+        for row in csv.reader(infile):
+
+            # Header rows and anything else without two addresses and a country are skipped
+            if len(row) < 3 or row[2].strip() in ["", "-"]:
+                continue
+
+            start_version, start = range_key(row[0].strip())
+            end_version, end = range_key(row[1].strip())
+            if start_version == None or start_version != end_version:
+                continue
+
+            starts, ends, codes = ranges[start_version]
+            starts.append(start)
+            ends.append(end)
+            codes.append(country_code(country_codes, row[2].strip()))
+
+    table = dict()
+    for version in [4, 6]:
+        table[version] = build_ranges(*ranges[version], KEY_BITS[version])
+
+    return {"table": table, "countries": country_codes["countries"]}
+
+
+# Returns (version, key) for an address written out or as an integer, (None, 0) if it's neither
+def range_key(value):
+
+    if value.isdigit():
+        number = int(value)
+        if number < 2 ** 32:
+            return 4, number
+        return 6, number >> (128 - KEY_BITS[6])
+
+    return lan_classifier.address_key(value)
+
+
+# Sorts the ranges, anything overlapping an earlier range is dropped
+def build_ranges(starts, ends, codes, key_bits):
+
+    dtype = np.uint32 if key_bits == 32 else np.uint64
+    starts = np.asarray(starts, dtype=dtype)
+    ends = np.asarray(ends, dtype=dtype)
+    codes = np.asarray(codes, dtype=np.int64)
+
+    order = np.argsort(starts, kind="stable")
+    starts = starts[order]
+    ends = ends[order]
+    codes = codes[order]
+
+    if len(starts) > 1:
+        covered_to = np.maximum.accumulate(ends)
+        keep = np.concatenate([[True], starts[1:] > covered_to[:-1]])
+        starts = starts[keep]
+        ends = ends[keep]
+        codes = codes[keep]
+
+    return starts, ends, codes
+
+
+# MaxMind DB format: a binary search tree over the address bits, its leaves point into a data section of typed values
+# https://maxmind.github.io/MaxMind-DB/
+METADATA_MARKER = b"\xab\xcd\xefMaxMind.com"
+
+def load_mmdb(file_location):
+
+    with open(file_location, "rb") as infile:
+        buffer = infile.read()
+
+    metadata_start = buffer.rfind(METADATA_MARKER)
+    if metadata_start < 0:
+        raise ValueError(f"{file_location} is not a MaxMind DB")
+    metadata_start += len(METADATA_MARKER)
+    metadata, _ = decode_mmdb_value(buffer, metadata_start, metadata_start)
+
+    node_count = metadata["node_count"]
+    node_bytes = metadata["record_size"] * 2 // 8
+    data_start = node_count * node_bytes + 16
+
+    def read_node(node):
+        offset = node * node_bytes
+        record = buffer[offset:offset + node_bytes]
+        if node_bytes == 6:
+            return int.from_bytes(record[:3], "big"), int.from_bytes(record[3:], "big")
+        elif node_bytes == 7:
+            return ((record[3] & 0xf0) << 20) | int.from_bytes(record[:3], "big"), ((record[3] & 0x0f) << 24) | int.from_bytes(record[4:], "big")
+        return int.from_bytes(record[:4], "big"), int.from_bytes(record[4:], "big")
+
+    # IPv4 lives at ::/96 in an IPv6 tree, which also aliases it from ::ffff:0:0/96 and 2002::/16
+    ipv4_node = 0
+    if metadata["ip_version"] == 6:
+        for i in range(96):
+            if ipv4_node >= node_count:
+                break
+            ipv4_node = read_node(ipv4_node)[0]
+
+    country_codes = new_country_codes()
+    record_codes = dict()
+
+    def leaf_code(record):
+        if record not in record_codes:
+            value, _ = decode_mmdb_value(buffer, data_start + record - node_count - 16, data_start)
+            record_codes[record] = 0
+            country = mmdb_country(value)
+            if country != None:
+                record_codes[record] = country_code(country_codes, country)
+        return record_codes[record]
+
+    table = dict()
+    for version, root in [(4, ipv4_node), (6, 0)]:
+        key_bits = KEY_BITS[version]
+        keys = list()
+        lengths = list()
+        codes = list()
+
+        # Depth first over the tree, a record past the nodes is a leaf, exactly node_count is an empty one
+        # An IPv4 database has no IPv6 tree, and an IPv6 one may have nothing under ::/96
+        stack = [(root, 0, 0)]
+        if (version == 6 and metadata["ip_version"] != 6) or root >= node_count:
+            stack = list()
+        while len(stack) > 0:
+            node, bits, depth = stack.pop()
+            for bit, record in enumerate(read_node(node)):
+                path = (bits << 1) | bit
+                if record < node_count:
+                    # The IPv4 subtree is read on its own, not again under its IPv6 aliases
+                    if version == 6 and record == ipv4_node:
+                        continue
+                    stack.append((record, path, depth + 1))
+                elif record > node_count:
+                    code = leaf_code(record)
+                    if code != 0:
+                        # IPv6 is keyed on its upper bits, anything longer than the key is cut down to it
+                        length = depth + 1
+                        if length > key_bits:
+                            keys.append(path >> (length - key_bits))
+                            lengths.append(key_bits)
+                        else:
+                            keys.append(path << (key_bits - length))
+                            lengths.append(length)
+                        codes.append(code)
+
+        table[version] = asn_table.build_intervals(keys, lengths, codes, key_bits)
+
+    return {"table": table, "countries": country_codes["countries"]}
+
+
+# GeoIP2/GeoLite2 records give the country's names by language, fall back to the registered country and then the ISO code
+def mmdb_country(value):
+
+    if not isinstance(value, dict):
+        return None
+
+    for field in ["country", "registered_country"]:
+        country = value.get(field)
+        if isinstance(country, dict):
+            if "en" in country.get("names", dict()):
+                return country["names"]["en"]
+            if "iso_code" in country:
+                return country["iso_code"]
+
+    return None
+
+
+# Decodes the value at offset, returns it and the offset after it
+# Pointers are relative to section_start and don't move the offset past what they point at
+def decode_mmdb_value(buffer, offset, section_start):
+
+    control = buffer[offset]
+    offset += 1
+    value_type = control >> 5
+
+    if value_type == 1:
+        pointer_size = (control >> 3) & 0x3
+        pointer = control & 0x7
+        if pointer_size == 3:
+            pointer = 0
+        pointer = (pointer << (8 * (pointer_size + 1))) | int.from_bytes(buffer[offset:offset + pointer_size + 1], "big")
+        pointer += [0, 2048, 526336, 0][pointer_size]
+        value, _ = decode_mmdb_value(buffer, section_start + pointer, section_start)
+        return value, offset + pointer_size + 1
+
+    if value_type == 0:
+        value_type = 7 + buffer[offset]
+        offset += 1
+
+    size = control & 0x1f
+    if size >= 29:
+        extra_bytes = size - 28
+        size = [29, 285, 65821][extra_bytes - 1] + int.from_bytes(buffer[offset:offset + extra_bytes], "big")
+        offset += extra_bytes
+
+    if value_type == 2:
+        return buffer[offset:offset + size].decode("utf-8"), offset + size
+    elif value_type == 3:
+        return float(np.frombuffer(buffer[offset:offset + 8], dtype=">f8")[0]), offset + 8
+    elif value_type == 4:
+        return buffer[offset:offset + size], offset + size
+    elif value_type in [5, 6, 9, 10]:
+        return int.from_bytes(buffer[offset:offset + size], "big"), offset + size
+    elif value_type == 7:
+        value = dict()
+        for i in range(size):
+            key, offset = decode_mmdb_value(buffer, offset, section_start)
+            value[key], offset = decode_mmdb_value(buffer, offset, section_start)
+        return value, offset
+    elif value_type == 8:
+        return int.from_bytes(buffer[offset:offset + size], "big", signed=size == 4), offset + size
+    elif value_type == 11:
+        value = list()
+        for i in range(size):
+            item, offset = decode_mmdb_value(buffer, offset, section_start)
+            value.append(item)
+        return value, offset
+    elif value_type == 14:
+        return size != 0, offset
+    elif value_type == 15:
+        return float(np.frombuffer(buffer[offset:offset + 4], dtype=">f4")[0]), offset + 4
+
+    raise ValueError(f"Unknown MaxMind DB type {value_type} at {offset}")
@@ -0,0 +1,76 @@
+import subprocess
+import tempfile
+import lan_classifier
+
+# Everything parse_endpoints learns about remote IPs from the capture itself, read in one tshark pass
+# Each piece of evidence comes out tagged (tag, ip, value) in capture order:
+SNI = "sni"                     # Server name a client asked the IP for in a TLS client hello
+X509_NAME = "x509_name"         # First dNSName of a certificate the IP sent
+DNS_ANSWER = "dns_answer"       # Name a captured DNS A/AAAA answer gave for the IP
+CERT_COUNTRY = "cert_country"   # Countries in a certificate the IP sent, joined with ';'
+
+EVIDENCE_TAGS = [SNI, X509_NAME, DNS_ANSWER, CERT_COUNTRY]
+
+evidence_fields = ["ip.src", "ip.dst", "ipv6.src", "ipv6.dst", "tls.handshake.type", "tls.handshake.extensions_server_name", "x509ce.dNSName", "x509sat.CountryName", "dns.a", "dns.aaaa", "dns.qry.name"]
+
+# Repeated fields are joined with ';', the separator Cert Geolocation uses between countries
+AGGREGATOR = ';'
+
+# Yields the tagged evidence of a capture, only the TLS handshakes and DNS answers are exported
+def stream_evidence(pcap_file):
+
+    display_filter = f"((tls.handshake.type == 1 || tls.handshake.certificate) && {lan_classifier.wan_filter}) || dns.a || dns.aaaa"
+    tshark_command = ["tshark", "-nr", pcap_file, f"-Y{display_filter}", "-T", "fields", "-E", f"aggregator={AGGREGATOR}"]
+    for field in evidence_fields:
+        tshark_command += ["-e", field]
+
+    # stderr goes to a file so a chatty tshark can't block on a full pipe
+    with tempfile.TemporaryFile(mode="w+") as error_file:
+        process = subprocess.Popen(tshark_command, stdout=subprocess.PIPE, stderr=error_file, text=True)
+
+        for line in process.stdout:
+            row = line.rstrip('\n').split('\t')
+            if len(row) == len(evidence_fields):
+                yield from parse_evidence_row(row)
+
+        process.wait()
+        if process.returncode != 0:
+            error_file.seek(0)
+            print(f"ERROR: Cannot read hostname evidence from {pcap_file} - {error_file.read()}")
+
+
+# Reads the whole stream into {tag: [(ip, value), ...]} so each resolver can go over its own evidence in capture order
+def collect_evidence(pcap_file):
+
+    evidence = {x: list() for x in EVIDENCE_TAGS}
+    for tag, ip, value in stream_evidence(pcap_file):
+        evidence[tag].append((ip, value))
+
+    return evidence
+
+
+def parse_evidence_row(row):
+
+    # Tunnelled or ICMP error packets repeat the IP header, the outer one comes first
+    src = first_value(row[0]) or first_value(row[2])
+    dst = first_value(row[1]) or first_value(row[3])
+    handshake_types = row[4].split(AGGREGATOR)
+
+    if "1" in handshake_types and row[5] != "" and dst != "":
+        yield SNI, dst, first_value(row[5])
+
+    if row[6] != "" and src != "":
+        yield X509_NAME, src, first_value(row[6])
+
+    if row[7] != "" and src != "":
+        yield CERT_COUNTRY, src, row[7]
+
+    name = first_value(row[10])
+    if name != "":
+        for ip in row[8].split(AGGREGATOR) + row[9].split(AGGREGATOR):
+            if ip != "":
+                yield DNS_ANSWER, ip, name
+
+
+def first_value(field):
+    return field.split(AGGREGATOR)[0]
@@ -0,0 +1,171 @@
+import argparse
+import bisect
+import socket
+import sys
+from ipaddress import ip_network
+
+# Site prefixes, a packet is LAN if it's sent to a group MAC or both of its addresses are local
+# Destinations also count as local when they're IPv6 multicast or link-local
+local_src_prefixes = ["10.0.0.0/8", "172.16.0.0/12", "192.168.0.0/16", "2620:0:5300::/44", "fdc4:22e1:d500::/32"]
+local_dst_prefixes = local_src_prefixes + ["ff00::/8", "fe80::/10"]
+
+# IPv6 addresses are compared on their upper 64 bits so they fit in a NumPy integer
+# Every site prefix is /64 or shorter, so this loses nothing
+IPV6_KEY_BITS = 64
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description="Prints the tshark display filter for LAN or WAN traffic, built from the same prefixes the Python scripts classify with")
+    parser.add_argument('scope', choices=["lan", "wan"], help="Which filter to print")
+    args = parser.parse_args()
+
+    if args.scope == "lan":
+        print(lan_filter)
+    else:
+        print(wan_filter)
+
+
+# Builds "(ip.src == a || ipv6.src == b ...)" for one direction
+def build_prefix_filter(prefixes, direction):
+    parts = list()
+    for prefix in prefixes:
+        field = "ipv6" if ':' in prefix else "ip"
+        parts.append(f"{field}.{direction} == {prefix}")
+
+    return "(" + " || ".join(parts) + ")"
+
+
+# Sorts the prefixes into disjoint [start, end] intervals for each IP version
+# Like tshark, host bits in the prefixes are masked off
+def compile_prefixes(prefixes):
+
+    intervals = {4: list(), 6: list()}
+    for prefix in prefixes:
+        network = ip_network(prefix, strict=False)
+        if network.version == 4:
+            intervals[4].append((int(network.network_address), int(network.broadcast_address)))
+        else:
+            shift = 128 - IPV6_KEY_BITS
+            intervals[6].append((int(network.network_address) >> shift, int(network.broadcast_address) >> shift))
+
+    table = dict()
+    for version, version_intervals in intervals.items():
+
+        # Merge overlapping or touching ranges so a single search finds the only candidate
+        merged = list()
+        for start, end in sorted(version_intervals):
+            if len(merged) > 0 and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+
+        # Plain lists so printing a filter from the command line doesn't load NumPy, the bulk functions convert them
+        table[version] = ([x[0] for x in merged], [x[1] for x in merged])
+
+    return table
+
+
+lan_filter = f"(eth.dst.ig == 1 || ({build_prefix_filter(local_src_prefixes, 'src')} && {build_prefix_filter(local_dst_prefixes, 'dst')}))"
+wan_filter = f"(eth.dst.ig == 0 && !({build_prefix_filter(local_src_prefixes, 'src')} && {build_prefix_filter(local_dst_prefixes, 'dst')}))"
+
+local_src_table = compile_prefixes(local_src_prefixes)
+local_dst_table = compile_prefixes(local_dst_prefixes)
+
+
+# Returns (version, key) for an address string, version is None for anything that isn't an address (e.g. "")
+def address_key(address):
+
+    try:
+        if ':' in address:
+            return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, address)[:IPV6_KEY_BITS // 8], "big")
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, address), "big")
+    except (OSError, TypeError):
+        return None, 0
+
+
+def is_local_address(address, table):
+
+    version, key = address_key(address)
+    if version == None:
+        return False
+
+    starts, ends = table[version]
+    i = bisect.bisect_right(starts, key) - 1
+    return i >= 0 and key <= ends[i]
+
+
+# Vectorized is_local_address over an array of address strings
+def local_address_mask(addresses, table):
+
+    import numpy as np
+    import pandas as pd
+
+    # Addresses repeat constantly, so only parse each distinct one
+    codes, uniques = pd.factorize(np.asarray(addresses, dtype=object))
+
+    versions = np.zeros(len(uniques), dtype=np.int8)
+    keys = {4: np.zeros(len(uniques), dtype=np.uint32), 6: np.zeros(len(uniques), dtype=np.uint64)}
+    for i, address in enumerate(uniques):
+        version, key = address_key(address)
+        if version != None:
+            versions[i] = version
+            keys[version][i] = key
+
+    # Find the last interval starting at or before each key, then check the key is inside it
+    unique_is_local = np.zeros(len(uniques), dtype=bool)
+    for version in [4, 6]:
+        starts, ends = table[version]
+        if len(starts) == 0:
+            continue
+
+        dtype = np.uint32 if version == 4 else np.uint64
+        starts = np.asarray(starts, dtype=dtype)
+        ends = np.asarray(ends, dtype=dtype)
+
+        version_keys = keys[version]
+        candidates = np.searchsorted(starts, version_keys, side="right") - 1
+        in_interval = (candidates >= 0) & (version_keys <= ends[np.maximum(candidates, 0)])
+        unique_is_local |= (versions == version) & in_interval
+
+    # pd.factorize marks missing values with -1
+    return np.where(codes >= 0, unique_is_local[np.maximum(codes, 0)], False)
+
+
+# Mirrors lan_filter and wan_filter, tshark may print booleans as 1/0 or True/False depending on version
+# Returns "LAN", "WAN", or None for packets that are neither (e.g. no Ethernet header)
+def classify_scope(eth_dst_ig, ip_src, ip_dst, ipv6_src, ipv6_dst):
+
+    is_group = eth_dst_ig in ("1", "True")
+    is_individual = eth_dst_ig in ("0", "False")
+
+    src_is_local = is_local_address(ip_src, local_src_table) or is_local_address(ipv6_src, local_src_table)
+    dst_is_local = is_local_address(ip_dst, local_dst_table) or is_local_address(ipv6_dst, local_dst_table)
+
+    if is_group or (src_is_local and dst_is_local):
+        return "LAN"
+    elif is_individual:
+        return "WAN"
+    else:
+        return None
+
+
+# Vectorized classify_scope over columns of packet fields, "" marks packets that are neither LAN nor WAN
+def classify_scopes(eth_dst_ig, ip_src, ip_dst, ipv6_src, ipv6_dst):
+
+    import numpy as np
+    import pandas as pd
+
+    src_is_local = local_address_mask(ip_src, local_src_table) | local_address_mask(ipv6_src, local_src_table)
+    dst_is_local = local_address_mask(ip_dst, local_dst_table) | local_address_mask(ipv6_dst, local_dst_table)
+
+    eth_dst_ig = pd.Series(np.asarray(eth_dst_ig, dtype=object))
+    is_group = eth_dst_ig.isin(["1", "True"]).to_numpy()
+    is_individual = eth_dst_ig.isin(["0", "False"]).to_numpy()
+
+    is_lan = is_group | (src_is_local & dst_is_local)
+    is_wan = ~is_lan & is_individual
+    return np.where(is_lan, "LAN", np.where(is_wan, "WAN", ""))
+
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
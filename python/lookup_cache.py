@@ -0,0 +1,107 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Bump whenever the shape of a stored value changes, older databases are cleared when opened
+FORMAT_VERSION = 1
+
+# Creates the cache settings and opens (or creates) the database, returns None (caching disabled) if there's no location
+# Answers are kept for ttl_days, failed or empty lookups for negative_ttl_hours so they're tried again sooner
+# In offline mode lookups that aren't cached are skipped instead of going to the network
+def open_cache(cache_location, max_megabytes, ttl_days, negative_ttl_hours, offline=False):
+
+    if cache_location == None:
+        return None
+
+    cache_dir = os.path.dirname(cache_location)
+    if cache_dir != "" and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Lookups run on a pool of threads, so the connection is shared behind a lock
+    connection = sqlite3.connect(cache_location, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    if connection.execute("PRAGMA user_version").fetchone()[0] != FORMAT_VERSION:
+        connection.execute("DROP TABLE IF EXISTS lookups")
+        connection.execute(f"PRAGMA user_version={FORMAT_VERSION}")
+    connection.execute("CREATE TABLE IF NOT EXISTS lookups (kind TEXT, key TEXT, value TEXT, stored REAL, last_used REAL, PRIMARY KEY (kind, key))")
+    connection.commit()
+
+    cache = dict()
+    cache["connection"] = connection
+    cache["lock"] = threading.Lock()
+    cache["max_bytes"] = int(max_megabytes * 1024 * 1024)
+    cache["ttl"] = ttl_days * 24 * 60 * 60
+    cache["negative_ttl"] = negative_ttl_hours * 60 * 60
+    cache["offline"] = offline
+    return cache
+
+# Trims the cache to its size cap and closes it
+def close_cache(cache):
+
+    if cache == None:
+        return
+
+    evict(cache)
+    with cache["lock"]:
+        cache["connection"].close()
+
+# Returns (found, value) for a lookup, value is None for a cached failure
+# Entries past their TTL are not found
+def load(cache, kind, key):
+
+    if cache == None:
+        return False, None
+
+    now = time.time()
+    with cache["lock"]:
+        row = cache["connection"].execute("SELECT value, stored FROM lookups WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+        if row == None:
+            return False, None
+
+        value, stored = row
+        ttl = cache["ttl"] if value != None else cache["negative_ttl"]
+        if stored + ttl < now:
+            return False, None
+
+        # Touch the entry so eviction treats it as recently used
+        cache["connection"].execute("UPDATE lookups SET last_used = ? WHERE kind = ? AND key = ?", (now, kind, key))
+        cache["connection"].commit()
+
+    if value == None:
+        return True, None
+    return True, json.loads(value)
+
+# Stores a JSON serializable lookup result, None stores a failure
+def store(cache, kind, key, value):
+
+    if cache == None:
+        return
+
+    now = time.time()
+    value = None if value == None else json.dumps(value)
+    with cache["lock"]:
+        cache["connection"].execute("INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?, ?)", (kind, key, value, now, now))
+        cache["connection"].commit()
+
+# Drops expired entries, then the least recently used ones until the stored keys and values fit under the size cap
+def evict(cache):
+
+    now = time.time()
+    with cache["lock"]:
+        connection = cache["connection"]
+        connection.execute("DELETE FROM lookups WHERE (value IS NOT NULL AND stored + ? < ?) OR (value IS NULL AND stored + ? < ?)", (cache["ttl"], now, cache["negative_ttl"], now))
+
+        entries = connection.execute("SELECT rowid, length(kind) + length(key) + ifnull(length(value), 0) FROM lookups ORDER BY last_used").fetchall()
+        total_bytes = sum(x[1] for x in entries)
+
+        evicted = list()
+        for rowid, size in entries:
+            if total_bytes <= cache["max_bytes"]:
+                break
+            evicted.append((rowid,))
+            total_bytes -= size
+
+        connection.executemany("DELETE FROM lookups WHERE rowid = ?", evicted)
+        connection.commit()
@@ -4,29 +4,77 @@ import argparse
 import os
 from ipaddress import ip_address
 import sys
-import whois
 import csv
-from cymruwhois import Client
-from dns import resolver,reversename
+from concurrent.futures import as_completed
 from rich.progress import Progress
 from rich.progress import Group
 from rich.live import Live
 from rich.progress import TextColumn
 from rich.progress import BarColumn
 from rich.progress import TaskProgressColumn
+import asn_table
+import cert_index
 import extract_certs
+import geolocation
+import hostname_evidence
+import lan_classifier
+import lookup_cache
+import ptr_resolver
+import whois_resolver
 
 # We only need to resolve names for remote IPs, don't worry about local/broadcast/multicast IPs
-lan_filter = "(eth.dst.ig == 1 || ((ip.src == 10.0.0.0/8 || ip.src == 172.16.0.0/12 || ip.src == 192.168.0.0/16 || ipv6.src == 2620:0:5300::/44 || ipv6.src == fdc4:22e1:d500::/32) && (ip.dst == 10.0.0.0/8 || ip.dst == 172.16.0.0/12 || ip.dst == 192.168.0.0/16 || ipv6.dst == ff00::/8 || ipv6.dst == fe80::/10 ||  ipv6.dst == 2620:0:5300::/44 || ipv6.dst == fdc4:22e1:d500::/32)))"
-wan_filter = "(eth.dst.ig == 0 && !((ip.src == 10.0.0.0/8 || ip.src == 172.16.0.0/12 || ip.src == 192.168.0.0/16 || ipv6.src == 2620:0:5300::/44 || ipv6.src == fdc4:22e1:d500::/32) && (ip.dst == 10.0.0.0/8 || ip.dst == 172.16.0.0/12 || ip.dst == 192.168.0.0/16 || ipv6.dst == ff00::/8 || ipv6.dst == fe80::/10 ||  ipv6.dst == 2620:0:5300::/44 || ipv6.dst == fdc4:22e1:d500::/32)))"
+lan_filter = lan_classifier.lan_filter
+wan_filter = lan_classifier.wan_filter
 
 def main(argv):
 
     parser = argparse.ArgumentParser()
     parser.add_argument('input_csv', type=is_file, help="A CSV containing paths to pcap files to analyze")
+    parser.add_argument('--whois-jobs', type=is_positive_int, default=16, help="The number of WHOIS/ASN queries that may run at once")
+    parser.add_argument('--whois-rate', type=is_positive_float, default=2.0, help="The most queries per second sent to any one WHOIS server")
+    parser.add_argument('--whois-timeout', type=is_positive_float, default=10.0, help="Seconds to wait on a WHOIS server before giving up on a query")
+    parser.add_argument('--whois-retries', type=is_non_negative_int, default=2, help="How many times a failed WHOIS query is tried again")
+    parser.add_argument('--whois-server', type=is_server, default=None, metavar="HOST:PORT", help="Send every WHOIS query to this server instead of the one for each domain, e.g. a local stub server")
+    parser.add_argument('--asn-server', type=is_server, default=whois_resolver.ASN_SERVER, metavar="HOST:PORT", help="The Team Cymru style bulk WHOIS server used for ASN lookups")
+    parser.add_argument('--lookup-cache', default=os.path.join("cache", "lookups.sqlite"), help="SQLite database WHOIS, ASN and reverse DNS answers are kept in between runs")
+    parser.add_argument('--lookup-cache-size', type=is_positive_int, default=256, help="The size in MB the lookup cache is trimmed to, least recently used entries go first")
+    parser.add_argument('--lookup-ttl', type=is_positive_float, default=30, metavar="DAYS", help="How long a cached answer is used before it's looked up again")
+    parser.add_argument('--lookup-negative-ttl', type=is_positive_float, default=24, metavar="HOURS", help="How long a lookup that failed or found nothing is remembered before it's tried again")
+    parser.add_argument('--no-lookup-cache', action="store_true", help="Always look everything up over the network")
+    parser.add_argument('--offline', action="store_true", help="Only use answers from the lookup cache, anything not cached is left unresolved")
+    parser.add_argument('--dns-jobs', type=is_positive_int, default=256, help="The number of reverse DNS queries that may be in flight at once")
+    parser.add_argument('--dns-timeout', type=is_positive_float, default=2.0, help="Seconds to wait on a reverse DNS query before giving up on it")
+    parser.add_argument('--dns-server', type=is_server, default=None, metavar="HOST:PORT", help="Send reverse DNS queries to this server instead of the system's resolvers, e.g. a local stub server")
+    parser.add_argument('--geo-db', type=is_file, default=None, metavar="MMDB_OR_CSV", help="Geolocate WAN IPs with this MaxMind DB (.mmdb) or <start ip>,<end ip>,<country> range CSV, e.g. GeoLite2-Country.mmdb or DB-IP's country lite CSV")
+    parser.add_argument('--asn-table', type=is_file, default=None, metavar="PFX2AS", help="Look ASNs up offline in a routeviews prefix to AS dump (e.g. CAIDA's pfx2as) instead of asking the ASN server")
+    parser.add_argument('--as-names', type=is_file, default=None, help="AS names for --asn-table in the format of RIPE's asn.txt, without it owners are given as AS numbers")
     args = parser.parse_args()
     paths = parse_cfg_csv(args.input_csv)
 
+    if args.offline and args.no_lookup_cache:
+        parser.error("--offline needs the lookup cache")
+    if args.as_names != None and args.asn_table == None:
+        parser.error("--as-names needs --asn-table")
+
+    lookup_cache_location = None if args.no_lookup_cache else args.lookup_cache
+    cache = lookup_cache.open_cache(lookup_cache_location, args.lookup_cache_size, args.lookup_ttl, args.lookup_negative_ttl, args.offline)
+
+    # Shared by every file, so an IP or hostname seen in an earlier capture isn't looked up again
+    resolver = whois_resolver.open_resolver(args.whois_jobs, args.whois_rate, args.whois_timeout, args.whois_retries, args.whois_server, args.asn_server, cache)
+
+    dns_resolver = ptr_resolver.open_resolver(args.dns_jobs, args.dns_timeout, args.dns_server, cache)
+
+    geo_db = None
+    if args.geo_db != None:
+        geo_db = geolocation.load_geolocation_db(args.geo_db)
+
+    prefix_table = None
+    as_names = None
+    if args.asn_table != None:
+        prefix_table = asn_table.load_prefix_table(args.asn_table)
+    if args.as_names != None:
+        as_names = asn_table.load_as_names(args.as_names)
+
     # Setup interactive environment for nice statusing
     overall_progress = Progress(
         TextColumn("[blue][progress.description]{task.description}"),
@@ -51,7 +99,7 @@ def main(argv):
     
     group = Group(overall_progress, file_progress, task_progress)
     file_count = len(list(paths))
-    inter_file_tasks = 11 # We just statically update this progress
+    inter_file_tasks = 12 # We just statically update this progress
 
     with Live(group):
         overall_task = overall_progress.add_task("Processing", total=file_count)
@@ -67,26 +115,31 @@ def main(argv):
             # First fetch list of all IPs including metrics
             lan_ip_data, wan_ip_data = fetch_ip_list(file_location)
 
-            # Now try to geolocate using MaxMind's database configured in tshark
+            # SNIs, certificate names and countries, and DNS answers all come out of one read of the capture
+            file_progress.update(file_task, advance=1, description=f"Extracting hostname evidence from capture")
+            evidence = hostname_evidence.collect_evidence(file_location)
+
+            # Now try to geolocate using the local geolocation database
             file_progress.update(file_task, advance=1, description=f"Resolving IP geolocation")
-            #wan_ip_data = resolve_ip_geolocation(file_location, wan_ip_data)
+            if geo_db != None:
+                wan_ip_data = resolve_ip_geolocation(wan_ip_data, geo_db)
           
             # Next try to geolocate the certificate using the x509 extensions
             file_progress.update(file_task, advance=1, description=f"Resolving Cert geolocation")
-            #wan_ip_data = resolve_cert_geolocation(file_location, wan_ip_data)
+            wan_ip_data = resolve_cert_geolocation(evidence, wan_ip_data)
 
             # Then try to resolve name
             file_progress.update(file_task, advance=1, description=f"Resolving hostnames with SNIs")
-            wan_ip_data = resolve_with_SNIs(file_location, wan_ip_data)
+            wan_ip_data = resolve_with_SNIs(evidence, wan_ip_data)
 
             file_progress.update(file_task, advance=1, description=f"Resolving hostnames with x509 certs")
-            wan_ip_data = resolve_with_x509(file_location, wan_ip_data)
+            wan_ip_data = resolve_with_x509(evidence, wan_ip_data)
 
             file_progress.update(file_task, advance=1, description=f"Resolving hostnames with captured DNS queries")
-            wan_ip_data = resolve_with_captured_dns(file_location, wan_ip_data)
+            wan_ip_data = resolve_with_captured_dns(evidence, wan_ip_data)
 
             file_progress.update(file_task, advance=1, description=f"Resolving hostnames with current DNS queries")
-            wan_ip_data = resolve_with_post_processing_dns(wan_ip_data)
+            wan_ip_data = resolve_with_post_processing_dns(wan_ip_data, dns_resolver)
 
             # Extract certificate data for owner lookup
             file_progress.update(file_task, advance=1, description=f"Extracting certification information from capture")
@@ -97,7 +150,7 @@ def main(argv):
 
             # Lookup whois information based on name if possible, otherwise look based on IP
             file_progress.update(file_task, advance=1, description=f"Resolving owning entites with WHOIS and ASN lookups")
-            wan_ip_data = resolve_owner_with_whois_and_asn(wan_ip_data, task_progress)
+            wan_ip_data = resolve_owner_with_whois_and_asn(wan_ip_data, task_progress, resolver, prefix_table, as_names)
 
             file_progress.update(file_task, advance=1, description=f"Writing results")
             # Create output dir if it doesn't exist
@@ -127,6 +180,9 @@ def main(argv):
 
             file_progress.remove_task(file_task)
             overall_progress.update(overall_task, advance=1)
+
+    whois_resolver.close_resolver(resolver)
+    lookup_cache.close_cache(cache)
         
 
 def is_file(path):
@@ -134,6 +190,34 @@ def is_file(path):
         return path
     else:
         raise argparse.ArgumentTypeError(f"{path} not found or isn't a file")
+
+def is_positive_int(value):
+    if value.isdigit() and int(value) > 0:
+        return int(value)
+    else:
+        raise argparse.ArgumentTypeError(f"{value} must be a positive integer")
+
+def is_non_negative_int(value):
+    if value.isdigit():
+        return int(value)
+    else:
+        raise argparse.ArgumentTypeError(f"{value} must be 0 or a positive integer")
+
+def is_positive_float(value):
+    try:
+        if float(value) > 0:
+            return float(value)
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(f"{value} must be a positive number")
+
+# Parses HOST:PORT, the host may be an IPv6 address
+def is_server(value):
+    host, _, port = value.rpartition(':')
+    if host != "" and port.isdigit():
+        return (host.strip("[]"), int(port))
+    else:
+        raise argparse.ArgumentTypeError(f"{value} must be HOST:PORT")
     
 def parse_cfg_csv(file_location):
 
@@ -308,303 +392,200 @@ def sort_ips(s):
         return (1, s)
     return (0, ip)
 
-def resolve_ip_geolocation(file_location, ip_data):
-    
-    # Run command to fetch geolocation mapping for src IPs
-    tshark_command = ["tshark", "-Ng", "-r", file_location, f"-Y{wan_filter}", "-Tfields", "-eip.src", "-eip.geoip.src_country"]
-    command = subprocess.run(tshark_command, capture_output=True, text=True)
-    
-    if(command.returncode != 0): 
-        return ip_data
-        
-    parsed_output = command.stdout
-    parsed_output = parsed_output.split('\n') 
-
-    # Now process data
-    for line in parsed_output:
-        tokens = line.split()
-
-        # Country can be multiple words
-        if len(tokens) >= 2:
-            ip = tokens[0]
-            country = " ".join(tokens[1:])
-
-            if ip in ip_data:
-                ip_data[ip]["IP Geolocation"] = country
-
-    # Repeat for dst IPs
-    tshark_command = ["tshark", "-Ng", "-r", file_location, f"-Y{wan_filter}", "-Tfields", "-eip.dst", "-eip.geoip.dst_country"]
-    command = subprocess.run(tshark_command, capture_output=True, text=True)
-    
-    if(command.returncode != 0): 
-        return ip_data
-        
-    parsed_output = command.stdout
-    parsed_output = parsed_output.split('\n') 
+# Every IP is looked up in the database at once, see geolocation
+def resolve_ip_geolocation(ip_data, geo_db):
 
-    # Now process data
-    for line in parsed_output:
-        tokens = line.split()
-
-        # Country can be multiple words
-        if len(tokens) >= 2:
-            ip = tokens[0]
-            country = " ".join(tokens[1:])
-
-            if ip in ip_data:
-                ip_data[ip]["IP Geolocation"] = country
+    ips = list(ip_data.keys())
+    for ip, country in zip(ips, geolocation.lookup_countries(geo_db, ips)):
+        if country != None:
+            ip_data[ip]["IP Geolocation"] = country
 
     return ip_data
 
-def resolve_cert_geolocation(file_location, ip_data):
-    
-    # Run command to fetch geolocation mapping for src IPs
-    tshark_command = ["tshark", "-nr", file_location, f"-Y{wan_filter}", "-Tfields", "-eip.src", "-ex509sat.CountryName"]
-    command = subprocess.run(tshark_command, capture_output=True, text=True)
-    
-    if(command.returncode != 0): 
-        return ip_data
-        
-    parsed_output = command.stdout
-    parsed_output = parsed_output.split('\n') 
-
-    # Now process data
-    for line in parsed_output:
-        tokens = line.split()
-
-        if len(tokens) == 2:
-            ip = tokens[0]
-            country_list = tokens[1].split(',')
-            country_string = ';'.join(country_list)
+def resolve_cert_geolocation(evidence, ip_data):
 
-            if ip in ip_data:
-                ip_data[ip]["Cert Geolocation"] = country_string
+    for ip, country_string in evidence[hostname_evidence.CERT_COUNTRY]:
+        if ip in ip_data:
+            ip_data[ip]["Cert Geolocation"] = country_string
 
     return ip_data
 
-def resolve_with_SNIs(file_location, ip_data):
-
-    # Run command to fetch SNI mapping
-    tshark_command = ["tshark", "-nr", file_location, f"-Ytls.handshake.type == 1 && {wan_filter}", "-Tfields", "-eip.dst", "-etls.handshake.extensions_server_name"]
-    command = subprocess.run(tshark_command, capture_output=True, text=True)
-    
-    if(command.returncode != 0): 
-        return ip_data
-        
-    parsed_output = command.stdout
-    parsed_output = parsed_output.split('\n') 
+def resolve_with_SNIs(evidence, ip_data):
 
-    # Now process data
-    for line in parsed_output:
-        tokens = line.split()
-
-        if len(tokens) == 2:
-            ip = tokens[0]
-            hostname = tokens[1]
-
-            if ip in ip_data:
-                # Remove trailing dot if it exists
-                if hostname.endswith('.'):
-                    hostname = hostname[:-1]
-                ip_data[ip]["Hostname"] = hostname
+    for ip, hostname in evidence[hostname_evidence.SNI]:
+        if ip in ip_data:
+            # Remove trailing dot if it exists
+            if hostname.endswith('.'):
+                hostname = hostname[:-1]
+            ip_data[ip]["Hostname"] = hostname
 
     return ip_data
 
-def resolve_with_x509(file_location, ip_data):
+def resolve_with_x509(evidence, ip_data):
 
-    # Run command to fetch cert mapping
-    tshark_command = ["tshark", "-qnr", file_location, f"-Ytls.handshake.certificate && {wan_filter}", "-Tfields", "-eip.src", "-ex509ce.dNSName"]
-    command = subprocess.run(tshark_command, capture_output=True, text=True)
-    
-    if(command.returncode != 0): 
-        return ip_data
-        
-    parsed_output = command.stdout
-    parsed_output = parsed_output.split('\n') 
+    for ip, hostname in evidence[hostname_evidence.X509_NAME]:
+        if ip in ip_data and ip_data[ip]["Hostname"] == None:
+            # Remove trailing dot if it exists
+            if hostname.endswith('.'):
+                hostname = hostname[:-1]
+            ip_data[ip]["Hostname"] = hostname
 
-    # Now process data
-    for line in parsed_output:
-        tokens = line.split()
+    return ip_data
 
-        if len(tokens) == 2:
-            ip = tokens[0]
-            hostname = tokens[1].split(',')[0]
+def resolve_with_captured_dns(evidence, ip_data):
 
-            if ip in ip_data and ip_data[ip]["Hostname"] == None:
-                # Remove trailing dot if it exists
-                if hostname.endswith('.'):
-                    hostname = hostname[:-1]
-                ip_data[ip]["Hostname"] = hostname
+    for ip, hostname in evidence[hostname_evidence.DNS_ANSWER]:
+        if ip in ip_data and ip_data[ip]["Hostname"] == None:
+            # Remove trailing dot if it exists
+            if hostname.endswith('.'):
+                hostname = hostname[:-1]
+            ip_data[ip]["Hostname"] = hostname
 
     return ip_data
 
-def resolve_with_captured_dns(file_location, ip_data):
-
-    # Run command to fetch cert mapping
-    tshark_command = ["tshark", "-Ndn", "-qr", file_location, "-Ydns.resp.type == A", "-Tfields", "-edns.a", "-edns.qry.name"]
-    command = subprocess.run(tshark_command, capture_output=True, text=True)
-    
-    if(command.returncode != 0): 
-        return ip_data
-        
-    parsed_output = command.stdout
-    parsed_output = parsed_output.split('\n') 
-
-    # Now process data
-    for line in parsed_output:
-        tokens = line.split()
+# Every IP still without a hostname is looked up at once, see ptr_resolver
+def resolve_with_post_processing_dns(ip_data, dns_resolver=None):
 
-        if len(tokens) == 2:
-            ip_list = tokens[0].split(',')
-            hostname = tokens[1]
+    if dns_resolver == None:
+        dns_resolver = ptr_resolver.open_resolver()
 
-            for ip in ip_list:
-                if ip in ip_data and ip_data[ip]["Hostname"] == None:
-                    # Remove trailing dot if it exists
-                    if hostname.endswith('.'):
-                        hostname = hostname[:-1]
-                    ip_data[ip]["Hostname"] = hostname
+    ips = [ip for ip in ip_data.keys() if ip_data[ip]["Hostname"] == None]
+    for ip, name in ptr_resolver.lookup_ptrs(dns_resolver, ips).items():
+        if name != None:
+            ip_data[ip]["Hostname"] = name
 
     return ip_data
-    
-def resolve_with_post_processing_dns(ip_data):
 
-    for ip in ip_data.keys():
-        if ip_data[ip]["Hostname"] == None:
-            try:
-                # Try to query the DNS server
-                addr = reversename.from_address(ip)
-                name = str(resolver.resolve(addr,"PTR")[0])
-                
-                # Remove trailing dot if it exists
-                if hostname.endswith('.'):
-                    hostname = hostname[:-1]
-                ip_data[ip]["Hostname"] = name
-            except:
-                continue
+# Certificates are indexed by name once per capture, so each hostname is a walk over its own labels, see cert_index
+def resolve_owner_with_cert_information(ip_data, cert_data):
 
-    return ip_data
+    index = cert_index.build_cert_index(cert_data)
 
-def resolve_owner_with_cert_information(ip_data, cert_data):
-    
     for ip in ip_data.keys():
         if ip_data[ip]["Hostname"] != None:
-            hostname = ip_data[ip]["Hostname"]
-
-            # We only care about certs that contain owner information for this
-            for serial in cert_data:
-                if "orgName" in cert_data[serial]:
-                    orgName = cert_data[serial]["orgName"]
-
-                    # Check if either the common names or the alt names match the current hostname
-                    cert = cert_data[serial]
-                    names_to_check = list()
-
-                    if "commonName" in cert:
-                        names_to_check.append(cert["commonName"])
+            cert = cert_index.find_cert(index, ip_data[ip]["Hostname"])
 
-                    if "altNames" in cert:
-                        names_to_check.extend(cert["altNames"])
-
-                    for name in names_to_check:
-
-                        # Remove the star if this is a wildcarded name
-                        if name.startswith("*"):
-                            name = name[1:]
-
-                        # Found owner
-                        if hostname.endswith(name):
-                            ip_data[ip]["Cert Owner"] = orgName
-                            if "countryName" in cert:
-                                ip_data[ip]["Cert Location"] = cert["countryName"]
-                            break
-
-                # Stop if we've already found the owner
-                if ip_data[ip]["Cert Owner"] != None:
-                    break
+            # Found owner
+            if cert != None:
+                ip_data[ip]["Cert Owner"] = cert["orgName"]
+                if "countryName" in cert:
+                    ip_data[ip]["Cert Location"] = cert["countryName"]
 
     return ip_data
 
 
-def resolve_owner_with_whois_and_asn(ip_data, rich_progress=None):
-    
-    asn_client = Client()
-    hostname_whois = dict() # We use this to prevent executing multiple queries for the same hostname
+# WHOIS lookups run concurrently, first by hostname then by IP for those that found no owner, while the ASN lookups run alongside them
+# With a prefix table the ASNs are looked up in it instead of on the ASN server
+def resolve_owner_with_whois_and_asn(ip_data, rich_progress=None, resolver=None, prefix_table=None, as_names=None):
+
+    if resolver == None:
+        resolver = whois_resolver.open_resolver()
 
     # Setup progress bar
     if rich_progress != None:
         task_count = len(ip_data)
         resolve_task = rich_progress.add_task(f"Attempting to resolve with WHOIS/ASN", total=task_count)
 
+    # Queries on the same hostname will have the same result, so each hostname is only looked up once
+    asn_futures = list()
+    if prefix_table == None:
+        asn_futures = whois_resolver.lookup_asns(resolver, ip_data.keys())
+    hostname_futures = dict()
+    for ip, data in ip_data.items():
+        if data["Hostname"] != None:
+            hostname_futures[ip] = whois_resolver.lookup_hostname(resolver, data["Hostname"])
+
+    # If we haven't found it (or skipped hostname) try via IP
+    # IPs with a hostname are submitted as soon as their hostname lookup comes back empty, whichever finishes first,
+    # so one slow hostname doesn't hold up the IP lookups behind it
+    ip_futures = dict()
+    ips_by_hostname_future = dict()
+    for ip in ip_data.keys():
+        if ip in hostname_futures:
+            ips_by_hostname_future.setdefault(hostname_futures[ip], list()).append(ip)
+        else:
+            ip_futures[ip] = whois_resolver.lookup_ip(resolver, ip)
+
+    for future in as_completed(ips_by_hostname_future):
+        if get_lookup_result(future, (None, None))[0] == None:
+            for ip in ips_by_hostname_future[future]:
+                ip_futures[ip] = whois_resolver.lookup_ip(resolver, ip)
+
+    hostname_whois = dict()
     for ip, data in ip_data.items():
 
         if rich_progress != None:
             rich_progress.update(resolve_task, description=f"Attempting to resolve \"{ip}\" with WHOIS/ASN")
-        
+
         # Try hostname first, if that doesn't work, revert to IP
         owner = None
         location = None
-        hostname = None
-        if data["Hostname"] != None:
-            hostname = data["Hostname"]
-
+        hostname = data["Hostname"]
+        if hostname != None:
             if hostname in hostname_whois:
-                owner = hostname_whois[hostname][0]
-                location = hostname_whois[hostname][1]
+                owner, location = hostname_whois[hostname]
             else:
-                # Perform whois query and look for the org
-                try:
-                    result = whois.whois(hostname)
-                    if "org" in result:
-                        owner = result["org"]
-                    if "country" in result:
-                        location = result["country"]
-                except:
-                    pass
-
-                # Queries on the same hostname will have the same result 
-                hostname_whois[hostname] = (owner, location)
+                owner, location = get_lookup_result(hostname_futures[ip], (None, None))
 
-        # If we haven't found it (or skipped hostname) try via IP
         if owner == None:
-            try:
-                result = whois.whois(ip)
-                if "org" in result:
-                    owner = result["org"]
-                if "country" in result:
-                    location = result["country"]
-
-                # A result on a different IP for the same hostname may resolve
-                # even if this one doesn't, so we only store for hostname if we were successful
-                if hostname != None:
-                    hostname_whois[hostname] = (owner, location)
-            except:
-                    pass
-            
+            ip_owner, ip_location = get_lookup_result(ip_futures[ip], (None, None))
+            if ip_owner != None:
+                owner = ip_owner
+            if ip_location != None:
+                location = ip_location
+
+            # A result on a different IP for the same hostname may resolve
+            # even if this one doesn't, so we only store for hostname if we were successful
+            if hostname != None and owner != None:
+                hostname_whois[hostname] = (owner, location)
+
         if owner != None:
             ip_data[ip]["WHOIS Owner"] = owner
             ip_data[ip]["WHOIS Location"] = location
 
-        # Now resolve with ASN
-
-        try:
-            result = asn_client.lookup(ip) # This looks like a whois lookup by the import, but does return ASN information
-            owner = result.owner
-            location = result.cc
+        if rich_progress != None:
+            rich_progress.update(resolve_task, advance=1)
 
+    # Now resolve with ASN
+    for future in asn_futures:
+        for ip, (owner, location) in get_lookup_result(future, dict()).items():
             if owner != None:
                 ip_data[ip]["ASN Owner"] = owner
                 ip_data[ip]["ASN Location"] = location
-        except:
-                pass
-        
-        if rich_progress != None:
-            rich_progress.update(resolve_task, advance=1)
+
+    if prefix_table != None:
+        ip_data = resolve_owner_with_asn_table(ip_data, prefix_table, as_names)
 
     if rich_progress != None:
         rich_progress.remove_task(resolve_task)        
     return ip_data
 
 
+# Every IP is looked up in the prefix table at once, an AS without a name is given as AS<number>
+def resolve_owner_with_asn_table(ip_data, prefix_table, as_names):
+
+    if as_names == None:
+        as_names = dict()
+
+    ips = list(ip_data.keys())
+    for ip, asn in zip(ips, asn_table.lookup_addresses(prefix_table, ips)):
+        if asn == 0:
+            continue
+
+        owner, location = as_names.get(int(asn), (f"AS{asn}", None))
+        ip_data[ip]["ASN Owner"] = owner
+        ip_data[ip]["ASN Location"] = location
+
+    return ip_data
+
+
+# A lookup that failed (no answer after its retries, or an answer that couldn't be parsed) counts as not found
+def get_lookup_result(future, default):
+    try:
+        return future.result()
+    except Exception:
+        return default
+
+
 if __name__ == "__main__":
    main(sys.argv[1:])
\ No newline at end of file
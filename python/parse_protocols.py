@@ -4,7 +4,13 @@ import argparse
 import os
 import sys
 import csv
+import socket
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from ipaddress import ip_address
+import numpy as np
+import pandas as pd
 from rich.progress import Progress
 from rich.progress import Group
 from rich.live import Live
@@ -12,6 +18,10 @@ from rich.progress import TextColumn
 from rich.progress import BarColumn
 from rich.progress import TaskProgressColumn
 from rich.progress import TimeRemainingColumn
+import capture_cache
+import lan_classifier
+import protocol_output
+from device_ips import find_device_ips_in_endpoints
 
 layer_3_protos = ["ip", "ipv6"]
 layer_4_protos = ["tcp", "udp"]
@@ -20,15 +30,33 @@ layer_7_protos = ["http", "https", "ssdp", "mdns", "ntp", "tplink-smarthome", "m
 
 known_udp_ports = ["udp:1982","udp:50000","udp:5355","udp:6667","udp:10101", "udp:1111","udp:56700","udp:58866","udp:8555","udp:9478","udp:9700","udp:55444"]
 
-lan_filter = "(eth.dst.ig == 1 || ((ip.src == 10.0.0.0/8 || ip.src == 172.16.0.0/12 || ip.src == 192.168.0.0/16 || ipv6.src == 2620:0:5300::/44 || ipv6.src == fdc4:22e1:d500::/32) && (ip.dst == 10.0.0.0/8 || ip.dst == 172.16.0.0/12 || ip.dst == 192.168.0.0/16 || ipv6.dst == ff00::/8 || ipv6.dst == fe80::/10 ||  ipv6.dst == 2620:0:5300::/44 || ipv6.dst == fdc4:22e1:d500::/32)))"
-wan_filter = "(eth.dst.ig == 0 && !((ip.src == 10.0.0.0/8 || ip.src == 172.16.0.0/12 || ip.src == 192.168.0.0/16 || ipv6.src == 2620:0:5300::/44 || ipv6.src == fdc4:22e1:d500::/32) && (ip.dst == 10.0.0.0/8 || ip.dst == 172.16.0.0/12 || ip.dst == 192.168.0.0/16 || ipv6.dst == ff00::/8 || ipv6.dst == fe80::/10 ||  ipv6.dst == 2620:0:5300::/44 || ipv6.dst == fdc4:22e1:d500::/32)))"
+# Shared with the other scripts so every one of them agrees on what LAN and WAN mean
+lan_filter = lan_classifier.lan_filter
+wan_filter = lan_classifier.wan_filter
+
+# Fields exported for every packet by the single pass engine, in column order
+packet_fields = ["frame.len", "eth.src", "eth.dst", "eth.dst.ig", "ip.src", "ip.dst", "ipv6.src", "ipv6.dst", "tcp.srcport", "tcp.dstport", "udp.srcport", "udp.dstport", "frame.protocols"]
+
+# The columnar backend parses the field export this many packets at a time
+columnar_chunk_rows = 250000
+endpoint_group_keys = ["ip_type", "mac", "scope", "proto", "ip"]
 
 def main(argv):
 
     parser = argparse.ArgumentParser()
     parser.add_argument('input_csv', type=is_file, help="A CSV mapping pcap files to MACs to analyze")
+    parser.add_argument('--backend', choices=["single-pass", "columnar", "endpoints"], default="single-pass", help="single-pass reads each capture once for all MACs and protocols, columnar does the same with grouped reductions over NumPy/pandas columns, endpoints runs batched tshark endpoint taps per MAC")
+    parser.add_argument('--jobs', type=is_positive_int, default=1, help="The number of tshark processes the endpoints backend may run at once")
+    parser.add_argument('--cache-dir', default="cache", help="Where parsed PHS trees and conversation tables are kept between runs")
+    parser.add_argument('--cache-size', type=is_positive_int, default=1024, help="The size in MB the cache is trimmed to, least recently used entries go first")
+    parser.add_argument('--no-cache', action="store_true", help="Always rerun tshark for PHS trees and conversation tables")
+    parser.add_argument('--output-format', choices=["csv", "parquet", "arrow"], default="csv", help="csv writes the usual files, parquet and arrow (IPC) write the same columns with MAC/protocol/IP dictionary encoded and need pyarrow")
     args = parser.parse_args()
     pcap_to_macs_mapping = parse_cfg_csv(args.input_csv)
+
+    cache = None
+    if not args.no_cache:
+        cache = capture_cache.open_cache(args.cache_dir, args.cache_size)
  
     # Setup interactive environment for nice statusing
     overall_progress = Progress(
@@ -77,45 +105,43 @@ def main(argv):
 
             # Fetch the phs tree and parse it
             file_task = file_progress.add_task("Extracting protocols", total=inter_file_tasks)
-            known_protos, unknown_protos = extract_protocols_from_phs_tree(pcap_file)
+            known_protos, unknown_protos = extract_protocols_from_phs_tree(pcap_file, cache)
          
             if known_protos != None:
                 file_progress.update(file_task, advance=1, description=f"Resolving unknown protos")
-                all_protos, manual_verification_ports = resolve_unknown_protos(known_protos, unknown_protos, pcap_file, task_progress)
+                all_protos, manual_verification_ports = resolve_unknown_protos(known_protos, unknown_protos, pcap_file, task_progress, cache)
 
                 # Determine if we need IPv4 or IPv6 (or both)
-                use_ipv4 = False
-                use_ipv6 = False
+                ip_types = list()
                 if "ip" in all_protos["Layer 3"]:
-                    use_ipv4 = True
+                    ip_types.append("ip")
                 if "ipv6" in all_protos["Layer 3"]:
-                    use_ipv6 = True
+                    ip_types.append("ipv6")
 
                 # Now gather metrics for each protocol
                 # We want to both gather metrics of transceived data to each IP as well as aggregates for the device
-                if use_ipv4:
-                    text = "Extracting metrics (IPv4)" if use_ipv6 else "Extracting metrics"
-                    advance_num = 1 if use_ipv6 else 2
-
-                    file_progress.update(file_task, advance=advance_num, description=f"{text}")
-                    proto_data_by_mac = extract_protocol_data_for_macs(pcap_file, macs_to_analyze, all_protos, manual_verification_ports, False, task_progress)
-
-                if use_ipv6:
-                    text = "Extracting metrics (IPv6)" if use_ipv4 else "Extracting metrics"
-                    advance_num = 1 if use_ipv4 else 2
+                # Both IP versions are gathered together so dual-stack captures aren't read twice
+                file_progress.update(file_task, advance=2, description=f"Extracting metrics")
+                if args.backend == "single-pass":
+                    proto_data_by_ip_type = extract_protocol_data_single_pass(pcap_file, macs_to_analyze, all_protos, manual_verification_ports, ip_types, task_progress_no_count)
+                elif args.backend == "columnar":
+                    try:
+                        proto_data_by_ip_type = extract_protocol_data_columnar(pcap_file, macs_to_analyze, all_protos, manual_verification_ports, ip_types, task_progress_no_count)
+                    except subprocess.CalledProcessError as e:
+                        print(f"ERROR: Cannot export packet fields for {pcap_file} - {e.stderr}")
+                        proto_data_by_ip_type = dict()
+                else:
+                    proto_data_by_ip_type = extract_protocol_data_for_macs(pcap_file, macs_to_analyze, all_protos, manual_verification_ports, ip_types, task_progress, args.jobs)
 
-                    file_progress.update(file_task, advance=advance_num, description=f"{text}")
-                    proto_data_by_mac_v6 = extract_protocol_data_for_macs(pcap_file, macs_to_analyze, all_protos, manual_verification_ports, True, task_progress)
-                
                 file_progress.update(file_task, advance=1, description=f"Writing output")
                 # Create output dir if it doesn't exist and write final results
                 if not os.path.isdir("results"):
                     os.makedirs("results")
-                
-                if use_ipv4:    
-                    write_output(proto_data_by_mac, "results", file_name)
-                if use_ipv6:
-                    write_output(proto_data_by_mac_v6, "results", f"{file_name}-ipv6")
+
+                if "ip" in proto_data_by_ip_type:
+                    write_output(proto_data_by_ip_type["ip"], "results", file_name, args.output_format)
+                if "ipv6" in proto_data_by_ip_type:
+                    write_output(proto_data_by_ip_type["ipv6"], "results", f"{file_name}-ipv6", args.output_format)
 
             # If it failed, we can't do anything else
             else:
@@ -130,6 +156,13 @@ def is_file(path):
         return path
     else:
         raise argparse.ArgumentTypeError(f"{path} not found or isn't a file")
+
+
+def is_positive_int(value):
+    if value.isdigit() and int(value) > 0:
+        return int(value)
+    else:
+        raise argparse.ArgumentTypeError(f"{value} must be a positive integer")
     
 
 def parse_cfg_csv(file_location):
@@ -149,63 +182,73 @@ def parse_cfg_csv(file_location):
 
     return ret_dict
 
-def extract_protocols_from_phs_tree(pcap_file):
-    
-    # Fetch the phys tree
+def extract_protocols_from_phs_tree(pcap_file, cache=None):
+
+    # The tree only depends on the capture, so reuse it if we've parsed it before
+    protocol_list = capture_cache.load(cache, pcap_file, "-Nt -q -z io,phs")
+    if protocol_list != None:
+        return parse_protocol_list(protocol_list)
+
+    # Fetch the phys tree, parsing it line by line as tshark prints it
     tshark_command_one = ["tshark", "-Nt", "-qr", pcap_file, "-z", "io,phs"] # create an array for both template commands
-    command_one = subprocess.run(tshark_command_one, capture_output=True, text=True)   # Run tshark command
+    command_one = subprocess.Popen(tshark_command_one, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)   # Run tshark command
 
-    if(command_one.returncode == 0):  # Check if the command was successful
-    
-        parsed_output = command_one.stdout # Process the output and extract values
-    
-        lines = parsed_output.split('\n')   # split based off of new line
-        for i, line in enumerate(lines): # for each line
-            if line.strip().startswith('eth'): # check if it starts with eth, indicating that we got rid of junk characters
-                break
+    # Parse out protocol tree
+    protocol_list = unwind_phs_tree(command_one.stdout)
 
-        # Join and return the remaining lines
-        parsed_output = '\n'.join(lines[i:]) # join it together
-        parsed_output = parsed_output.splitlines() # put string into list for parsing
-        parsed_output.remove(parsed_output[-1]) # remove final line, useless tring
-        
-        # Parse out protocol tree
-        protocol_list = unwind_phs_tree(parsed_output)
+    # Drain anything after the tree so tshark can exit
+    for line in command_one.stdout:
+        pass
+    command_one.wait()
+
+    if(command_one.returncode == 0):  # Check if the command was successful
+        capture_cache.store(cache, pcap_file, "-Nt -q -z io,phs", protocol_list)
         return parse_protocol_list(protocol_list)
 
     else:
         return None, None
 
-def unwind_phs_tree(parsed_output):
-    proto_list, output_lines = unwind_phs_tree_step(-1, [], parsed_output, [])
-    return proto_list
 
+# Takes the lines of the io,phs output and returns the chain of protocols leading to each line of the tree
+# The first entry is the empty chain above the root of the tree
+def unwind_phs_tree(phs_lines):
 
-def unwind_phs_tree_step(curr_indent, stack, output_lines, proto_list):
-   
-    proto_list.append(list(stack))
+    proto_list = [[]]
+
+    # Protocols above the current line, along with the indent each one was found at
+    stack = []
+    stack_indents = []
+
+    found_tree = False
+    for line in phs_lines:
+
+        # Skip the header, the tree starts at eth
+        if not found_tree:
+            if not line.strip().startswith('eth'):
+                continue
+            found_tree = True
+
+        # The tree ends at the footer
+        if line.startswith('='):
+            break
 
-    while True: # Recursion handles breaking this loop
-        # End case
-        if len(output_lines) == 0:
-            if(len(stack) > 0):
-                stack.pop()
-            return proto_list, output_lines
-        
         # Parse current line
-        line = output_lines[0]
         parts = line.split() # split,
+        if len(parts) == 0:
+            continue
         key = parts[0].rstrip(':') # get the key (layer)
         elem_indent = int((len(line) - len(line.lstrip())) / 2) # indicate what level of indent
 
-        # This element is nested, add to stack and push down
-        if elem_indent > curr_indent:
-            stack.append(key)
-            proto_list, output_lines = unwind_phs_tree_step(elem_indent, stack, output_lines[1:], proto_list)
-
-        else:
+        # Climb back up to this element's parent, then nest it underneath
+        while len(stack_indents) > 0 and stack_indents[-1] >= elem_indent:
             stack.pop()
-            return proto_list, output_lines
+            stack_indents.pop()
+
+        stack.append(key)
+        stack_indents.append(elem_indent)
+        proto_list.append(list(stack))
+
+    return proto_list
 
 
 def parse_protocol_list(protocol_list):
@@ -260,7 +303,7 @@ def parse_protocol_list(protocol_list):
     return ret_dict, unknown_protos
 
 
-def resolve_unknown_protos(known_protos, unknown_protos, file_location, rich_progress=None):
+def resolve_unknown_protos(known_protos, unknown_protos, file_location, rich_progress=None, cache=None):
 
     # TLS can hide other protocols in it, so we consider this "unknown" if it exists
     if "tls" in known_protos["Layer 5"]:
@@ -275,24 +318,34 @@ def resolve_unknown_protos(known_protos, unknown_protos, file_location, rich_pro
     # We assume that ports associated with well known protocols indicate that protocol
     # and that the devices are not intentionally trying to hide other traffic in well known
     # ports
+
+    # We record all TCP and UDP conversations involving each protocol
+    # Reuse any conversations we've parsed before, the rest are gathered together below
+    conv_endpoints_by_proto = dict()
     for unknown_proto in unknown_protos:
+        conv_rows = capture_cache.load(cache, file_location, conv_cache_query(unknown_proto))
+        if conv_rows != None:
+            conv_endpoints_by_proto[unknown_proto] = conv_endpoints_from_rows(conv_rows)
+
+    # The taps for every remaining protocol are stacked into as few tshark passes as the argv limit allows
+    # Each pass reads the file once no matter how many protocols it covers
+    protos_to_read = [x for x in unknown_protos if x not in conv_endpoints_by_proto]
+    for proto_batch in batch_conv_taps(file_location, protos_to_read):
 
         if rich_progress != None:
-            rich_progress.update(resolve_task, description=f"Attempting to resolve \"{unknown_proto}\" to port mappings")
-        
-        # We record all TCP and UDP conversations involving this protocol
-        # We pull TCP, UDP broadcast and multicast (designated by eth.dst.ig == 1), and UDP unicast seperately
-        # as they have different rules for assignment
+            rich_progress.update(resolve_task, description=f"Collecting conversations for {len(proto_batch)} unknown protos")
 
-        # We can get this with one tshark command
-        tcp_command = f"conv,tcp,{unknown_proto}"
-        multi_broadcast_udp_command = f"conv,udp,{unknown_proto} && eth.dst.ig == 1"
-        unicast_udp = f"conv,udp,{unknown_proto} && eth.dst.ig == 0"
-        tshark_command = ["tshark","-nqr", file_location, "-z", unicast_udp, "-z", multi_broadcast_udp_command, "-z", tcp_command]
-        command = subprocess.run(tshark_command, capture_output=True, text=True)   # Run tshark command
+        conv_endpoints_by_proto.update(read_conv_endpoints(file_location, proto_batch, cache))
 
-        # Parse info from the conversation
-        tcp_conv_endpoints_, multi_broadcast_udp_conv_endpoints, unicast_udp_conv_endpoints = parse_ips_and_ports(command.stdout)
+    # Ports we couldn't attribute to a known protocol, collected across every unknown protocol
+    manual_verification_ports = list()
+
+    for unknown_proto in unknown_protos:
+
+        if rich_progress != None:
+            rich_progress.update(resolve_task, description=f"Attempting to resolve \"{unknown_proto}\" to port mappings")
+
+        tcp_conv_endpoints_, multi_broadcast_udp_conv_endpoints, unicast_udp_conv_endpoints = conv_endpoints_by_proto[unknown_proto]
 
         # Pull the protos out of the conversations
 
@@ -301,7 +354,7 @@ def resolve_unknown_protos(known_protos, unknown_protos, file_location, rich_pro
 
         resolved_protos = list()
         for conv in tcp_conv_endpoints_:
-            port_to_record = F"tcp:{conv['port_dst']}"
+            port_to_record = F"tcp:{conv.port_dst}"
 
             # HTTPS is a special case of being very well known but
             # sometimes enapsulated in tls in a way that can't be pulled out easily.
@@ -317,7 +370,7 @@ def resolve_unknown_protos(known_protos, unknown_protos, file_location, rich_pro
         # the port to examine since that's how we contacted the group address
 
         for conv in multi_broadcast_udp_conv_endpoints:
-            port_to_record = F"udp:{conv['port_dst']}"
+            port_to_record = F"udp:{conv.port_dst}"
             if port_to_record not in resolved_protos:
                 resolved_protos.append(port_to_record)
 
@@ -329,10 +382,9 @@ def resolve_unknown_protos(known_protos, unknown_protos, file_location, rich_pro
         # manual verification later, since double checking for both ports will double
         # the traffic values and will need to be manually corrected
 
-        manual_verification_ports = list()
         for conv in unicast_udp_conv_endpoints:
-            dst_port = F"udp:{conv['port_dst']}"
-            src_port = F"udp:{conv['port_src']}"
+            dst_port = F"udp:{conv.port_dst}"
+            src_port = F"udp:{conv.port_src}"
 
             if dst_port in known_udp_ports:
                 if dst_port not in resolved_protos:
@@ -348,11 +400,13 @@ def resolve_unknown_protos(known_protos, unknown_protos, file_location, rich_pro
                 # Record both, but flag for manual verification
                 if dst_port not in resolved_protos:
                     resolved_protos.append(dst_port)
-                    manual_verification_ports.append(dst_port)
+                    if dst_port not in manual_verification_ports:
+                        manual_verification_ports.append(dst_port)
 
                 if src_port not in resolved_protos:
                     resolved_protos.append(src_port)
-                    manual_verification_ports.append(src_port)
+                    if src_port not in manual_verification_ports:
+                        manual_verification_ports.append(src_port)
 
         # When performing a manual verification, you should remove any entries for data already covered for an earlier port/proto pair.
         # For example if udp:8888 and udp:34823 are both present in the resulting dataset, but all udp:34823 conversations involve udp:8888
@@ -369,120 +423,176 @@ def resolve_unknown_protos(known_protos, unknown_protos, file_location, rich_pro
     
     return known_protos, manual_verification_ports
 
-def parse_ips_and_ports(text):
-    
-    # Responses
-    tcp_conv_endpoints_ = []
-    multi_broadcast_udp_conv_endpoints = []
-    unicast_udp_conv_endpoints = []
 
-    # Trim header and footer
-    parsed_output = text.splitlines()
+# We pull TCP, UDP broadcast and multicast (designated by eth.dst.ig == 1), and UDP unicast seperately
+# as they have different rules for assignment
+# Returned in command line order, tshark prints them back in reverse so the TCP section comes first
+def build_conv_taps(unknown_proto):
+    tcp_command = f"conv,tcp,{unknown_proto}"
+    multi_broadcast_udp_command = f"conv,udp,{unknown_proto} && eth.dst.ig == 1"
+    unicast_udp = f"conv,udp,{unknown_proto} && eth.dst.ig == 0"
+    return [unicast_udp, multi_broadcast_udp_command, tcp_command]
 
-    tcp_lines = None
-    multi_broadcast_udp_lines = None
-    unicast_udp_lines = None
 
-    # Seperate sections
-    # Need to iterate with indicies since section sizes are variable
-    curr_index = 0
-    found_first = False
-    for i in range(len(parsed_output)):
+# The conversations only depend on the capture and the taps, so this is what they're cached under
+def conv_cache_query(unknown_proto):
+    return "-nq " + " ".join(f"-z {tap}" for tap in build_conv_taps(unknown_proto))
 
-        line = parsed_output[i]
 
-        # Look for two consecutive lines both containing "====" for the split
-        if "====" in line:
+# Splits the protocols into groups whose stacked taps fit on one command line
+def batch_conv_taps(file_location, unknown_protos):
+
+    # The kernel limit covers the arguments and the environment, each string also costs a pointer and a terminator
+    # Leave some headroom in case the limit isn't reported exactly
+    arg_size = lambda arg: len(os.fsencode(arg)) + 1 + 8
+    arg_budget = os.sysconf("SC_ARG_MAX") - 4096
+    arg_budget -= sum(arg_size(f"{key}={value}") for key, value in os.environ.items())
+    arg_budget -= sum(arg_size(arg) for arg in ["tshark", "-nqr", file_location])
+
+    batches = list()
+    batch = list()
+    batch_size = 0
+    for unknown_proto in unknown_protos:
+        proto_size = sum(arg_size("-z") + arg_size(tap) for tap in build_conv_taps(unknown_proto))
+
+        if len(batch) > 0 and batch_size + proto_size > arg_budget:
+            batches.append(batch)
+            batch = list()
+            batch_size = 0
+
+        batch.append(unknown_proto)
+        batch_size += proto_size
+
+    if len(batch) > 0:
+        batches.append(batch)
+
+    return batches
+
+
+# Runs the stacked conv taps for a group of protocols in one pass and parses each protocol's conversations
+def read_conv_endpoints(file_location, unknown_protos, cache=None):
+
+    ret_dict = dict()
 
-            if found_first:
+    tshark_command = ["tshark","-nqr", file_location]
+    for unknown_proto in unknown_protos:
+        for tap in build_conv_taps(unknown_proto):
+            tshark_command.extend(["-z", tap])
+    command = subprocess.run(tshark_command, capture_output=True, text=True)   # Run tshark command
+
+    # Sections come back in reverse, flip them to line up with the command line
+    sections = split_conv_sections(command.stdout)
+    sections.reverse()
+
+    if command.returncode != 0 or len(sections) != 3 * len(unknown_protos):
+
+        # One bad filter fails the whole pass, so fall back to reading each protocol on its own
+        if len(unknown_protos) > 1:
+            for unknown_proto in unknown_protos:
+                ret_dict.update(read_conv_endpoints(file_location, [unknown_proto], cache))
+            return ret_dict
 
-                # First is TCP
-                if tcp_lines == None:
-                    tcp_lines = parsed_output[:i]
-                    curr_index = i
+        print(f"Unable to read conversations for \"{unknown_protos[0]}\": {command.stderr.strip()}", file=sys.stderr)
+        ret_dict[unknown_protos[0]] = ([], [], [])
+        return ret_dict
 
-                # Next is eth.dst.ig == 1 which we can use to find the rest
-                elif multi_broadcast_udp_lines == None:
-                    multi_broadcast_udp_lines = parsed_output[curr_index:i]
-                    unicast_udp_lines = parsed_output[i:]
-                    curr_index = i
-                    break
+    for i, unknown_proto in enumerate(unknown_protos):
+
+        # Parse info from the conversation
+        unicast_udp_section, multi_broadcast_udp_section, tcp_section = sections[3 * i:3 * i + 3]
+        conv_endpoints = parse_ips_and_ports([tcp_section, multi_broadcast_udp_section, unicast_udp_section])
+        capture_cache.store(cache, file_location, conv_cache_query(unknown_proto), conv_endpoints_to_rows(conv_endpoints))
+        ret_dict[unknown_proto] = conv_endpoints
+
+    return ret_dict
 
-                found_first = False
+
+# Splits stacked tap output into one list of lines per section, each section is wrapped in "====" lines
+def split_conv_sections(text):
+
+    sections = list()
+    section = None
+    for line in text.splitlines():
+
+        if "====" in line:
+            if section == None:
+                section = [line]
             else:
-                found_first = True
-        else:
-            found_first = False
-
-    # Trim headers and footers
-    tcp_lines = tcp_lines[5:]
-    tcp_lines = tcp_lines[:-1]
-
-    multi_broadcast_udp_lines = multi_broadcast_udp_lines[5:]
-    multi_broadcast_udp_lines = multi_broadcast_udp_lines[:-1]
-
-    unicast_udp_lines = unicast_udp_lines[5:]
-    unicast_udp_lines = unicast_udp_lines[:-1]
-
-    # Process TCP
-    for line in tcp_lines:
-        line = line.split()
-        src_part = line[0]
-        dst_part = line[2]
-        port_src = src_part.split(':')[-1]
-        ip_src = src_part.replace(port_src, "")
-        port_dst = dst_part.split(':')[-1]
-        ip_dst = dst_part.replace(port_dst, "")
-        conv_data = dict()
-        conv_data["ip_src"] = ip_src
-        conv_data["port_src"] = port_src
-        conv_data["ip_dst"] = ip_dst
-        conv_data["port_dst"] = port_dst
-        tcp_conv_endpoints_.append(conv_data)
-
-    # Process broadcast/multicast
-    for line in multi_broadcast_udp_lines:
-        line = line.split()
-        src_part = line[0]
-        dst_part = line[2]
-        port_src = src_part.split(':')[-1]
-        ip_src = src_part.replace(port_src, "")
-        port_dst = dst_part.split(':')[-1]
-        ip_dst = dst_part.replace(port_dst, "")
-        conv_data = dict()
-        conv_data["ip_src"] = ip_src
-        conv_data["port_src"] = port_src
-        conv_data["ip_dst"] = ip_dst
-        conv_data["port_dst"] = port_dst
-        multi_broadcast_udp_conv_endpoints.append(conv_data)
-
-    # Process unicast
-    for line in unicast_udp_lines:
-        line = line.split()
-        src_part = line[0]
-        dst_part = line[2]
-        port_src = src_part.split(':')[-1]
-        ip_src = src_part.replace(port_src, "")
-        port_dst = dst_part.split(':')[-1]
-        ip_dst = dst_part.replace(port_dst, "")
-        conv_data = dict()
-        conv_data["ip_src"] = ip_src
-        conv_data["port_src"] = port_src
-        conv_data["ip_dst"] = ip_dst
-        conv_data["port_dst"] = port_dst
-        unicast_udp_conv_endpoints.append(conv_data)
+                section.append(line)
+                sections.append(section)
+                section = None
+
+        elif section != None:
+            section.append(line)
+
+    return sections
+
+# One row of -z conv output, addresses are kept as packed integers and ports as integers
+# Slots keep this small since busy captures produce hundreds of thousands of conversations
+class ConvRecord:
+    __slots__ = ("ip_src", "port_src", "ip_dst", "port_dst", "is_ipv6")
+
+    def __init__(self, ip_src, port_src, ip_dst, port_dst, is_ipv6):
+        self.ip_src = ip_src
+        self.port_src = port_src
+        self.ip_dst = ip_dst
+        self.port_dst = port_dst
+        self.is_ipv6 = is_ipv6
+
+    def to_row(self):
+        return [self.ip_src, self.port_src, self.ip_dst, self.port_dst, self.is_ipv6]
+
+
+def pack_ip(ip):
+    if ':' in ip:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), "big")
+    return int.from_bytes(socket.inet_aton(ip), "big")
+
+
+def parse_conv_line(line):
+
+    parts = line.split()
+
+    # Anything that isn't a conversation row (headers, blank lines) is skipped
+    if len(parts) < 3 or parts[1] != "<->":
+        return None
+
+    # Each side is "address:port", IPv6 addresses have colons of their own so split on the last one
+    ip_src, _, port_src = parts[0].rpartition(':')
+    ip_dst, _, port_dst = parts[2].rpartition(':')
+    try:
+        return ConvRecord(pack_ip(ip_src), int(port_src), pack_ip(ip_dst), int(port_dst), ':' in ip_src)
+    except (OSError, ValueError):
+        return None
+
+
+# Takes the TCP, UDP broadcast/multicast and UDP unicast sections of a -z conv run (as split by split_conv_sections)
+# and returns the conversations in each
+def parse_ips_and_ports(sections):
+
+    conv_endpoints = list()
+    for section in sections:
+        section_endpoints = list()
+        for line in section:
+            conv = parse_conv_line(line)
+            if conv != None:
+                section_endpoints.append(conv)
+        conv_endpoints.append(section_endpoints)
 
+    tcp_conv_endpoints_, multi_broadcast_udp_conv_endpoints, unicast_udp_conv_endpoints = conv_endpoints
     return tcp_conv_endpoints_, multi_broadcast_udp_conv_endpoints, unicast_udp_conv_endpoints
 
 
-def extract_protocol_data_for_macs(pcap_file, macs_to_analyze, all_protos, manual_verification_ports, is_ipv6, rich_progress=None):
+# Conversations are cached as plain rows
+def conv_endpoints_to_rows(conv_endpoints):
+    return [[conv.to_row() for conv in section_endpoints] for section_endpoints in conv_endpoints]
 
-    protocol_metrics_by_mac = dict()
 
-    if is_ipv6:
-        ip_type = "ipv6"
-    else:
-        ip_type = "ip"
+def conv_endpoints_from_rows(rows):
+    return tuple([ConvRecord(*row) for row in section_rows] for section_rows in rows)
+
+
+def extract_protocol_data_for_macs(pcap_file, macs_to_analyze, all_protos, manual_verification_ports, ip_types, rich_progress=None, jobs=1):
 
     # tshark can take a long time to run based on filesize but is efficient at processing multiple
     # statistics at one time. Because of this, we batch the protocols in sets of ~10. However,
@@ -491,266 +601,631 @@ def extract_protocol_data_for_macs(pcap_file, macs_to_analyze, all_protos, manua
     it = iter(flattened_protos)
     batched_protos = list(iter(lambda: tuple(itertools.islice(it, 20)), ()))
 
+    # There is a tshark call per batch per mac, this could take a decent bit of time
+    # Each call is independent, so they're handed to a pool of workers
+    # Every call carries the taps for all IP types so the capture is only read once per batch
+    work_items = list()
+    for mac in macs_to_analyze:
+        for batch in batched_protos:
+            work_items.append((mac, batch, tuple(ip_types)))
+
     # Setup progress bar
     if rich_progress != None:
-        task_count = len(batched_protos)
-        task_count = task_count * len(macs_to_analyze)
+        task_count = len(work_items)
         extract_task = rich_progress.add_task(f"Analyzing MACs", total=task_count)
 
-    # There is a tshark call per batch per mac, this could take a decent bit of time
+    # Workers report when they start and finish so the progress bar can show how busy the pool is
+    busy_lock = threading.Lock()
+    busy_workers = [0]
+
+    def run_work_item(mac, batch, ip_types):
+        with busy_lock:
+            busy_workers[0] += 1
+            if rich_progress != None:
+                rich_progress.update(extract_task, description=f"Analyzing MACs - {mac} for batched protocols ({busy_workers[0]} of {jobs} workers busy)")
+
+        try:
+            return run_endpoint_batch(pcap_file, mac, batch, ip_types, manual_verification_ports)
+        finally:
+            with busy_lock:
+                busy_workers[0] -= 1
+                if rich_progress != None:
+                    rich_progress.update(extract_task, advance=1)
+
+    # The heavy lifting happens in tshark, so threads are enough to keep every worker's process busy
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(run_work_item, *work_item) for work_item in work_items]
+
+        # Results are collected in submission order, not completion order, so output is identical to a serial run
+        batch_results = [future.result() for future in futures]
+
+    proto_data_by_ip_type = dict()
+    for ip_type in ip_types:
+        protocol_metrics_by_mac = dict()
+        for mac in macs_to_analyze:
+            protocol_metrics_by_mac[mac] = dict()
+            protocol_metrics_by_mac[mac]["All"] = dict()
+            protocol_metrics_by_mac[mac]["LAN"] = dict()
+            protocol_metrics_by_mac[mac]["WAN"] = dict()
+        proto_data_by_ip_type[ip_type] = protocol_metrics_by_mac
+
+    # Now that we've stored the data, we do a final aggregation of all information
+    for work_item, batch_result in zip(work_items, batch_results):
+        mac = work_item[0]
+        for ip_type, (all_proto_data, lan_proto_data, wan_proto_data) in batch_result.items():
+            proto_data_by_ip_type[ip_type][mac]["All"].update(all_proto_data)
+            proto_data_by_ip_type[ip_type][mac]["LAN"].update(lan_proto_data)
+            proto_data_by_ip_type[ip_type][mac]["WAN"].update(wan_proto_data)
+
+    if rich_progress != None:
+        rich_progress.remove_task(extract_task)
+
+    for ip_type in ip_types:
+        proto_data_by_ip_type[ip_type] = dict(sorted(proto_data_by_ip_type[ip_type].items()))
+    return proto_data_by_ip_type
+
+
+def run_endpoint_batch(pcap_file, mac, batch, ip_types, manual_verification_ports):
+
+    # Need to construct command for batched protocols
+    tshark_command = ["tshark", "-qr", pcap_file]
+
+    # Since tshark puts output with the last -z flag first, we process the IP types and protocols in reverse
+    for ip_type, proto in itertools.product(reversed(ip_types), reversed(batch)):
+
+        # We want to record
+
+        # Tshark will name protocols that are recognized by port but aren't
+        # directly queryable with a filter, e.g. it recognizes "https" but can't filter directly on "https"
+        if proto.isnumeric():
+            filter_string = f"tcp.port == {int(proto)} || udp.port == {int(proto)} && eth.addr == {mac}"
+        elif "tcp:" in proto:
+            proto_to_use = proto.replace("tcp:", "")
+            filter_string = f"tcp.port == {int(proto_to_use)} && eth.addr == {mac}"
+        elif "udp:" in proto:
+            proto_to_use = proto.replace("udp:", "")
+            filter_string = f"udp.port == {int(proto_to_use)} && eth.addr == {mac}"
+        elif proto == "https":
+            filter_string = f"tcp.port == 443 && eth.addr == {mac}"
+        elif proto == "secure-mqtt":
+            filter_string = f"tcp.port == 8883 && eth.addr == {mac}"
+        else:
+            filter_string = f"{proto} && eth.addr == {mac}"
+
+        # Repeat this process again for LAN/WAN filters
+        if proto.isnumeric():
+            lan_filter_string = f"tcp.port == {int(proto)} || udp.port == {int(proto)} && {lan_filter} && eth.addr == {mac}"
+        elif "tcp:" in proto:
+            proto_to_use = proto.replace("tcp:", "")
+            lan_filter_string = f"tcp.port == {int(proto_to_use)} && {lan_filter} && eth.addr == {mac}"
+        elif "udp:" in proto:
+            proto_to_use = proto.replace("udp:", "")
+            lan_filter_string = f"udp.port == {int(proto_to_use)} && {lan_filter} && eth.addr == {mac}"
+        elif proto == "https":
+            lan_filter_string = f"tcp.port == 443 && {lan_filter} && eth.addr == {mac}"
+        elif proto == "secure-mqtt":
+            lan_filter_string = f"tcp.port == 8883 && {lan_filter} && eth.addr == {mac}"
+        else:
+            lan_filter_string = f"{proto} && {lan_filter} && eth.addr == {mac}"
+
+        if proto.isnumeric():
+            wan_filter_string = f"tcp.port == {int(proto)} || udp.port == {int(proto)} && {wan_filter} && eth.addr == {mac}"
+        elif "tcp:" in proto:
+            proto_to_use = proto.replace("tcp:", "")
+            wan_filter_string = f"tcp.port == {int(proto_to_use)} && {wan_filter}  && eth.addr == {mac}"
+        elif "udp:" in proto:
+            proto_to_use = proto.replace("udp:", "")
+            wan_filter_string = f"udp.port == {int(proto_to_use)} && {wan_filter}  && eth.addr == {mac}"
+        elif proto == "https":
+            wan_filter_string = f"tcp.port == 443 && {wan_filter} && eth.addr == {mac}"
+        elif proto == "secure-mqtt":
+            wan_filter_string = f"tcp.port == 8883 && {wan_filter} && eth.addr == {mac}"
+        else:
+            wan_filter_string = f"{proto} && {wan_filter} && eth.addr == {mac}"
+
+        tshark_command += ["-z", f"endpoints,{ip_type},{filter_string}", "-z", f"endpoints,{ip_type},{lan_filter_string}", "-z", f"endpoints,{ip_type},{wan_filter_string}"]
+
+    # Now process the command
+    command = subprocess.run(tshark_command, capture_output=True, text=True)
+
+    proto_data_by_ip_type = dict()
+    for ip_type in ip_types:
+        proto_data_by_ip_type[ip_type] = (dict(), dict(), dict())
+
+    # Check if the command was successful
+    if(command.returncode == 0):
+        lines = command.stdout.split('\n')
+
+        # Process WAN -> LAN -> Both
+        # We revered to create the command so we go forward here
+        for ip_type, proto in itertools.product(ip_types, batch):
+            is_ipv6 = ip_type == "ipv6"
+            all_proto_data, lan_proto_data, wan_proto_data = proto_data_by_ip_type[ip_type]
+
+            # Check if we need to flag this
+            flag = proto in manual_verification_ports
+
+            # Starts WAN
+            wan_lines, lines = split_endpoint_section(lines)
+
+            # Next up is LAN
+            lan_lines, lines = split_endpoint_section(lines)
+
+            # Finally both
+            both_lines, lines = split_endpoint_section(lines)
+
+            # Tokens are in order <ip>,<total_packets>,<total_bytes>,<packets_from_ip>,<bytes_from_ip>,<packets_to_ip>,<packets_to_ip>
+            wan_proto_data[proto] = build_endpoint_metrics([line.split() for line in wan_lines], "WAN", is_ipv6, flag)
+            lan_proto_data[proto] = build_endpoint_metrics([line.split() for line in lan_lines], "LAN", is_ipv6, flag)
+            all_proto_data[proto] = build_endpoint_metrics([line.split() for line in both_lines], "All", is_ipv6, flag)
+
+    else:
+        print(f"ERROR: Cannot process ALL for {pcap_file} - {command.stderr}")
+
+    return proto_data_by_ip_type
+
+
+def extract_protocol_data_single_pass(pcap_file, macs_to_analyze, all_protos, manual_verification_ports, ip_types, rich_progress=None):
+
+    # Instead of asking tshark for endpoint tables per MAC and protocol, we export a few fields for every
+    # packet in one read of the capture and build the same endpoint tables ourselves
+    # The same read fills the tables for every requested IP type
+    address_indexes = dict()
+    address_indexes["ip"] = (packet_fields.index("ip.src"), packet_fields.index("ip.dst"))
+    address_indexes["ipv6"] = (packet_fields.index("ipv6.src"), packet_fields.index("ipv6.dst"))
+
+    flattened_protos = list(itertools.chain(*all_protos.values()))
+    layer_matchers, tcp_port_matchers, udp_port_matchers = build_protocol_matchers(flattened_protos)
+
+    # tshark prints MACs in lowercase, but we report them as they were given
+    mac_lookup = dict()
     for mac in macs_to_analyze:
+        mac_lookup[mac.lower()] = mac
+
+    # Counts are kept from the perspective of the IP like tshark's endpoint tables
+    # endpoint_counts[ip_type][mac][scope][proto][ip] = [packets_from_ip, bytes_from_ip, packets_to_ip, bytes_to_ip]
+    endpoint_counts = dict()
+    for ip_type in ip_types:
+        endpoint_counts[ip_type] = dict()
+        for mac in macs_to_analyze:
+            endpoint_counts[ip_type][mac] = dict()
+            endpoint_counts[ip_type][mac]["All"] = dict()
+            endpoint_counts[ip_type][mac]["LAN"] = dict()
+            endpoint_counts[ip_type][mac]["WAN"] = dict()
+
+    # Setup progress bar, we don't know the packet count up front
+    if rich_progress != None:
+        extract_task = rich_progress.add_task(f"Reading packets", total=None)
+
+    packet_count = 0
+    scope_cache = dict()
+    for fields in stream_packet_fields(pcap_file, packet_fields):
+
+        packet_count += 1
+        if rich_progress != None and packet_count % 10000 == 0:
+            rich_progress.update(extract_task, description=f"Reading packets ({packet_count} read)")
+
+        if len(fields) != len(packet_fields):
+            continue
+
+        # Only traffic to or from the MACs we're analyzing matters
+        macs = list()
+        for eth_addr in (fields[1], fields[2]):
+            if eth_addr in mac_lookup and mac_lookup[eth_addr] not in macs:
+                macs.append(mac_lookup[eth_addr])
+
+        if len(macs) == 0:
+            continue
+
+        protos = match_protocols(fields[12], fields[8], fields[9], fields[10], fields[11], layer_matchers, tcp_port_matchers, udp_port_matchers)
+        if len(protos) == 0:
+            continue
+
+        # The scope only depends on the addresses, so cache it since the same pairs repeat constantly
+        scope_key = (fields[3], fields[4], fields[5], fields[6], fields[7])
+        if scope_key not in scope_cache:
+            scope_cache[scope_key] = lan_classifier.classify_scope(*scope_key)
+        scope = scope_cache[scope_key]
+
+        frame_len = int(fields[0])
+        for ip_type in ip_types:
+            src_index, dst_index = address_indexes[ip_type]
+            ip_src = fields[src_index]
+            ip_dst = fields[dst_index]
+
+            # Packets without this IP layer don't show up in its endpoint table
+            if ip_src == "" or ip_dst == "":
+                continue
 
-        all_proto_data = dict()
-        lan_proto_data = dict()
-        wan_proto_data = dict()
+            for mac in macs:
+                for proto in protos:
+                    record_endpoint_packet(endpoint_counts[ip_type][mac]["All"], proto, ip_src, ip_dst, frame_len)
+                    if scope != None:
+                        record_endpoint_packet(endpoint_counts[ip_type][mac][scope], proto, ip_src, ip_dst, frame_len)
 
-        for batch in batched_protos:
-            if rich_progress != None:
-                rich_progress.update(extract_task, description=f"Analyzing MACs - {mac} for batched protocols")
-
-            # Need to construct command for batched protocols
-            tshark_command = ["tshark", "-qr", pcap_file]
-
-            # Since tshark puts output with the last -z flag first, we process the protocols in reverse 
-            for proto in reversed(batch):
-
-                # We want to record
-
-                # Tshark will name protocols that are recognized by port but aren't
-                # directly queryable with a filter, e.g. it recognizes "https" but can't filter directly on "https"
-                if proto.isnumeric():
-                    filter_string = f"tcp.port == {int(proto)} || udp.port == {int(proto)} && eth.addr == {mac}"
-                elif "tcp:" in proto:
-                    proto_to_use = proto.replace("tcp:", "")
-                    filter_string = f"tcp.port == {int(proto_to_use)} && eth.addr == {mac}"
-                elif "udp:" in proto:
-                    proto_to_use = proto.replace("udp:", "")
-                    filter_string = f"udp.port == {int(proto_to_use)} && eth.addr == {mac}"
-                elif proto == "https":
-                    filter_string = f"tcp.port == 443 && eth.addr == {mac}"
-                elif proto == "secure-mqtt":
-                    filter_string = f"tcp.port == 8883 && eth.addr == {mac}"
-                else:
-                    filter_string = f"{proto} && eth.addr == {mac}"
-
-                # Repeat this process again for LAN/WAN filters
-                if proto.isnumeric():
-                    lan_filter_string = f"tcp.port == {int(proto)} || udp.port == {int(proto)} && {lan_filter} && eth.addr == {mac}"
-                elif "tcp:" in proto:
-                    proto_to_use = proto.replace("tcp:", "")
-                    lan_filter_string = f"tcp.port == {int(proto_to_use)} && {lan_filter} && eth.addr == {mac}"
-                elif "udp:" in proto:
-                    proto_to_use = proto.replace("udp:", "")
-                    lan_filter_string = f"udp.port == {int(proto_to_use)} && {lan_filter} && eth.addr == {mac}"
-                elif proto == "https":
-                    lan_filter_string = f"tcp.port == 443 && {lan_filter} && eth.addr == {mac}"
-                elif proto == "secure-mqtt":
-                    lan_filter_string = f"tcp.port == 8883 && {lan_filter} && eth.addr == {mac}"
-                else:
-                    lan_filter_string = f"{proto} && {lan_filter} && eth.addr == {mac}"
-
-                if proto.isnumeric():
-                    wan_filter_string = f"tcp.port == {int(proto)} || udp.port == {int(proto)} && {wan_filter} && eth.addr == {mac}"
-                elif "tcp:" in proto:
-                    proto_to_use = proto.replace("tcp:", "")
-                    wan_filter_string = f"tcp.port == {int(proto_to_use)} && {wan_filter}  && eth.addr == {mac}"
-                elif "udp:" in proto:
-                    proto_to_use = proto.replace("udp:", "")
-                    wan_filter_string = f"udp.port == {int(proto_to_use)} && {wan_filter}  && eth.addr == {mac}"
-                elif proto == "https":
-                    wan_filter_string = f"tcp.port == 443 && {wan_filter} && eth.addr == {mac}"
-                elif proto == "secure-mqtt":
-                    wan_filter_string = f"tcp.port == 8883 && {wan_filter} && eth.addr == {mac}"
-                else:
-                    wan_filter_string = f"{proto} && {wan_filter} && eth.addr == {mac}"
-
-                tshark_command += ["-z", f"endpoints,{ip_type},{filter_string}", "-z", f"endpoints,{ip_type},{lan_filter_string}", "-z", f"endpoints,{ip_type},{wan_filter_string}"]
-
-            # Now process the command
-            command = subprocess.run(tshark_command, capture_output=True, text=True)
-
-            # Check if the command was successful
-            if(command.returncode == 0):  
-                parsed_output = command.stdout
-
-                with open("temp.txt", "w") as outfile:
-                    outfile.write(parsed_output)
-
-                lines = parsed_output.split('\n') 
-                
-                # Process WAN -> LAN -> Both
-                # We revered to create the command so we go forward here
-                for proto in batch:
-
-                    all_endpoint_data = dict()
-                    lan_endpoint_data = dict()
-                    wan_endpoint_data = dict()
-
-                    # Check if we need to flag this
-                    flag_wan = False
-                    flag_lan = False
-                    flag_overall = False
-                    if proto in manual_verification_ports:
-                        flag_wan = True
-                        flag_lan = True
-                        flag_overall = True
-
-                    # Starts WAN
-                    # Trim off header
-                    lines = lines[4:]        
-
-                    # Loop until we find the end of this section
-                    index = 0
-                    for line in lines:
-                        
-                        if "========" in line:
-                            wan_lines = lines[:index]
-                            lines = lines[index+1:]
-                            break
-
-                        index += 1
-
-                    # If we found more than 2 endpoints and it's IPv4 trim off the first one, it's going to be the host itself
-                    if len(wan_lines) > 2 and not is_ipv6:
-                        wan_lines = wan_lines[1:]
-
-                    # Else if it's IPv6, this host can start with anything in the 2620:0:5300::/44 address range
-                    # or anything in the fdc4:22e1:d500::/44 address range
-                    elif len(wan_lines) > 2 and is_ipv6:
-                        wan_lines = [line for line in wan_lines if not (line.startswith("2620:0:53"))]
-                        wan_lines = [line for line in wan_lines if not (line.startswith("fdc4:22e1:d5"))]
-
-                    # If we only found two, we don't know which one is this host,
-                    # need to manually verify
-                    elif len(wan_lines) == 2:
-                        flag_wan = True
-
-                    # Next up is LAN
-                    lines = lines[4:]
-
-                    # Loop until we find the end of this section
-                    index = 0
-                    for line in lines:
-                        
-                        if "========" in line:
-                            lan_lines = lines[:index]
-                            lines = lines[index+1:]
-                            break
-
-                        index += 1
-
-                    # If we found more than 2 endpoints and it's IPv4 trim off the first one, it's going to be the host itself
-                    if len(lan_lines) > 2 and not is_ipv6:
-                        lan_lines = lan_lines[1:]
-
-                    # If we only found two or it's IPv6, we don't know which one is this host,
-                    # need to manually verify
-                    elif len(lan_lines) == 2 or is_ipv6:
-                        flag_lan = True
-
-                    # Finally both
-                    lines = lines[4:]
-
-                    # Loop until we find the end of this section
-                    index = 0
-                    for line in lines:
-                        
-                        if "========" in line:
-                            both_lines = lines[:index]
-                            lines = lines[index+1:]
-                            break
-
-                        index += 1
-
-                    # If we found more than 2 endpoints and it's IPv4 trim off the first one, it's going to be the host itself
-                    if len(both_lines) > 2 and not is_ipv6:
-                        both_lines = both_lines[1:]
-
-                    # If we only found two or it's IPv6, we don't know which one is this host,
-                    # need to manually verify
-                    elif len(both_lines) == 2 or is_ipv6:
-                        flag_overall = True
-
-                    # Now we can process each
-                    for line in wan_lines:
-                        tokens = line.split()
-
-                        # Tokens are in order <ip>,<total_packets>,<total_bytes>,<packets_from_ip>,<bytes_from_ip>,<packets_to_ip>,<packets_to_ip>
-                        # We parse from the perspective of the MAC being analyzed, so if the tshark output says "X packets Tx from IP", we record that as "MAC Rx X packets from IP"
-                        metric_dict = dict()
-                        name = tokens[0]
-                        if flag_wan:
-                            name += "*"
-                        metric_dict["PktTotal"] = tokens[1]
-                        metric_dict["ByteTotal"] = tokens[2]
-                        metric_dict["PktRx"] = tokens[3]
-                        metric_dict["ByteRx"] = tokens[4]
-                        metric_dict["PktTx"] = tokens[5]
-                        metric_dict["ByteTx"] = tokens[6]
-                        wan_endpoint_data[name] = metric_dict
-
-                    for line in lan_lines:
-                        tokens = line.split()
-
-                        # Tokens are in order <ip>,<total_packets>,<total_bytes>,<packets_from_ip>,<bytes_from_ip>,<packets_to_ip>,<packets_to_ip>
-                        # We parse from the perspective of the MAC being analyzed, so if the tshark output says "X packets Tx from IP", we record that as "MAC Rx X packets from IP"
-                        metric_dict = dict()
-                        name = tokens[0]
-                        if flag_lan:
-                            name += "*"
-                        metric_dict["PktTotal"] = tokens[1]
-                        metric_dict["ByteTotal"] = tokens[2]
-                        metric_dict["PktRx"] = tokens[3]
-                        metric_dict["ByteRx"] = tokens[4]
-                        metric_dict["PktTx"] = tokens[5]
-                        metric_dict["ByteTx"] = tokens[6]
-                        lan_endpoint_data[name] = metric_dict
-
-                    for line in both_lines:
-                        tokens = line.split()
-
-                        # Tokens are in order <ip>,<total_packets>,<total_bytes>,<packets_from_ip>,<bytes_from_ip>,<packets_to_ip>,<packets_to_ip>
-                        # We parse from the perspective of the MAC being analyzed, so if the tshark output says "X packets Tx from IP", we record that as "MAC Rx X packets from IP"
-                        metric_dict = dict()
-                        name = tokens[0]
-                        if flag_overall:
-                            name += "*"
-                        metric_dict["PktTotal"] = tokens[1]
-                        metric_dict["ByteTotal"] = tokens[2]
-                        metric_dict["PktRx"] = tokens[3]
-                        metric_dict["ByteRx"] = tokens[4]
-                        metric_dict["PktTx"] = tokens[5]
-                        metric_dict["ByteTx"] = tokens[6]
-                        all_endpoint_data[name] = metric_dict
-
-                    # Sort by IP for nicer printing
-                    all_endpoint_data = dict(sorted(all_endpoint_data.items(), key=sort_ips))
-                    lan_endpoint_data = dict(sorted(lan_endpoint_data.items(), key=sort_ips))
-                    wan_endpoint_data = dict(sorted(wan_endpoint_data.items(), key=sort_ips))
-
-                    # Save protocol data
-                    all_proto_data[proto] = all_endpoint_data
-                    lan_proto_data[proto] = lan_endpoint_data
-                    wan_proto_data[proto] = wan_endpoint_data
+    if rich_progress != None:
+        rich_progress.remove_task(extract_task)
 
-            else:
-                print(f"ERROR: Cannot process ALL for {pcap_file} - {command.stderr}")
+    # Build endpoint tables from the counts
+    endpoint_rows = dict()
+    for ip_type in ip_types:
+        for mac in macs_to_analyze:
+            for scope in ["All", "LAN", "WAN"]:
+                for proto, ip_counts in endpoint_counts[ip_type][mac][scope].items():
+
+                    # tshark lists endpoints by total packets, keeping first seen order for ties
+                    rows = list()
+                    for ip, counts in ip_counts.items():
+                        rows.append((ip, counts[0] + counts[2], counts[1] + counts[3], counts[0], counts[1], counts[2], counts[3]))
+                    rows.sort(key=lambda row: row[1], reverse=True)
+
+                    endpoint_rows[(ip_type, mac, scope, proto)] = rows
+
+    return build_protocol_metrics(endpoint_rows, ip_types, macs_to_analyze, flattened_protos, manual_verification_ports)
 
-            # Update batch count
-            if rich_progress != None:
-                rich_progress.update(extract_task, advance=1)
-        
-        # Now that we've stored the data, we do a final aggregation of all information
-        protocol_metrics_by_mac[mac] = dict()
-        protocol_metrics_by_mac[mac]["All"] = all_proto_data
-        protocol_metrics_by_mac[mac]["LAN"] = lan_proto_data
-        protocol_metrics_by_mac[mac]["WAN"] = wan_proto_data
+
+def build_protocol_metrics(endpoint_rows, ip_types, macs_to_analyze, flattened_protos, manual_verification_ports):
+
+    # Convert endpoint tables keyed by (ip_type, mac, scope, proto) into the same structure the endpoint parsing produces
+    proto_data_by_ip_type = dict()
+    for ip_type in ip_types:
+        is_ipv6 = ip_type == "ipv6"
+
+        protocol_metrics_by_mac = dict()
+        for mac in macs_to_analyze:
+            protocol_metrics_by_mac[mac] = dict()
+
+            for scope in ["All", "LAN", "WAN"]:
+                proto_data = dict()
+
+                for proto in flattened_protos:
+                    flag = proto in manual_verification_ports
+                    rows = endpoint_rows.get((ip_type, mac, scope, proto), [])
+                    proto_data[proto] = build_endpoint_metrics(rows, scope, is_ipv6, flag)
+
+                protocol_metrics_by_mac[mac][scope] = proto_data
+
+        proto_data_by_ip_type[ip_type] = dict(sorted(protocol_metrics_by_mac.items()))
+
+    return proto_data_by_ip_type
+
+
+def extract_protocol_data_columnar(pcap_file, macs_to_analyze, all_protos, manual_verification_ports, ip_types, rich_progress=None):
+
+    # Same field export as the single pass engine, but parsed into columns a chunk at a time and
+    # reduced with grouped sums instead of per packet bookkeeping
+    flattened_protos = list(itertools.chain(*all_protos.values()))
+    layer_matchers, tcp_port_matchers, udp_port_matchers = build_protocol_matchers(flattened_protos)
+
+    # tshark prints MACs in lowercase, but we report them as they were given
+    mac_lookup = dict()
+    for mac in macs_to_analyze:
+        mac_lookup[mac.lower()] = mac
+
+    # Setup progress bar, we don't know the packet count up front
+    if rich_progress != None:
+        extract_task = rich_progress.add_task(f"Reading packets", total=None)
+
+    packets_read = 0
+    partial_counts = list()
+    for chunk in stream_packet_field_chunks(pcap_file, packet_fields, columnar_chunk_rows):
+        chunk_counts = count_endpoints_in_chunk(chunk, packets_read, ip_types, mac_lookup, layer_matchers, tcp_port_matchers, udp_port_matchers)
+        if chunk_counts is not None:
+            partial_counts.append(chunk_counts)
+
+        # Collapse partial results every so often, memory then only grows with the number of distinct endpoints
+        if len(partial_counts) >= 8:
+            partial_counts = [combine_endpoint_counts(partial_counts, endpoint_group_keys)]
+
+        packets_read += len(chunk)
+        if rich_progress != None:
+            rich_progress.update(extract_task, description=f"Reading packets ({packets_read} read)")
 
     if rich_progress != None:
         rich_progress.remove_task(extract_task)
 
-    protocol_metrics_by_mac = dict(sorted(protocol_metrics_by_mac.items()))
-    return protocol_metrics_by_mac
+    endpoint_rows = dict()
+    if len(partial_counts) > 0:
+        counts = combine_endpoint_counts(partial_counts, endpoint_group_keys)
+
+        # Every packet counts towards "All", only classified packets count towards LAN/WAN
+        all_counts = combine_endpoint_counts([counts], ["ip_type", "mac", "proto", "ip"])
+        all_counts["scope"] = "All"
+        counts = pd.concat([all_counts, counts[counts["scope"] != ""]], ignore_index=True)
+
+        # tshark lists endpoints by total packets, keeping first seen order for ties
+        counts["total_pkts"] = counts["pkts_from"] + counts["pkts_to"]
+        counts["total_bytes"] = counts["bytes_from"] + counts["bytes_to"]
+        counts = counts.sort_values(["total_pkts", "first_seen"], ascending=[False, True], kind="stable")
+
+        row_columns = ["ip", "total_pkts", "total_bytes", "pkts_from", "bytes_from", "pkts_to", "bytes_to"]
+        for key, group in counts.groupby(["ip_type", "mac", "scope", "proto"], sort=False):
+            endpoint_rows[key] = list(zip(*[group[column].tolist() for column in row_columns]))
+
+    return build_protocol_metrics(endpoint_rows, ip_types, macs_to_analyze, flattened_protos, manual_verification_ports)
+
+
+def count_endpoints_in_chunk(chunk, first_packet, ip_types, mac_lookup, layer_matchers, tcp_port_matchers, udp_port_matchers):
+
+    chunk = chunk.reset_index(drop=True)
+    frame_len = chunk["frame.len"].to_numpy()
+
+    # Used to order endpoints the way tshark first saw them, the source of a packet comes before the destination
+    packet_order = (np.arange(len(chunk)) + first_packet) * 2
+
+    # A packet is counted for the source MAC and the destination MAC if we're analyzing them,
+    # but only once if both are the same
+    src_macs = chunk["eth.src"].map(mac_lookup)
+    dst_macs = chunk["eth.dst"].map(mac_lookup)
+    dst_macs = dst_macs.where(dst_macs != src_macs)
+
+    scopes = classify_chunk_scope(chunk)
+    proto_masks = build_protocol_masks(chunk, layer_matchers, tcp_port_matchers, udp_port_matchers)
+
+    frames = list()
+    for ip_type in ip_types:
+        ip_src = chunk[f"{ip_type}.src"].to_numpy()
+        ip_dst = chunk[f"{ip_type}.dst"].to_numpy()
+
+        # Packets without this IP layer don't show up in its endpoint table
+        has_ip = (ip_src != "") & (ip_dst != "")
+
+        for macs in (src_macs, dst_macs):
+            mac_values = macs.to_numpy()
+            has_mac = has_ip & macs.notna().to_numpy()
+
+            for proto, proto_mask in proto_masks.items():
+                selected = np.flatnonzero(has_mac & proto_mask)
+                if len(selected) == 0:
+                    continue
+
+                # One row for the source endpoint sending the packet, one for the destination receiving it
+                zeros = np.zeros(len(selected), dtype=np.int64)
+                ones = np.ones(len(selected), dtype=np.int64)
+                for ips, is_src in ((ip_src, True), (ip_dst, False)):
+                    frame = pd.DataFrame({
+                        "ip_type": ip_type,
+                        "mac": mac_values[selected],
+                        "scope": scopes[selected],
+                        "proto": proto,
+                        "ip": ips[selected],
+                        "pkts_from": ones if is_src else zeros,
+                        "bytes_from": frame_len[selected] if is_src else zeros,
+                        "pkts_to": zeros if is_src else ones,
+                        "bytes_to": zeros if is_src else frame_len[selected],
+                        "first_seen": packet_order[selected] + (0 if is_src else 1)
+                    })
+                    frames.append(frame)
+
+    if len(frames) == 0:
+        return None
+
+    return combine_endpoint_counts(frames, endpoint_group_keys)
+
+
+def combine_endpoint_counts(frames, group_keys):
+
+    counts = pd.concat(frames, ignore_index=True)
+    counts = counts.groupby(group_keys, sort=False).agg(
+        pkts_from=("pkts_from", "sum"),
+        bytes_from=("bytes_from", "sum"),
+        pkts_to=("pkts_to", "sum"),
+        bytes_to=("bytes_to", "sum"),
+        first_seen=("first_seen", "min")
+    )
+    return counts.reset_index()
+
+
+def build_protocol_masks(chunk, layer_matchers, tcp_port_matchers, udp_port_matchers):
+
+    # Column equivalent of match_protocols, a boolean array per protocol
+    proto_masks = dict()
+
+    # There are only a handful of distinct protocol stacks, so match against those and expand
+    stack_codes, stacks = pd.factorize(chunk["frame.protocols"])
+    stack_layers = [set(stack.split(':')) for stack in stacks]
+
+    for layer, protos in layer_matchers.items():
+        mask = np.array([layer in layers for layers in stack_layers], dtype=bool)[stack_codes]
+        for proto in protos:
+            proto_masks[proto] = proto_masks.get(proto, False) | mask
+
+    for port, protos in tcp_port_matchers.items():
+        mask = ((chunk["tcp.srcport"] == port) | (chunk["tcp.dstport"] == port)).to_numpy()
+        for proto in protos:
+            proto_masks[proto] = proto_masks.get(proto, False) | mask
+
+    for port, protos in udp_port_matchers.items():
+        mask = ((chunk["udp.srcport"] == port) | (chunk["udp.dstport"] == port)).to_numpy()
+        for proto in protos:
+            proto_masks[proto] = proto_masks.get(proto, False) | mask
+
+    return proto_masks
+
+
+def classify_chunk_scope(chunk):
+
+    # Column equivalent of lan_classifier.classify_scope, "" marks packets that are neither LAN nor WAN
+    return lan_classifier.classify_scopes(chunk["eth.dst.ig"], chunk["ip.src"], chunk["ip.dst"], chunk["ipv6.src"], chunk["ipv6.dst"])
+
+
+def packet_field_command(pcap_file, fields):
+
+    tshark_command = ["tshark", "-nr", pcap_file, "-T", "fields", "-E", "occurrence=f"]
+    for field in fields:
+        tshark_command += ["-e", field]
+
+    return tshark_command
+
+
+def stream_packet_fields(pcap_file, fields):
+
+    tshark_command = packet_field_command(pcap_file, fields)
+
+    # Stream stdout line by line so the capture never has to fit in memory, stderr goes to
+    # a file so a chatty tshark can't block on a full pipe
+    with tempfile.TemporaryFile(mode="w+") as error_file:
+        process = subprocess.Popen(tshark_command, stdout=subprocess.PIPE, stderr=error_file, text=True)
+
+        for line in process.stdout:
+            yield line.rstrip('\n').split('\t')
+
+        process.wait()
+        if process.returncode != 0:
+            error_file.seek(0)
+            print(f"ERROR: Cannot export packet fields for {pcap_file} - {error_file.read()}")
+
+
+def stream_packet_field_chunks(pcap_file, fields, chunk_rows):
+
+    tshark_command = packet_field_command(pcap_file, fields)
+
+    # Same as stream_packet_fields, but parsed straight into columns a chunk at a time
+    column_types = dict.fromkeys(fields, str)
+    column_types["frame.len"] = np.int64
+
+    with tempfile.TemporaryFile(mode="w+") as error_file:
+        process = subprocess.Popen(tshark_command, stdout=subprocess.PIPE, stderr=error_file, text=True)
+
+        reader = pd.read_csv(process.stdout, sep='\t', header=None, names=fields, dtype=column_types, keep_default_na=False,
+                             quoting=csv.QUOTE_NONE, on_bad_lines="skip", chunksize=chunk_rows)
+        try:
+            for chunk in reader:
+                yield chunk
+
+        # An empty export has no columns to parse
+        except pd.errors.EmptyDataError:
+            pass
+
+        # A capture tshark couldn't read (or only read part of) raises instead of passing for an empty or short one
+        process.wait()
+        if process.returncode != 0:
+            error_file.seek(0)
+            raise subprocess.CalledProcessError(process.returncode, tshark_command, stderr=error_file.read())
+
+
+def build_protocol_matchers(protos):
+
+    # Protocols are either named layers in frame.protocols or are recognized by port
+    # Map each to the protocols it indicates so each packet only needs a few lookups
+    layer_matchers = dict()
+    tcp_port_matchers = dict()
+    udp_port_matchers = dict()
+
+    for proto in protos:
+        if proto.isnumeric():
+            tcp_port_matchers.setdefault(proto, []).append(proto)
+            udp_port_matchers.setdefault(proto, []).append(proto)
+        elif "tcp:" in proto:
+            tcp_port_matchers.setdefault(proto.replace("tcp:", ""), []).append(proto)
+        elif "udp:" in proto:
+            udp_port_matchers.setdefault(proto.replace("udp:", ""), []).append(proto)
+        elif proto == "https":
+            tcp_port_matchers.setdefault("443", []).append(proto)
+        elif proto == "secure-mqtt":
+            tcp_port_matchers.setdefault("8883", []).append(proto)
+        else:
+            layer_matchers.setdefault(proto, []).append(proto)
+
+    return layer_matchers, tcp_port_matchers, udp_port_matchers
+
+
+def match_protocols(frame_protocols, tcp_srcport, tcp_dstport, udp_srcport, udp_dstport, layer_matchers, tcp_port_matchers, udp_port_matchers):
+
+    # A packet counts once for every protocol it matches, even if it matches it twice (e.g. both ports are 443)
+    matched = dict()
+
+    for layer in frame_protocols.split(':'):
+        if layer in layer_matchers:
+            matched.update(dict.fromkeys(layer_matchers[layer]))
+
+    for port in (tcp_srcport, tcp_dstport):
+        if port in tcp_port_matchers:
+            matched.update(dict.fromkeys(tcp_port_matchers[port]))
+
+    for port in (udp_srcport, udp_dstport):
+        if port in udp_port_matchers:
+            matched.update(dict.fromkeys(udp_port_matchers[port]))
+
+    return list(matched)
+
+
+def record_endpoint_packet(proto_counts, proto, ip_src, ip_dst, frame_len):
+
+    if proto not in proto_counts:
+        proto_counts[proto] = dict()
+    ip_counts = proto_counts[proto]
+
+    # Like tshark, the source is recorded before the destination so first seen order matches
+    if ip_src not in ip_counts:
+        ip_counts[ip_src] = [0, 0, 0, 0]
+    ip_counts[ip_src][0] += 1
+    ip_counts[ip_src][1] += frame_len
+
+    if ip_dst not in ip_counts:
+        ip_counts[ip_dst] = [0, 0, 0, 0]
+    ip_counts[ip_dst][2] += 1
+    ip_counts[ip_dst][3] += frame_len
+
+
+def split_endpoint_section(lines):
+
+    # Trim off header
+    lines = lines[4:]
+
+    # Loop until we find the end of this section
+    for index, line in enumerate(lines):
+        if "========" in line:
+            return lines[:index], lines[index+1:]
+
+    return lines, []
+
+
+def build_endpoint_metrics(endpoint_rows, scope, is_ipv6, flag):
+
+    # Rows are in order <ip>,<total_packets>,<total_bytes>,<packets_from_ip>,<bytes_from_ip>,<packets_to_ip>,<bytes_to_ip>
+    # and sorted by total packets like tshark's endpoint tables, the counts may still be tshark's strings
+
+    # If we found more than 2 endpoints and it's IPv4 trim off the host itself, it's the endpoint in every packet
+    # If no single endpoint is (e.g. DHCP from 0.0.0.0, an address change), fall back to the busiest endpoint
+    # being this host and flag it for manual verification
+    if len(endpoint_rows) > 2 and not is_ipv6:
+        device_ips = find_device_ips_in_endpoints(endpoint_rows)
+        if len(device_ips) == 0:
+            device_ips = {max(endpoint_rows, key=lambda x: int(x[1]))[0]}
+            flag = True
+        endpoint_rows = [row for row in endpoint_rows if row[0] not in device_ips]
+
+    # Else if it's IPv6 WAN, this host can start with anything in the 2620:0:5300::/44 address range
+    # or anything in the fdc4:22e1:d500::/44 address range
+    elif len(endpoint_rows) > 2 and is_ipv6 and scope == "WAN":
+        endpoint_rows = [row for row in endpoint_rows if not (row[0].startswith("2620:0:53"))]
+        endpoint_rows = [row for row in endpoint_rows if not (row[0].startswith("fdc4:22e1:d5"))]
+
+    # If we only found two or it's IPv6 LAN, we don't know which one is this host,
+    # need to manually verify
+    elif len(endpoint_rows) == 2 or (is_ipv6 and scope != "WAN"):
+        flag = True
+
+    endpoint_data = dict()
+    for row in endpoint_rows:
+
+        # We parse from the perspective of the MAC being analyzed, so if the tshark output says "X packets Tx from IP", we record that as "MAC Rx X packets from IP"
+        metric_dict = dict()
+        name = row[0]
+        if flag:
+            name += "*"
+        metric_dict["PktTotal"] = int(row[1])
+        metric_dict["ByteTotal"] = int(row[2])
+        metric_dict["PktRx"] = int(row[3])
+        metric_dict["ByteRx"] = int(row[4])
+        metric_dict["PktTx"] = int(row[5])
+        metric_dict["ByteTx"] = int(row[6])
+        endpoint_data[name] = metric_dict
+
+    # Sort by IP for nicer printing
+    return dict(sorted(endpoint_data.items(), key=sort_ips))
+
 
 def sort_ips(s):
     try:
@@ -761,70 +1236,16 @@ def sort_ips(s):
         return (1, s)
     return (0, ip)
 
-def write_output(proto_data_by_mac, out_dir, file_name):
+def write_output(proto_data_by_mac, out_dir, file_name, output_format="csv"):
 
-    # Process CSV output for writing
     # We're going to write 3 files, one for all, one for LAN, one for WAN
-    lines_to_write = []
-    lan_lines_to_write = []
-    wan_lines_to_write = []
-    header = "MAC,WAN/LAN,Protocol,IP,TotalPackets,TotalBytes,TxPackets,TxBytes,RxPackets,RxBytes\n"
-    lines_to_write.append(header)
-    lan_lines_to_write.append(header)
-    wan_lines_to_write.append(header)
-
-    for mac in proto_data_by_mac:
-        protocol_dict = proto_data_by_mac[mac]["All"]
-        for protocol, ip_dict in protocol_dict.items():
-            for ip, metric_dict in ip_dict.items():
-                packet_total = metric_dict["PktTotal"]
-                byte_total = metric_dict["ByteTotal"]
-                packet_rx = metric_dict["PktRx"]
-                byte_rx = metric_dict["ByteRx"]
-                packet_tx = metric_dict["PktTx"]
-                byte_tx = metric_dict["ByteTx"]
-                line_to_write = f"{mac},ALL,{protocol},{ip},{packet_total},{byte_total},{packet_tx},{byte_tx},{packet_rx},{byte_rx}\n"
-                lines_to_write.append(line_to_write)
-
-        protocol_dict = proto_data_by_mac[mac]["LAN"]
-        for protocol, ip_dict in protocol_dict.items():
-            for ip, metric_dict in ip_dict.items():
-                packet_total = metric_dict["PktTotal"]
-                byte_total = metric_dict["ByteTotal"]
-                packet_rx = metric_dict["PktRx"]
-                byte_rx = metric_dict["ByteRx"]
-                packet_tx = metric_dict["PktTx"]
-                byte_tx = metric_dict["ByteTx"]
-                line_to_write = f"{mac},ALL,{protocol},{ip},{packet_total},{byte_total},{packet_tx},{byte_tx},{packet_rx},{byte_rx}\n"
-                lan_lines_to_write.append(line_to_write)
-
-        protocol_dict = proto_data_by_mac[mac]["WAN"]
-        for protocol, ip_dict in protocol_dict.items():
-            for ip, metric_dict in ip_dict.items():
-                packet_total = metric_dict["PktTotal"]
-                byte_total = metric_dict["ByteTotal"]
-                packet_rx = metric_dict["PktRx"]
-                byte_rx = metric_dict["ByteRx"]
-                packet_tx = metric_dict["PktTx"]
-                byte_tx = metric_dict["ByteTx"]
-                line_to_write = f"{mac},ALL,{protocol},{ip},{packet_total},{byte_total},{packet_tx},{byte_tx},{packet_rx},{byte_rx}\n"
-                wan_lines_to_write.append(line_to_write)
-
-    # Write the files
-    outfile_name = f"{file_name}-protocols.csv"
-    outfile_location = os.path.join(out_dir, outfile_name)
-    with open(outfile_location, "w", newline='') as outfile:
-        outfile.writelines(lines_to_write)
-
-    outfile_name = f"{file_name}-protocols-LAN.csv"
-    outfile_location = os.path.join(out_dir, outfile_name)
-    with open(outfile_location, "w", newline='') as outfile:
-        outfile.writelines(lan_lines_to_write)
-
-    outfile_name = f"{file_name}-protocols-WAN.csv"
-    outfile_location = os.path.join(out_dir, outfile_name)
-    with open(outfile_location, "w", newline='') as outfile:
-        outfile.writelines(wan_lines_to_write)
+    # Each MAC's rows go straight to all three as we reach it
+    writer = protocol_output.open_writer(out_dir, file_name, output_format)
+    try:
+        for mac in proto_data_by_mac:
+            protocol_output.write_mac(writer, mac, proto_data_by_mac[mac])
+    finally:
+        protocol_output.close_writer(writer)
 
 if __name__ == "__main__":
    main(sys.argv[1:])
\ No newline at end of file
@@ -0,0 +1,94 @@
+import os
+import pandas as pd
+
+# Columns of the protocol metric files, in order
+header = ["MAC", "WAN/LAN", "Protocol", "IP", "TotalPackets", "TotalBytes", "TxPackets", "TxBytes", "RxPackets", "RxBytes"]
+text_columns = ["MAC", "WAN/LAN", "Protocol", "IP"]
+count_columns = ["TotalPackets", "TotalBytes", "TxPackets", "TxBytes", "RxPackets", "RxBytes"]
+
+# Each scope in the metrics is written to its own file
+scope_suffixes = {"All": "", "LAN": "-LAN", "WAN": "-WAN"}
+scope_labels = {"All": "ALL", "LAN": "LAN", "WAN": "WAN"}
+
+# Arrow is written as an IPC stream since each MAC's batch carries its own dictionaries, which the IPC file format doesn't allow
+output_extensions = {"csv": ".csv", "parquet": ".parquet", "arrow": ".arrows"}
+
+# Opens the ALL/LAN/WAN files for a capture, rows are then added a MAC at a time with write_mac
+def open_writer(out_dir, file_name, output_format="csv"):
+
+    writer = dict()
+    writer["format"] = output_format
+    writer["files"] = dict()
+
+    for scope, suffix in scope_suffixes.items():
+        outfile_location = os.path.join(out_dir, f"{file_name}-protocols{suffix}{output_extensions[output_format]}")
+
+        if output_format == "csv":
+            outfile = open(outfile_location, "w", newline='')
+            outfile.write(",".join(header) + "\n")
+            writer["files"][scope] = outfile
+
+        else:
+            # Only needed for the columnar formats, so only required when they're asked for
+            import pyarrow as pa
+            import pyarrow.ipc
+            import pyarrow.parquet
+
+            # MACs, protocols and IPs repeat on nearly every row, so store them as dictionaries
+            schema = pa.schema([(x, pa.dictionary(pa.int32(), pa.string())) for x in text_columns] + [(x, pa.int64()) for x in count_columns])
+            if output_format == "parquet":
+                writer["files"][scope] = pyarrow.parquet.ParquetWriter(outfile_location, schema)
+            else:
+                writer["files"][scope] = pyarrow.ipc.new_stream(outfile_location, schema)
+            writer["schema"] = schema
+
+    return writer
+
+
+# Writes every row for one MAC, proto_data is the "All"/"LAN"/"WAN" -> protocol -> IP -> metrics dict for that MAC
+def write_mac(writer, mac, proto_data):
+
+    for scope in scope_suffixes:
+        rows = list()
+        for protocol, ip_dict in proto_data[scope].items():
+            for ip, metric_dict in ip_dict.items():
+                rows.append((mac, scope_labels[scope], protocol, ip, metric_dict["PktTotal"], metric_dict["ByteTotal"], metric_dict["PktTx"], metric_dict["ByteTx"], metric_dict["PktRx"], metric_dict["ByteRx"]))
+
+        if writer["format"] == "csv":
+            writer["files"][scope].writelines(",".join(str(x) for x in row) + "\n" for row in rows)
+
+        elif len(rows) > 0:
+            import pyarrow as pa
+
+            columns = list(zip(*rows))
+            arrays = [pa.array(columns[i], type=pa.string()).dictionary_encode() for i in range(len(text_columns))]
+            arrays += [pa.array(columns[i], type=pa.int64()) for i in range(len(text_columns), len(header))]
+            writer["files"][scope].write_batch(pa.record_batch(arrays, schema=writer["schema"]))
+
+
+def close_writer(writer):
+    for outfile in writer["files"].values():
+        outfile.close()
+
+
+# Loads a protocol metric file written in any of the output formats
+def read_protocol_table(file_location):
+
+    extension = os.path.splitext(file_location)[1]
+
+    if extension == ".parquet":
+        table = pd.read_parquet(file_location)
+
+    elif extension == ".arrows":
+        import pyarrow.ipc
+        with pyarrow.ipc.open_stream(file_location) as reader:
+            table = reader.read_pandas()
+
+    else:
+        table = pd.read_csv(file_location, dtype=dict.fromkeys(text_columns, str), keep_default_na=False)
+
+    # Dictionary columns come back as categoricals, compare them like the CSV strings
+    for column in text_columns:
+        table[column] = table[column].astype(str)
+
+    return table
@@ -0,0 +1,84 @@
+import asyncio
+import dns.asyncresolver
+import dns.exception
+import dns.reversename
+import lookup_cache
+
+# Reverse DNS (PTR) lookups for many IPs at once
+# Every query is sent straight away, up to jobs of them in flight, so a few hundred IPs take about one timeout instead of one each
+# Names and failures are kept in the lookup cache under the same "ptr" kind whois_resolver uses, and in memory for the rest of the run
+
+# Creates the settings and shared state for the lookups
+# nameserver sends every query to one (host, port) instead of the system's resolvers, e.g. a local stub server
+def open_resolver(jobs=256, timeout=2.0, nameserver=None, cache=None):
+
+    resolver = dict()
+    resolver["jobs"] = jobs
+    resolver["timeout"] = timeout
+    resolver["nameserver"] = nameserver
+    resolver["cache"] = cache
+
+    # IP -> name (or None) for everything looked up so far
+    resolver["names"] = dict()
+    return resolver
+
+
+# Returns a dict of IP -> name without the trailing dot, or None where there's no name (or the query failed)
+def lookup_ptrs(resolver, ips):
+
+    ret_dict = dict()
+    uncached = list()
+    for ip in set(ips):
+        if ip in resolver["names"]:
+            ret_dict[ip] = resolver["names"][ip]
+            continue
+
+        found, name = lookup_cache.load(resolver["cache"], "ptr", ip)
+        if found or is_offline(resolver):
+            ret_dict[ip] = name
+            resolver["names"][ip] = name
+        else:
+            uncached.append(ip)
+
+    if len(uncached) > 0:
+        names = asyncio.run(query_ptrs(resolver, uncached))
+        for ip, name in zip(uncached, names):
+            lookup_cache.store(resolver["cache"], "ptr", ip, name)
+            ret_dict[ip] = name
+            resolver["names"][ip] = name
+
+    return ret_dict
+
+
+def is_offline(resolver):
+    return resolver["cache"] != None and resolver["cache"]["offline"]
+
+
+async def query_ptrs(resolver, ips):
+
+    dns_resolver = dns.asyncresolver.Resolver(configure=resolver["nameserver"] == None)
+    if resolver["nameserver"] != None:
+        dns_resolver.nameservers = [resolver["nameserver"][0]]
+        dns_resolver.port = resolver["nameserver"][1]
+
+    # The timeout covers the whole query, retries on other nameservers included
+    dns_resolver.timeout = resolver["timeout"]
+    dns_resolver.lifetime = resolver["timeout"]
+
+    in_flight = asyncio.Semaphore(resolver["jobs"])
+    return await asyncio.gather(*[query_ptr(dns_resolver, in_flight, ip) for ip in ips])
+
+
+async def query_ptr(dns_resolver, in_flight, ip):
+
+    async with in_flight:
+        try:
+            answer = await dns_resolver.resolve(dns.reversename.from_address(ip), "PTR")
+        except (dns.exception.DNSException, ValueError):
+            return None
+
+    # Remove trailing dot if it exists
+    name = str(answer[0])
+    if name.endswith('.'):
+        name = name[:-1]
+    return name
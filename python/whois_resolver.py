@@ -0,0 +1,277 @@
+import re
+import socket
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+import whois
+import lookup_cache
+
+# Asked for the WHOIS server of TLDs python-whois doesn't know
+IANA_SERVER = "whois.iana.org"
+
+# Team Cymru's bulk WHOIS interface maps IPs to the owner and country of their ASN
+ASN_SERVER = ("whois.cymru.com", 43)
+
+# IPs are sent to the ASN server this many to a query, like cymruwhois does
+ASN_BATCH_SIZE = 100
+
+# Creates the settings and shared state for the lookups
+# Each WHOIS server gets at most queries_per_second queries, every query gives up after timeout seconds and is tried again up to retries times
+# whois_server sends every WHOIS query to one (host, port) instead of the server for each domain, e.g. a local stub server
+# Answers are kept in the lookup cache if one is given, see lookup_cache.open_cache
+def open_resolver(jobs=16, queries_per_second=2.0, timeout=10.0, retries=2, whois_server=None, asn_server=ASN_SERVER, cache=None):
+
+    resolver = dict()
+    resolver["executor"] = ThreadPoolExecutor(max_workers=jobs)
+    resolver["interval"] = 1.0 / queries_per_second
+    resolver["timeout"] = timeout
+    resolver["retries"] = retries
+    resolver["whois_server"] = whois_server
+    resolver["asn_server"] = asn_server
+    resolver["cache"] = cache
+
+    # Every lookup is kept by its key, so a second request for the same hostname waits on the first instead of querying again
+    resolver["lock"] = threading.Lock()
+    resolver["lookups"] = dict()
+    resolver["next_query"] = dict()
+    resolver["tld_servers"] = dict()
+    resolver["tld_locks"] = dict()
+    return resolver
+
+
+def close_resolver(resolver):
+    resolver["executor"].shutdown(wait=True)
+
+
+# Starts a lookup unless the same one has already been started, returns its future
+def submit_lookup(resolver, key, function, *args):
+
+    with resolver["lock"]:
+        if key not in resolver["lookups"]:
+            resolver["lookups"][key] = resolver["executor"].submit(function, resolver, *args)
+        return resolver["lookups"][key]
+
+
+# Returns a future for the (owner, location) of a hostname's domain, either may be None
+def lookup_hostname(resolver, hostname):
+    return submit_lookup(resolver, ("whois", hostname), query_hostname_owner, hostname)
+
+
+# Returns a future for the (owner, location) of an IP, found through the domain of its reverse DNS name like whois.whois(ip)
+def lookup_ip(resolver, ip):
+    return submit_lookup(resolver, ("whois", ip), query_ip_owner, ip)
+
+
+# Returns futures for the ASN lookups of the IPs, each one a dict of IP -> (owner, location) for its batch
+# IPs that are cached come back together in an already finished future
+def lookup_asns(resolver, ips):
+
+    cached = dict()
+    uncached = list()
+    for ip in sorted(set(ips)):
+        found, value = lookup_cache.load(resolver["cache"], "asn", ip)
+        if found:
+            if value != None:
+                cached[ip] = tuple(value)
+        elif not is_offline(resolver):
+            uncached.append(ip)
+
+    cached_future = Future()
+    cached_future.set_result(cached)
+    futures = [cached_future]
+
+    ips = uncached
+    for i in range(0, len(ips), ASN_BATCH_SIZE):
+        batch = tuple(ips[i:i + ASN_BATCH_SIZE])
+        futures.append(submit_lookup(resolver, ("asn", batch), query_asn_owners, batch))
+
+    return futures
+
+
+def query_hostname_owner(resolver, hostname):
+
+    domain = whois.extract_domain(hostname)
+    return query_cached_domain_owner(resolver, domain)
+
+
+def query_ip_owner(resolver, ip):
+
+    name = run_cached(resolver, "ptr", ip, query_ptr, ip)
+    if name == None:
+        return None, None
+
+    return query_cached_domain_owner(resolver, whois.extract_domain(name))
+
+
+# The lookup cache holds WHOIS answers by domain, so hostnames and IPs that lead to the same domain share an entry
+def query_cached_domain_owner(resolver, domain):
+
+    result = run_cached(resolver, "whois", domain, query_domain_owner, domain)
+    if result == None:
+        return None, None
+    return tuple(result)
+
+
+# Returns the cached result of a lookup, or runs it and caches what it returns
+# Lookups that fail or find nothing (None, or no owner) are cached as failures, in offline mode anything not cached is None
+def run_cached(resolver, kind, key, function, *args):
+
+    found, value = lookup_cache.load(resolver["cache"], kind, key)
+    if found:
+        return value
+    if is_offline(resolver):
+        return None
+
+    try:
+        value = function(resolver, *args)
+    except Exception:
+        lookup_cache.store(resolver["cache"], kind, key, None)
+        raise
+
+    if isinstance(value, tuple) and value[0] == None:
+        value = None
+    lookup_cache.store(resolver["cache"], kind, key, value)
+    return value
+
+
+def is_offline(resolver):
+    return resolver["cache"] != None and resolver["cache"]["offline"]
+
+
+def query_ptr(resolver, ip):
+
+    try:
+        return socket.gethostbyaddr(ip)[0]
+    except (OSError, UnicodeError):
+        return None
+
+
+# Same queries as python-whois makes for a domain, only rate limited, with timeouts and retried
+# The registry's answer is asked first, then the registrar it refers to
+def query_domain_owner(resolver, domain):
+
+    server = ResolverNICClient(resolver).choose_server(domain)
+    if server == None:
+        return None, None
+
+    response = query_server(resolver, server, build_whois_query(server, domain))
+    if 'with "=xxx"' in response:
+        response = query_server(resolver, server, f"={domain}")
+
+    referred_server = whois.NICClient.findwhois_server(response, server, domain)
+    if referred_server != None and referred_server != "":
+        response += query_server(resolver, referred_server, build_whois_query(referred_server, domain))
+
+    result = whois.WhoisEntry.load(domain, response)
+
+    owner = None
+    location = None
+    if "org" in result:
+        owner = result["org"]
+    if "country" in result:
+        location = result["country"]
+    return owner, location
+
+
+# python-whois picks the server for a domain, but asks IANA itself for TLDs it doesn't know
+# This sends those through the resolver too, and remembers the answer for each TLD
+class ResolverNICClient(whois.NICClient):
+
+    def __init__(self, resolver):
+        super().__init__()
+        self.resolver = resolver
+
+    def findwhois_iana(self, tld):
+
+        # Lookups for other domains in the same TLD wait for the first one's answer
+        with self.resolver["lock"]:
+            tld_lock = self.resolver["tld_locks"].setdefault(tld, threading.Lock())
+
+        with tld_lock:
+            if tld not in self.resolver["tld_servers"]:
+                match = re.search(r"whois:\s+(.*?)\n", query_server(self.resolver, IANA_SERVER, tld))
+                self.resolver["tld_servers"][tld] = match.group(1).strip() if match else None
+
+        return self.resolver["tld_servers"][tld]
+
+
+# A few registries want extra flags with the query
+def build_whois_query(server, domain):
+
+    if server == whois.NICClient.DENICHOST:
+        return f"-T dn,ace -C UTF-8 {domain}"
+    elif server == whois.NICClient.DK_HOST:
+        return f" --show-handles {domain}"
+    return domain
+
+
+# Sends a batch of IPs to the ASN server's bulk interface
+# Answers are <asn> | <ip> | <prefix> | <cc> | <owner>, IPs it doesn't know are left out
+def query_asn_owners(resolver, ips):
+
+    query = "\n".join(["begin", "prefix", "asnumber", "countrycode", "notruncate"] + list(ips) + ["end"])
+    try:
+        response = query_server(resolver, ASN_SERVER[0], query, resolver["asn_server"])
+    except OSError:
+        for ip in ips:
+            lookup_cache.store(resolver["cache"], "asn", ip, None)
+        raise
+
+    ret_dict = dict()
+    for line in response.split('\n'):
+        parts = [x.strip() for x in line.split('|')]
+        if len(parts) != 5 or parts[1] not in ips:
+            continue
+
+        # Like cymruwhois, only the first answer for an IP is kept
+        if parts[1] not in ret_dict:
+            ret_dict[parts[1]] = (parts[4], parts[3])
+
+    # IPs the server doesn't know are cached as failures
+    for ip in ips:
+        lookup_cache.store(resolver["cache"], "asn", ip, ret_dict.get(ip))
+
+    return ret_dict
+
+
+# Sends one WHOIS query (RFC 3912) and returns the whole answer
+# server names the server for rate limiting, the query goes to address if given, otherwise to the server (or the override) on port 43
+def query_server(resolver, server, query, address=None):
+
+    if address == None:
+        address = resolver["whois_server"] if resolver["whois_server"] != None else (server, 43)
+
+    for attempt in range(resolver["retries"] + 1):
+        wait_for_turn(resolver, server)
+        try:
+            with socket.create_connection(address, timeout=resolver["timeout"]) as connection:
+                connection.sendall(query.encode("utf-8") + b"\r\n")
+
+                response = b""
+                while True:
+                    data = connection.recv(4096)
+                    if not data:
+                        break
+                    response += data
+
+            return response.decode("utf-8", "replace")
+
+        except OSError:
+            # Give the server a moment before trying again, longer each time
+            if attempt == resolver["retries"]:
+                raise
+            time.sleep(resolver["interval"] * (2 ** attempt))
+
+
+# Blocks until the server may be sent another query
+# Each caller reserves the next free slot before sleeping, so concurrent callers never share one
+def wait_for_turn(resolver, server):
+
+    with resolver["lock"]:
+        now = time.monotonic()
+        start = max(now, resolver["next_query"].get(server, now))
+        resolver["next_query"][server] = start + resolver["interval"]
+
+    if start > now:
+        time.sleep(start - now)